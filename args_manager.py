@@ -40,6 +40,83 @@ args_parser.parser.add_argument("--always-download-new-model", action='store_tru
 args_parser.parser.add_argument("--rebuild-hash-cache", help="Generates missing model and LoRA hashes.",
                                 type=int, nargs="?", metavar="CPU_NUM_THREADS", const=-1)
 
+args_parser.parser.add_argument("--batched-sampling", help="Sample the images of one request together in batches "
+                                "sized by free memory, optionally capped at MAX_BATCH_SIZE.",
+                                type=int, nargs="?", metavar="MAX_BATCH_SIZE", const=0, default=None)
+
+args_parser.parser.add_argument("--queue-affinity-limit", type=int, default=4, metavar="N",
+                                help="Run queued tasks that use the currently loaded models first, letting each task "
+                                  "be overtaken at most N times. Use 0 to keep plain queue order.")
+
+args_parser.parser.add_argument("--post-processing-workers", type=int, default=2, metavar="N",
+                                help="Number of threads that save finished images while the next ones are sampled. "
+                                  "Use 0 to save on the sampling thread.")
+
+args_parser.parser.add_argument("--worker-devices", type=str, default=None, metavar="DEVICES",
+                                help="Start one extra worker process per comma-separated device (CUDA device id or "
+                                  "'cpu'). All workers take tasks from the same queue.")
+
+args_parser.parser.add_argument("--job-journal", type=str, nargs="?", const='', default=None, metavar="PATH",
+                                help="Record queued jobs and their saved images in a SQLite journal, by default "
+                                  "jobs.db in the outputs folder, and resume unfinished jobs after a restart.")
+
+args_parser.parser.add_argument("--disable-mmap-loading", action='store_true',
+                                help="Read checkpoints fully into memory before building the models instead of "
+                                  "memory-mapping them. Uses about twice the checkpoint size in RAM while loading.")
+
+args_parser.parser.add_argument("--split-checkpoint-cache", type=str, nargs="?", const='', default=None,
+                                metavar="PATH",
+                                help="Store each loaded checkpoint split into UNet, CLIP and VAE safetensors with its "
+                                  "detected config, by default in models/checkpoints_split, and load it from there "
+                                  "next time without detection and conversion.")
+
+args_parser.parser.add_argument("--checkpoint-cache-size", type=float, default=0, metavar="GB",
+                                help="Keep recently used checkpoints in RAM up to a total of GB gigabytes, so that "
+                                  "switching back to them does not read them from disk again.")
+
+args_parser.parser.add_argument("--prefetch-size", type=float, default=0, metavar="GB",
+                                help="While a job runs, read the model files of the next queued job in the "
+                                  "background, up to GB gigabytes, so that they load from the page cache.")
+
+args_parser.parser.add_argument("--eviction-policy", type=str, default='lru', choices=['lru', 'cost'],
+                                help="How models are chosen for unloading from VRAM when memory is needed. 'cost' "
+                                  "keeps models that are slow to load or needed by the next queued task.")
+
+args_parser.parser.add_argument("--clip-cache-size", type=int, default=256, metavar="N",
+                                help="Keep the CLIP conditioning of the last N prompts across tasks, 0 to disable.")
+
+args_parser.parser.add_argument("--clip-cache", type=str, nargs="?", const='', default=None, metavar="PATH",
+                                help="Also store cached CLIP conditioning on disk, by default in models/clip_cache, "
+                                  "so that it survives restarts.")
+
+args_parser.parser.add_argument("--int8-cpu-aux-models", action='store_true',
+                                help="Run the prompt expansion, image description and censor models on the CPU with "
+                                  "int8 quantized linear layers, see experiments_quantization.py for their accuracy "
+                                  "and speed.")
+
+args_parser.parser.add_argument("--lora-cache-size", type=float, default=1, metavar="GB",
+                                help="Keep recently used LoRA files parsed in RAM up to a total of GB gigabytes.")
+
+args_parser.parser.add_argument("--runtime-lora", action='store_true',
+                                help="Apply LoRAs as low rank side branches of the layers instead of merging them "
+                                  "into the model weights. Switching LoRAs is almost free, every step is slower.")
+
+args_parser.parser.add_argument("--lora-merge-cache-size", type=float, default=0, metavar="GB",
+                                help="Keep model weights with LoRAs already merged in RAM up to a total of GB "
+                                  "gigabytes, so that repeating a LoRA combination does not compute them again.")
+
+args_parser.parser.add_argument("--result-cache-size", type=int, default=0, metavar="N",
+                                help="Remember the images of up to N generated seeds and return them again for "
+                                  "identical text-to-image requests instead of sampling. Off by default.")
+args_parser.parser.add_argument("--result-cache-max-age", type=float, default=24 * 7, metavar="HOURS",
+                                help="Do not reuse cached images that are older than HOURS.")
+
+args_parser.parser.add_argument("--api-port", type=int, default=None, metavar="PORT",
+                                help="Serve the HTTP/WebSocket generation API on PORT next to the web UI.")
+args_parser.parser.add_argument("--api-only", action='store_true',
+                                help="Only serve the generation API, without the web UI. "
+                                  "Uses --api-port, or --port if it is not given.")
+
 args_parser.parser.set_defaults(
     disable_cuda_malloc=True,
     in_browser=True,
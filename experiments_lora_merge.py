@@ -0,0 +1,75 @@
+import argparse
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Compares the merge time of the batched LoRA merge with merging one key '
+                                             'at a time.')
+parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint name, the default model if not given.')
+parser.add_argument('--loras', type=str, nargs='+', default=None, metavar='NAME[:WEIGHT]',
+                    help='LoRA names with optional weights, the default LoRAs if not given.')
+parser.add_argument('--repeat', type=int, default=3)
+benchmark_args, sys.argv[1:] = parser.parse_known_args()
+
+import torch
+
+import ldm_patched.modules.model_management as model_management
+import modules.config as config
+import modules.core as core
+from modules.lora_merge import calculate_weights_batched
+from modules.patch import patch_all
+from modules.util import get_file_from_folder_list
+
+patch_all()
+
+checkpoint = benchmark_args.checkpoint or config.default_base_model_name
+if benchmark_args.loras is None:
+    loras = [(name, weight) for enabled, name, weight in config.default_loras if enabled and name != 'None']
+else:
+    loras = [(name, float(weight or 1.0)) for name, _, weight in (x.partition(':') for x in benchmark_args.loras)]
+
+model = core.load_model(get_file_from_folder_list(checkpoint, config.paths_checkpoints))
+model.refresh_loras(loras)
+device = model_management.get_torch_device()
+
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(name, patcher, calculate):
+    keys = list(patcher.patches.keys())
+    model_sd = patcher.model_state_dict()
+    sample_keys = set(keys[::max(1, len(keys) // 32)])
+    samples = {}
+    timings = []
+    for _ in range(benchmark_args.repeat):
+        synchronize()
+        start_time = time.perf_counter()
+        for key, weight in calculate(patcher, keys, model_sd, device):
+            if key in sample_keys:
+                samples[key] = weight.cpu()
+            del weight
+        synchronize()
+        timings.append(time.perf_counter() - start_time)
+        model_management.soft_empty_cache()
+    print(f'{name}: {len(keys)} keys, best of {len(timings)} runs {min(timings):.3f} seconds')
+    return samples
+
+
+def calculate_weights_per_key(patcher, keys, model_sd, device_to):
+    for key in keys:
+        yield key, patcher.calculate_key_weight(key, model_sd[key], device_to)
+
+
+print(f'Merging {loras} into {checkpoint} on {device}')
+patchers = [('UNet', model.unet_with_lora)]
+if model.clip_with_lora is not None:
+    patchers.append(('CLIP', model.clip_with_lora.patcher))
+for part, patcher in patchers:
+    if patcher is None or len(patcher.patches) == 0:
+        continue
+    reference = benchmark(f'{part} per key', patcher, calculate_weights_per_key)
+    batched = benchmark(f'{part} batched', patcher, calculate_weights_batched)
+    error = max((reference[key].float() - batched[key].float()).abs().max().item() for key in reference)
+    print(f'{part} largest difference on {len(reference)} sampled keys: {error:.6f}')
@@ -0,0 +1,91 @@
+import argparse
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Finds the number of sampling steps from which merging LoRAs into the '
+                                             'weights is faster than applying them as runtime side branches.')
+parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint name, the default model if not given.')
+parser.add_argument('--loras', type=str, nargs='+', default=None, metavar='NAME[:WEIGHT]',
+                    help='LoRA names with optional weights, the default LoRAs if not given.')
+parser.add_argument('--width', type=int, default=1024)
+parser.add_argument('--height', type=int, default=1024)
+parser.add_argument('--repeat', type=int, default=10)
+benchmark_args, sys.argv[1:] = parser.parse_known_args()
+
+import torch
+
+import ldm_patched.modules.model_management as model_management
+import modules.config as config
+import modules.core as core
+import modules.task_context as task_context
+from ldm_patched.modules.model_patcher import ModelPatcher
+from modules.lora_runtime import patch_weight_at_runtime
+from modules.patch import patch_all, PatchSettings
+from modules.util import get_file_from_folder_list
+
+merge_all_weights = ModelPatcher.patch_weight_at_runtime
+patch_all()
+task_context.current().patch_settings = PatchSettings()
+
+checkpoint = benchmark_args.checkpoint or config.default_base_model_name
+if benchmark_args.loras is None:
+    loras = [(name, weight) for enabled, name, weight in config.default_loras if enabled and name != 'None']
+else:
+    loras = [(name, float(weight or 1.0)) for name, _, weight in (x.partition(':') for x in benchmark_args.loras)]
+
+model = core.load_model(get_file_from_folder_list(checkpoint, config.paths_checkpoints))
+model.refresh_loras(loras)
+model_management.load_models_gpu([model.unet])
+patcher = model.unet_with_lora
+device = model_management.get_torch_device()
+
+unet_config = patcher.model.model_config.unet_config
+x = torch.randn((2, 4, benchmark_args.height // 8, benchmark_args.width // 8), device=device)
+sigma = torch.full((2,), 5.0, device=device)
+conds = dict(c_crossattn=torch.randn((2, 77, unet_config['context_dim']), device=device))
+if unet_config.get('adm_in_channels') is not None:
+    conds['y'] = torch.randn((2, unet_config['adm_in_channels']), device=device)
+
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure(name, runtime):
+    ModelPatcher.patch_weight_at_runtime = patch_weight_at_runtime if runtime else merge_all_weights
+
+    switch_times = []
+    for _ in range(3):
+        synchronize()
+        start_time = time.perf_counter()
+        patcher.patch_model(device_to=device)
+        synchronize()
+        switch_times.append(time.perf_counter() - start_time)
+        patcher.unpatch_model()
+
+    patcher.patch_model(device_to=device)
+    with torch.inference_mode():
+        patcher.model.apply_model(x, sigma, **conds)
+        synchronize()
+        start_time = time.perf_counter()
+        for _ in range(benchmark_args.repeat):
+            patcher.model.apply_model(x, sigma, **conds)
+        synchronize()
+    step_time = (time.perf_counter() - start_time) / benchmark_args.repeat
+    patcher.unpatch_model()
+
+    print(f'{name}: switching LoRAs {min(switch_times):.3f} seconds, one step {step_time:.3f} seconds')
+    return min(switch_times), step_time
+
+
+print(f'{len(patcher.patches)} keys of {checkpoint} patched by {loras} at {benchmark_args.width}x{benchmark_args.height}')
+merged_switch, merged_step = measure('Merged', runtime=False)
+runtime_switch, runtime_step = measure('Runtime', runtime=True)
+
+if runtime_step <= merged_step:
+    print('Runtime LoRAs are faster at any number of steps')
+else:
+    crossover = (merged_switch - runtime_switch) / (runtime_step - merged_step)
+    print(f'Runtime LoRAs are faster for tasks with fewer than {crossover:.1f} steps per LoRA switch, '
+          f'merging is faster above that')
@@ -0,0 +1,151 @@
+import argparse
+import glob
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Compares the accuracy and latency of the int8 quantized CPU mode of the '
+                                             'prompt expansion, BLIP and censor models with the float models. Add '
+                                             '--always-cpu to compare with the float models on the CPU.')
+parser.add_argument('--models', type=str, nargs='+', default=['expansion', 'blip', 'censor'],
+                    choices=['expansion', 'blip', 'censor'])
+parser.add_argument('--prompts', type=str, nargs='+',
+                    default=['a handsome man', 'a cat sitting on a window sill', 'castle in the mountains at sunset',
+                             'portrait of an old fisherman, oil painting'])
+parser.add_argument('--seeds', type=int, default=8, help='Expansions per prompt.')
+parser.add_argument('--images', type=str, nargs='+', default=None,
+                    help='Images to describe and censor, 16 of the style samples if not given.')
+benchmark_args, sys.argv[1:] = parser.parse_known_args()
+
+import cv2
+import numpy as np
+import torch
+
+import ldm_patched.modules.model_management as model_management
+
+image_paths = benchmark_args.images or sorted(glob.glob('./sdxl_styles/samples/*.jpg'))[:16]
+
+
+def load_images():
+    return [cv2.imread(path)[:, :, ::-1].copy() for path in image_paths]
+
+
+def cosine(a, b):
+    return torch.nn.functional.cosine_similarity(a.float().flatten(1), b.float().flatten(1)).mean().item()
+
+
+def word_overlap(a, b):
+    a, b = set(a.lower().replace(',', ' ').split()), set(b.lower().replace(',', ' ').split())
+    return len(a & b) / max(len(a | b), 1)
+
+
+def measure(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def report(name, float_time, int8_time, **accuracy):
+    print(f'{name}: float {float_time:.3f} seconds, int8 {int8_time:.3f} seconds, '
+          f'speedup {float_time / max(int8_time, 1e-9):.2f}x')
+    for key, value in accuracy.items():
+        print(f'    {key}: {value:.4f}')
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def compare_expansion():
+    from extras.expansion import FooocusExpansion
+
+    engines = [FooocusExpansion(int8_cpu=False), FooocusExpansion(int8_cpu=True)]
+    if not all(engine.available for engine in engines):
+        print('Fooocus V2 Expansion is not available.')
+        return
+
+    # the next token scores of the prompts, after the expansion bias, and the candidates sampled from
+    logits = []
+    for engine in engines:
+        model_management.load_model_gpu(engine.patcher)
+        scores = []
+        for prompt in benchmark_args.prompts:
+            input_ids = engine.tokenizer(prompt + ',', return_tensors='pt').data['input_ids']
+            input_ids = input_ids.to(engine.patcher.load_device)
+            scores.append(engine.logits_processor(input_ids, engine.model(input_ids).logits[:, -1].float()).cpu())
+        logits.append(torch.cat(scores))
+    top_1 = (logits[0].argmax(-1) == logits[1].argmax(-1)).float().mean().item()
+    top_100 = [len(set(a.tolist()) & set(b.tolist())) / 100 for a, b in
+               zip(torch.topk(logits[0], 100).indices, torch.topk(logits[1], 100).indices)]
+
+    prompts = [prompt for prompt in benchmark_args.prompts for _ in range(benchmark_args.seeds)]
+    seeds = [seed for _ in benchmark_args.prompts for seed in range(benchmark_args.seeds)]
+    results = []
+    times = []
+    for engine in engines:
+        engine.cache.clear()
+        model_management.load_model_gpu(engine.patcher)
+        engine.expand_batch(prompts[:1], seeds[:1])
+        engine.cache.clear()
+        result, elapsed = measure(engine.expand_batch, prompts, seeds)
+        results.append(result)
+        times.append(elapsed)
+
+    report(f'Expansion of {len(prompts)} prompts', times[0], times[1],
+           next_token_top_1_agreement=top_1,
+           next_token_top_100_overlap=sum(top_100) / len(top_100),
+           identical_expansions=sum(a == b for a, b in zip(*results)) / len(prompts),
+           expansion_word_overlap=sum(word_overlap(a, b) for a, b in zip(*results)) / len(prompts))
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def compare_blip(images):
+    from extras.interrogate import Interrogator
+
+    captions = []
+    times = []
+    for interrogator in [Interrogator(int8_cpu=False), Interrogator(int8_cpu=True)]:
+        interrogator.interrogate(images[0])
+        result = []
+        start_time = time.perf_counter()
+        for image in images:
+            torch.manual_seed(0)
+            result.append(interrogator.interrogate(image))
+        times.append(time.perf_counter() - start_time)
+        captions.append(result)
+
+    for a, b in zip(*captions):
+        print(f'    float: {a}\n    int8:  {b}')
+    report(f'BLIP captions of {len(images)} images', times[0], times[1],
+           identical_captions=sum(a == b for a, b in zip(*captions)) / len(images),
+           caption_word_overlap=sum(word_overlap(a, b) for a, b in zip(*captions)) / len(images))
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def compare_censor(images):
+    from extras.censor import Censor
+
+    embeddings = []
+    decisions = []
+    times = []
+    for censor in [Censor(int8_cpu=False), Censor(int8_cpu=True)]:
+        censor.censor([images[0]])
+        # the safety checker blacks out flagged images in the list it is given
+        _, elapsed = measure(censor.censor, list(images))
+        times.append(elapsed)
+
+        model = censor.safety_checker_model.model
+        clip_input = censor.clip_image_processor(images, return_tensors='pt').pixel_values.to(censor.load_device)
+        embeddings.append(model.visual_projection(model.vision_model(clip_input)[1]).cpu())
+        decisions.append(np.array(model(clip_input=clip_input, images=list(images))[1]))
+
+    report(f'Censor of {len(images)} images', times[0], times[1],
+           image_embedding_cosine=cosine(*embeddings),
+           nsfw_decision_agreement=float((decisions[0] == decisions[1]).mean()))
+
+
+if 'expansion' in benchmark_args.models:
+    compare_expansion()
+if 'blip' in benchmark_args.models:
+    compare_blip(load_images())
+if 'censor' in benchmark_args.models:
+    compare_censor(load_images())
@@ -6,6 +6,7 @@ from transformers import CLIPConfig, CLIPImageProcessor
 
 import ldm_patched.modules.model_management as model_management
 import modules.config
+from extras.quantization import quantize_int8, use_int8_cpu
 from extras.safety_checker.models.safety_checker import StableDiffusionSafetyChecker
 from ldm_patched.modules.model_patcher import ModelPatcher
 
@@ -15,7 +16,8 @@ preprocessor_config_path = os.path.join(safety_checker_repo_root, "configs", "pr
 
 
 class Censor:
-    def __init__(self):
+    def __init__(self, int8_cpu=None):
+        self.int8_cpu = int8_cpu
         self.safety_checker_model: ModelPatcher | None = None
         self.clip_image_processor: CLIPImageProcessor | None = None
         self.load_device = torch.device('cpu')
@@ -32,6 +34,14 @@ class Censor:
             self.load_device = model_management.text_encoder_device()
             self.offload_device = model_management.text_encoder_offload_device()
 
+            if self.int8_cpu is None:
+                self.int8_cpu = use_int8_cpu()
+
+            if self.int8_cpu:
+                self.load_device = torch.device('cpu')
+                self.offload_device = torch.device('cpu')
+                model = quantize_int8(model, 'Safety checker')
+
             model.to(self.offload_device)
 
             self.safety_checker_model = ModelPatcher(model, load_device=self.load_device, offload_device=self.offload_device)
@@ -6,13 +6,16 @@
 
 
 import os
+import threading
 import torch
 import math
 import ldm_patched.modules.model_management as model_management
 
+from collections import OrderedDict
 from transformers.generation.logits_process import LogitsProcessorList
-from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
+from transformers import AutoTokenizer, AutoModelForCausalLM
 from modules.config import path_fooocus_expansion
+from extras.quantization import quantize_int8, use_int8_cpu
 from ldm_patched.modules.model_patcher import ModelPatcher
 
 
@@ -35,10 +38,15 @@ def remove_pattern(x, pattern):
 
 
 class FooocusExpansion:
-    def __init__(self):
+    def __init__(self, max_cache_entries=1024, int8_cpu=None):
         self.available = False
         self.tokenizer = None
         self.logits_bias = None
+        self.max_cache_entries = max_cache_entries
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(path_fooocus_expansion)
@@ -75,7 +83,16 @@ class FooocusExpansion:
                 load_device = torch.device('cpu')
                 offload_device = torch.device('cpu')
 
-            use_fp16 = model_management.should_use_fp16(device=load_device)
+            if int8_cpu is None:
+                int8_cpu = use_int8_cpu()
+
+            if int8_cpu:
+                load_device = torch.device('cpu')
+                offload_device = torch.device('cpu')
+                self.model = quantize_int8(self.model, 'Fooocus V2 Expansion')
+                use_fp16 = False
+            else:
+                use_fp16 = model_management.should_use_fp16(device=load_device)
 
             if use_fp16:
                 self.model.half()
@@ -90,56 +107,137 @@ class FooocusExpansion:
             print('[INFO] Fooocus will work without prompt expansion (optional feature)')
             self.available = False
 
+    def get_cached(self, key):
+        with self.cache_lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return result
+
+    def put_cached(self, key, result):
+        with self.cache_lock:
+            self.cache[key] = result
+            while len(self.cache) > max(0, self.max_cache_entries):
+                self.cache.popitem(last=False)
+
+    def stats(self):
+        with self.cache_lock:
+            return dict(entries=len(self.cache), hits=self.hits, misses=self.misses)
+
     @torch.no_grad()
     @torch.inference_mode()
     def logits_processor(self, input_ids, scores):
-        assert scores.ndim == 2 and scores.shape[0] == 1
         self.logits_bias = self.logits_bias.to(scores)
 
-        bias = self.logits_bias.clone()
-        bias[0, input_ids[0].to(bias.device).long()] = neg_inf
-        bias[0, 11] = 0
+        # same as adding the bias with the tokens of input_ids banned and the comma always allowed, without a copy of
+        # the bias per step
+        result = scores + self.logits_bias
+        input_ids = input_ids.to(scores.device).long()
+        result.scatter_(1, input_ids, scores.gather(1, input_ids) + neg_inf)
+        result[:, 11] = scores[:, 11]
+        return result
+
+    def create_sampler(self, seeds, top_k=100):
+        # each row draws from its own generator, seeded as set_seed(seed) seeded the global one, from the distribution
+        # generate(do_sample=True, top_k=top_k) samples from, so a batch of one gives the expansion earlier versions
+        # gave for the seed and the expansion of a seed does not depend on the batch
+        generators = []
+
+        @torch.no_grad()
+        @torch.inference_mode()
+        def sampler(input_ids, scores):
+            scores = self.logits_processor(input_ids, scores)
+
+            # same as TopKLogitsWarper
+            k = min(top_k, scores.shape[-1])
+            scores = scores.masked_fill(scores < torch.topk(scores, k)[0][..., -1, None], -float('inf'))
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+
+            if len(generators) == 0:
+                generators.extend(torch.Generator(device=scores.device).manual_seed(seed) for seed in seeds)
+            chosen = torch.cat([torch.multinomial(probs[i:i + 1], num_samples=1, generator=generator)
+                                for i, generator in enumerate(generators)])
+
+            # generate picks the only token that is not banned
+            result = torch.full_like(scores, neg_inf)
+            result.scatter_(1, chosen, 0)
+            return result
 
-        return scores + bias
+        return sampler
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def generate_tokens(self, input_ids, seeds, max_new_tokens, pad_token_id=None):
+        # https://huggingface.co/blog/introducing-csearch
+        # https://huggingface.co/docs/transformers/generation_strategies
+        return self.model.generate(input_ids=input_ids,
+                                   attention_mask=torch.ones_like(input_ids),
+                                   max_new_tokens=max_new_tokens,
+                                   do_sample=False,
+                                   pad_token_id=pad_token_id,
+                                   logits_processor=LogitsProcessorList([self.create_sampler(seeds)]))
 
     @torch.no_grad()
     @torch.inference_mode()
     def __call__(self, prompt, seed):
-        if prompt == '':
-            return ''
+        return self.expand_batch([prompt], [seed])[0]
 
-        # Si FooocusExpansion no se cargó, retornar prompt sin expandir
-        if not self.available:
-            return prompt
+    @torch.no_grad()
+    @torch.inference_mode()
+    def expand_batch(self, prompts, seeds, max_batch_size=32):
+        """
+        Expands prompts[i] with seeds[i]. Prompts of the same token length are generated together, the result for a
+        prompt and seed is the same in any batch and is kept in an LRU cache.
+        """
+        results = [None] * len(prompts)
+        pending = {}
+        for i, (prompt, seed) in enumerate(zip(prompts, seeds)):
+            if prompt == '':
+                results[i] = ''
+            elif not self.available:
+                # Si FooocusExpansion no se cargó, retornar prompt sin expandir
+                results[i] = prompt
+            else:
+                key = (safe_str(prompt) + ',', int(seed) % SEED_LIMIT_NUMPY)
+                results[i] = self.get_cached(key)
+                if results[i] is None:
+                    pending.setdefault(key, []).append(i)
+
+        if len(pending) == 0:
+            return results
 
         if self.patcher.current_device != self.patcher.load_device:
             print('Fooocus Expansion loaded by itself.')
             model_management.load_model_gpu(self.patcher)
 
-        seed = int(seed) % SEED_LIMIT_NUMPY
-        set_seed(seed)
-        prompt = safe_str(prompt) + ','
+        groups = {}
+        for key in pending:
+            input_ids = self.tokenizer(key[0], return_tensors="pt").data['input_ids']
+            groups.setdefault(int(input_ids.shape[1]), []).append((key, input_ids))
 
-        tokenized_kwargs = self.tokenizer(prompt, return_tensors="pt")
-        tokenized_kwargs.data['input_ids'] = tokenized_kwargs.data['input_ids'].to(self.patcher.load_device)
-        tokenized_kwargs.data['attention_mask'] = tokenized_kwargs.data['attention_mask'].to(self.patcher.load_device)
+        for current_token_length, group in groups.items():
+            max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
+            max_new_tokens = max_token_length - current_token_length
 
-        current_token_length = int(tokenized_kwargs.data['input_ids'].shape[1])
-        max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
-        max_new_tokens = max_token_length - current_token_length
+            for start in range(0, len(group), max_batch_size):
+                batch = group[start:start + max_batch_size]
+                if max_new_tokens == 0:
+                    expansions = [key[0][:-1] for key, _ in batch]
+                else:
+                    input_ids = torch.cat([x for _, x in batch]).to(self.patcher.load_device)
 
-        if max_new_tokens == 0:
-            return prompt[:-1]
+                    features = self.generate_tokens(input_ids, [key[1] for key, _ in batch], max_new_tokens,
+                                                    pad_token_id=self.tokenizer.eos_token_id)
 
-        # https://huggingface.co/blog/introducing-csearch
-        # https://huggingface.co/docs/transformers/generation_strategies
-        features = self.model.generate(**tokenized_kwargs,
-                                       top_k=100,
-                                       max_new_tokens=max_new_tokens,
-                                       do_sample=True,
-                                       logits_processor=LogitsProcessorList([self.logits_processor]))
+                    response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
+                    expansions = [safe_str(x) for x in response]
 
-        response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
-        result = safe_str(response[0])
+                for (key, _), expansion in zip(batch, expansions):
+                    self.put_cached(key, expansion)
+                    for i in pending[key]:
+                        results[i] = expansion
 
-        return result
+        return results
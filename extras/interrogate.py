@@ -8,6 +8,7 @@ from modules.model_loader import load_file_from_url
 from modules.config import path_clip_vision
 from ldm_patched.modules.model_patcher import ModelPatcher
 from extras.BLIP.models.blip import blip_decoder
+from extras.quantization import quantize_int8, use_int8_cpu
 
 
 blip_image_eval_size = 384
@@ -15,7 +16,8 @@ blip_repo_root = os.path.join(os.path.dirname(__file__), 'BLIP')
 
 
 class Interrogator:
-    def __init__(self):
+    def __init__(self, int8_cpu=None):
+        self.int8_cpu = int8_cpu
         self.blip_model = None
         self.load_device = torch.device('cpu')
         self.offload_device = torch.device('cpu')
@@ -39,9 +41,17 @@ class Interrogator:
             self.offload_device = model_management.text_encoder_offload_device()
             self.dtype = torch.float32
 
+            if self.int8_cpu is None:
+                self.int8_cpu = use_int8_cpu()
+
+            if self.int8_cpu:
+                self.load_device = torch.device('cpu')
+                self.offload_device = torch.device('cpu')
+                model = quantize_int8(model, 'BLIP')
+
             model.to(self.offload_device)
 
-            if model_management.should_use_fp16(device=self.load_device):
+            if not self.int8_cpu and model_management.should_use_fp16(device=self.load_device):
                 model.half()
                 self.dtype = torch.float16
 
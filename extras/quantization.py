@@ -0,0 +1,43 @@
+import torch
+
+import args_manager
+
+
+def use_int8_cpu():
+    return args_manager.args.int8_cpu_aux_models
+
+
+def replace_conv1d_with_linear(model):
+    # GPT-2 uses the transformers Conv1D, a linear layer with a transposed weight that quantize_dynamic does not know
+    from transformers.pytorch_utils import Conv1D
+
+    for name, module in list(model.named_children()):
+        if isinstance(module, Conv1D):
+            linear = torch.nn.Linear(module.weight.shape[0], module.weight.shape[1], bias=module.bias is not None)
+            linear.weight.data = module.weight.data.t().contiguous()
+            if module.bias is not None:
+                linear.bias.data = module.bias.data
+            setattr(model, name, linear)
+        else:
+            replace_conv1d_with_linear(module)
+    return model
+
+
+def quantize_int8(model, name):
+    """
+    Returns the model with the weights of its linear layers quantized to int8 and their activations quantized
+    dynamically, for running on the CPU. The model is returned unchanged in float32 if the CPU has no quantized engine.
+    """
+    model = model.float().to('cpu')
+    if torch.backends.quantized.engine == 'none':
+        print(f'[Quantization] No quantized engine on this CPU, {name} runs in float32.')
+        return model
+    try:
+        model = torch.ao.quantization.quantize_dynamic(replace_conv1d_with_linear(model), {torch.nn.Linear},
+                                                      dtype=torch.qint8, inplace=True)
+    except Exception as e:
+        print(f'[Quantization] Cannot quantize {name}, it runs in float32: {e}')
+        return model
+    model.eval()
+    print(f'[Quantization] {name} runs on the CPU with int8 weights.')
+    return model
@@ -155,4 +155,8 @@ config.default_base_model_name, config.checkpoint_downloads = download_models(
 config.update_files()
 init_cache(config.model_filenames, config.paths_checkpoints, config.lora_filenames, config.paths_loras)
 
-from webui import *
+if args.api_only:
+    import modules.api_server
+    modules.api_server.start(block=True)
+else:
+    from webui import *
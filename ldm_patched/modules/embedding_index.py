@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+
+EMBEDDING_EXTENSIONS = ['.safetensors', '.pt', '.bin']
+
+
+class EmbeddingIndex:
+    """
+    Maps textual inversion embedding names to files in a list of embedding directories and caches loaded embeddings.
+
+    An embedding is named by its path relative to any of the directories or to one of their subdirectories, with or
+    without one of EMBEDDING_EXTENSIONS, the same names load_embed used to probe the file system for. The index is
+    built by the first lookup and rebuilt by refresh() when the modification time of a directory or an indexed file
+    changed, so lookups never touch the disk. At most max_entries loaded embeddings are kept, keyed by the file and
+    its modification time.
+    """
+
+    def __init__(self, directories, max_entries=64):
+        self.directories = [os.path.abspath(x) for x in directories]
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.names = None
+        self.mtimes = {}
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def scan(self):
+        names = {}
+        extension_names = {}
+        mtimes = {}
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory, followlinks=True):
+                try:
+                    mtimes[root] = os.stat(root).st_mtime_ns
+                except OSError:
+                    continue
+                # the file is named relative to the directory and to each subdirectory on the way to it
+                bases = [root]
+                while bases[-1] != directory:
+                    bases.append(os.path.dirname(bases[-1]))
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        continue
+                    extension = os.path.splitext(filename)[1]
+                    for base in bases:
+                        name = os.path.relpath(path, base)
+                        names.setdefault(name, path)
+                        if extension in EMBEDDING_EXTENSIONS:
+                            priority = EMBEDDING_EXTENSIONS.index(extension)
+                            name = name[:-len(extension)]
+                            if name not in extension_names or priority < extension_names[name][0]:
+                                extension_names[name] = (priority, path)
+
+        # an existing file of the exact name wins over adding an extension, as when probing the file system
+        for name, (_, path) in extension_names.items():
+            names.setdefault(name, path)
+        return names, mtimes
+
+    def is_stale(self):
+        for path, mtime in self.mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and self.names is not None and not self.is_stale():
+                return False
+            self.names, self.mtimes = self.scan()
+            return True
+
+    def find(self, embedding_name):
+        name = os.path.normpath(embedding_name)
+        if os.path.isabs(name) or name == os.pardir or name.startswith(os.pardir + os.sep):
+            return None
+        if self.names is None:
+            self.refresh()
+        return self.names.get(name)
+
+    def load(self, embedding_name, loader, key=None):
+        """Returns loader(path) for the file of the embedding, cached per key, or None if there is no such file."""
+        path = self.find(embedding_name)
+        if path is None:
+            return None
+        entry_key = (path, self.mtimes.get(path), key)
+        with self.lock:
+            if entry_key in self.entries:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return self.entries[entry_key]
+            self.misses += 1
+
+        # failures are cached as None too, the file is tried again once it changes
+        value = loader(path)
+        with self.lock:
+            self.entries[entry_key] = value
+            while len(self.entries) > max(0, self.max_entries):
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                names=len(self.names) if self.names is not None else 0,
+                entries=len(self.entries),
+                hits=self.hits,
+                misses=self.misses
+            )
+
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_embedding_index(directories):
+    if isinstance(directories, str):
+        directories = [directories]
+    key = tuple(os.path.abspath(x) for x in directories)
+    with indexes_lock:
+        if key not in indexes:
+            indexes[key] = EmbeddingIndex(key)
+        return indexes[key]
+
+
+def refresh_embedding_indexes():
+    with indexes_lock:
+        all_indexes = list(indexes.values())
+    for index in all_indexes:
+        if index.refresh():
+            print(f'[Embeddings] Indexed {len(index.names)} embedding names in {", ".join(index.directories)}.')
@@ -2,8 +2,10 @@ import psutil
 from enum import Enum
 from ldm_patched.modules.args_parser import args
 import ldm_patched.modules.utils
+from ldm_patched.modules.weight_streaming import WeightStreamer
 import torch
 import sys
+import time
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -270,7 +272,10 @@ def module_size(module):
     sd = module.state_dict()
     for k in sd:
         t = sd[k]
-        module_mem += t.nelement() * t.element_size()
+        # quantized modules also store packed (weight, bias) tuples and dtypes
+        for x in (t if isinstance(t, tuple) else (t,)):
+            if isinstance(x, torch.Tensor):
+                module_mem += x.nelement() * x.element_size()
     return module_mem
 
 class LoadedModel:
@@ -278,6 +283,10 @@ class LoadedModel:
         self.model = model
         self.model_accelerated = False
         self.device = model.load_device
+        # seconds the last load took and the value of load_clock when the model was last requested
+        self.load_time = None
+        self.last_used = 0
+        self.weight_streamer = None
 
     def model_memory(self):
         return self.model.model_size()
@@ -306,6 +315,7 @@ class LoadedModel:
         if lowvram_model_memory > 0:
             print("loading in lowvram mode", lowvram_model_memory/(1024 * 1024))
             mem_counter = 0
+            streamed_modules = []
             for m in self.real_model.modules():
                 if hasattr(m, "ldm_patched_cast_weights"):
                     m.prev_ldm_patched_cast_weights = m.ldm_patched_cast_weights
@@ -314,6 +324,8 @@ class LoadedModel:
                     if mem_counter + module_mem < lowvram_model_memory:
                         m.to(self.device)
                         mem_counter += module_mem
+                    elif getattr(m, "weight", None) is not None:
+                        streamed_modules.append(m)
                 elif hasattr(m, "weight"): #only modules with ldm_patched_cast_weights can be set to lowvram mode
                     m.to(self.device)
                     mem_counter += module_size(m)
@@ -321,12 +333,21 @@ class LoadedModel:
 
             self.model_accelerated = True
 
+            if lowvram_stream_budget() > 0 and len(streamed_modules) > 0:
+                self.weight_streamer = WeightStreamer(streamed_modules, self.device, lowvram_stream_budget())
+                print(f"lowvram: streaming {len(streamed_modules)} modules with a budget of "
+                      f"{lowvram_stream_budget() / (1024 * 1024):.0f} MB")
+
         if is_intel_xpu() and not args.disable_ipex_hijack:
             self.real_model = torch.xpu.optimize(self.real_model.eval(), inplace=True, auto_kernel_selection=True, graph_mode=True)
 
         return self.real_model
 
-    def model_unload(self):
+    def model_unload(self, keep_for=None):
+        if self.weight_streamer is not None:
+            self.weight_streamer.detach()
+            self.weight_streamer = None
+
         if self.model_accelerated:
             for m in self.real_model.modules():
                 if hasattr(m, "prev_ldm_patched_cast_weights"):
@@ -335,16 +356,23 @@ class LoadedModel:
 
             self.model_accelerated = False
 
-        self.model.unpatch_model(self.model.offload_device)
+        self.model.unpatch_model(self.model.offload_device, keep_for=keep_for)
         self.model.model_patches_to(self.model.offload_device)
 
     def __eq__(self, other):
         return self.model is other.model
 
+def lowvram_stream_budget():
+    # weights of modules left on the host are streamed to CUDA devices only
+    if cpu_state != CPUState.GPU or directml_enabled or is_intel_xpu():
+        return 0
+    return args.lowvram_stream_budget * 1024 * 1024
+
 def minimum_inference_memory():
     return (1024 * 1024 * 1024)
 
-def unload_model_clones(model):
+def unload_model_clones(model, keep_patches=False):
+    # with keep_patches, model is loaded next and takes over the weights its clones merged with the same patches
     to_unload = []
     for i in range(len(current_loaded_models)):
         if model.is_clone(current_loaded_models[i].model):
@@ -352,21 +380,38 @@ def unload_model_clones(model):
 
     for i in to_unload:
         print("unload clone", i)
-        current_loaded_models.pop(i).model_unload()
+        current_loaded_models.pop(i).model_unload(keep_for=model if keep_patches else None)
+
+class LRUEvictionPolicy:
+    """Unloads the least recently used models first. Eviction policies get the candidates in that order."""
+    name = 'lru'
+
+    def order(self, candidates, clock):
+        return candidates
+
+eviction_policy = LRUEvictionPolicy()
+load_clock = 0
+model_stats = dict(loads=0, reuses=0, unloads=0, load_time=0.0, unloaded_bytes=0)
+
+def get_model_name(loaded_model):
+    return loaded_model.model.model.__class__.__name__ if hasattr(loaded_model.model, "model") else loaded_model.model.__class__.__name__
 
 def free_memory(memory_required, device, keep_loaded=[]):
     unloaded_model = False
-    for i in range(len(current_loaded_models) -1, -1, -1):
+    candidates = [m for m in reversed(current_loaded_models) if m.device == device and m not in keep_loaded]
+    for m in eviction_policy.order(candidates, load_clock):
         if not ALWAYS_VRAM_OFFLOAD:
             if get_free_memory(device) > memory_required:
                 break
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded:
-                m = current_loaded_models.pop(i)
-                m.model_unload()
-                del m
-                unloaded_model = True
+        size = m.model_memory()
+        print(f"[Memory] Unloading {get_model_name(m)} ({size / (1024 * 1024):.0f} MB) from {device}, "
+              f"{eviction_policy.name} policy")
+        current_loaded_models.remove(m)
+        m.model_unload()
+        model_stats["unloads"] += 1
+        model_stats["unloaded_bytes"] += size
+        del m
+        unloaded_model = True
 
     if unloaded_model:
         soft_empty_cache()
@@ -378,6 +423,9 @@ def free_memory(memory_required, device, keep_loaded=[]):
 
 def load_models_gpu(models, memory_required=0):
     global vram_state
+    global load_clock
+
+    load_clock += 1
 
     inference_memory = minimum_inference_memory()
     extra_mem = max(inference_memory, memory_required)
@@ -390,7 +438,9 @@ def load_models_gpu(models, memory_required=0):
         if loaded_model in current_loaded_models:
             index = current_loaded_models.index(loaded_model)
             current_loaded_models.insert(0, current_loaded_models.pop(index))
+            current_loaded_models[0].last_used = load_clock
             models_already_loaded.append(loaded_model)
+            model_stats["reuses"] += 1
         else:
             if hasattr(x, "model"):
                 print(f"Requested to load {x.model.__class__.__name__}")
@@ -407,7 +457,7 @@ def load_models_gpu(models, memory_required=0):
 
     total_memory_required = {}
     for loaded_model in models_to_load:
-        unload_model_clones(loaded_model.model)
+        unload_model_clones(loaded_model.model, keep_patches=True)
         total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
 
     for device in total_memory_required:
@@ -425,7 +475,7 @@ def load_models_gpu(models, memory_required=0):
         if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM):
             model_size = loaded_model.model_memory_required(torch_dev)
             current_free_mem = get_free_memory(torch_dev)
-            lowvram_model_memory = int(max(64 * (1024 * 1024), (current_free_mem - 1024 * (1024 * 1024)) / 1.3 ))
+            lowvram_model_memory = int(max(64 * (1024 * 1024), (current_free_mem - 1024 * (1024 * 1024) - lowvram_stream_budget()) / 1.3 ))
             if model_size > (current_free_mem - inference_memory): #only switch to lowvram if really necessary
                 vram_set_state = VRAMState.LOW_VRAM
             else:
@@ -434,7 +484,15 @@ def load_models_gpu(models, memory_required=0):
         if vram_set_state == VRAMState.NO_VRAM:
             lowvram_model_memory = 64 * 1024 * 1024
 
+        start_time = time.perf_counter()
         cur_loaded_model = loaded_model.model_load(lowvram_model_memory)
+        loaded_model.load_time = time.perf_counter() - start_time
+        loaded_model.last_used = load_clock
+        model_stats["loads"] += 1
+        model_stats["load_time"] += loaded_model.load_time
+        print(f"[Memory] Loaded {get_model_name(loaded_model)} ({loaded_model.model_memory() / (1024 * 1024):.0f} MB) "
+              f"to {torch_dev} in {loaded_model.load_time:.2f} seconds"
+              f"{' in lowvram mode' if lowvram_model_memory > 0 else ''}")
         current_loaded_models.insert(0, loaded_model)
     return
 
@@ -5,6 +5,10 @@ import inspect
 import ldm_patched.modules.utils
 import ldm_patched.modules.model_management
 
+def patches_equal(a, b):
+    # LoRA tensors are compared by identity, the cached entry keeps them alive so their ids are not reused
+    return len(a) == len(b) and all(p[0] == q[0] and p[1] is q[1] and p[2] == q[2] for p, q in zip(a, b))
+
 class ModelPatcher:
     def __init__(self, model, load_device, offload_device, size=0, current_device=None, weight_inplace_update=False):
         self.size = size
@@ -23,6 +27,13 @@ class ModelPatcher:
             self.current_device = current_device
 
         self.weight_inplace_update = weight_inplace_update
+        # modules whose patches are applied in forward instead of being merged, see patch_weight_at_runtime
+        self.runtime_patched_modules = []
+        # optional dict of key -> (patches, patched weight), filled by patch_model and reused on the next load
+        # for every key whose patches did not change
+        self.weight_cache = None
+        # key -> patches merged into the weight of the model, see unpatch_model
+        self.applied_patches = {}
 
     def model_size(self):
         if self.size > 0:
@@ -41,6 +52,7 @@ class ModelPatcher:
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
         n.model_keys = self.model_keys
+        n.weight_cache = self.weight_cache
         return n
 
     def is_clone(self, other):
@@ -141,6 +153,8 @@ class ModelPatcher:
             return self.model.get_dtype()
 
     def add_patches(self, patches, strength_patch=1.0, strength_model=1.0):
+        # cached weights were computed without these patches
+        self.weight_cache = None
         p = set()
         for k in patches:
             if k in self.model_keys:
@@ -183,28 +197,37 @@ class ModelPatcher:
 
         if patch_weights:
             model_sd = self.model_state_dict()
+            pending = []
             for key in self.patches:
                 if key not in model_sd:
                     print("could not patch. key doesn't exist in model:", key)
                     continue
 
-                weight = model_sd[key]
+                if key in self.applied_patches:
+                    # merged by a clone with the same patches and handed over by unpatch_model
+                    continue
+
+                if self.patch_weight_at_runtime(key, device_to):
+                    continue
 
-                inplace_update = self.weight_inplace_update
+                weight = model_sd[key]
 
                 if key not in self.backup:
-                    self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
+                    self.backup[key] = weight.to(device=self.offload_device, copy=self.weight_inplace_update)
 
-                if device_to is not None:
-                    temp_weight = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-                else:
-                    temp_weight = weight.to(torch.float32, copy=True)
-                out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
-                if inplace_update:
-                    ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
+                cached = self.weight_cache.get(key) if self.weight_cache is not None else None
+                if cached is not None and patches_equal(cached[0], self.patches[key]):
+                    self.set_patched_weight(key, cached[1].to(device=device_to if device_to is not None else weight.device,
+                                                              copy=True))
+                    self.applied_patches[key] = self.patches[key]
                 else:
-                    ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
-                del temp_weight
+                    pending.append(key)
+
+            for key, out_weight in self.calculate_weights(pending, model_sd, device_to):
+                if self.weight_cache is not None:
+                    self.weight_cache[key] = (self.patches[key], out_weight.to(device=self.offload_device, copy=True))
+                self.set_patched_weight(key, out_weight)
+                self.applied_patches[key] = self.patches[key]
 
             if device_to is not None:
                 self.model.to(device_to)
@@ -212,6 +235,28 @@ class ModelPatcher:
 
         return self.model
 
+    def patch_weight_at_runtime(self, key, device_to=None):
+        # may attach the patches of key to its module so that they are applied in forward, returns True if it did
+        return False
+
+    def set_patched_weight(self, key, out_weight):
+        if self.weight_inplace_update:
+            ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
+        else:
+            ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
+
+    def calculate_key_weight(self, key, weight, device_to=None):
+        if device_to is not None:
+            temp_weight = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+        else:
+            temp_weight = weight.to(torch.float32, copy=True)
+        return self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+
+    def calculate_weights(self, keys, model_sd, device_to=None):
+        # yields (key, patched weight), one key at a time so that only one extra weight is alive
+        for key in keys:
+            yield key, self.calculate_key_weight(key, model_sd[key], device_to)
+
     def calculate_weight(self, patches, weight, key):
         for p in patches:
             alpha = p[0]
@@ -334,9 +379,19 @@ class ModelPatcher:
 
         return weight
 
-    def unpatch_model(self, device_to=None):
+    def unpatch_model(self, device_to=None, keep_for=None):
         keys = list(self.backup.keys())
 
+        if keep_for is not None:
+            # weights merged with the same patches as in the clone keep_for, which is loaded next, stay merged and
+            # are handed over with their backups, so that patch_model of keep_for only merges the changed keys
+            kept = set(k for k in keys if k in keep_for.patches and k not in keep_for.backup
+                       and patches_equal(self.applied_patches.get(k, []), keep_for.patches[k]))
+            for k in kept:
+                keep_for.backup[k] = self.backup[k]
+                keep_for.applied_patches[k] = self.applied_patches[k]
+            keys = [k for k in keys if k not in kept]
+
         if self.weight_inplace_update:
             for k in keys:
                 ldm_patched.modules.utils.copy_to_param(self.model, k, self.backup[k])
@@ -345,6 +400,11 @@ class ModelPatcher:
                 ldm_patched.modules.utils.set_attr(self.model, k, self.backup[k])
 
         self.backup = {}
+        self.applied_patches = {}
+
+        for module in self.runtime_patched_modules:
+            module.lora_branch = None
+        self.runtime_patched_modules = []
 
         if device_to is not None:
             self.model.to(device_to)
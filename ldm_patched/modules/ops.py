@@ -2,6 +2,9 @@ import torch
 import ldm_patched.modules.model_management
 
 def cast_bias_weight(s, input):
+    weight_streamer = getattr(s, "weight_streamer", None)
+    if weight_streamer is not None:
+        return weight_streamer.get(s, input)
     bias = None
     non_blocking = ldm_patched.modules.model_management.device_supports_non_blocking(input.device)
     if s.bias is not None:
@@ -10,9 +13,22 @@ def cast_bias_weight(s, input):
     return weight, bias
 
 
+def apply_lora_branch(s, input, output):
+    # low rank side branch of runtime LoRAs, up already holds the LoRA strengths
+    up, down = s.lora_branch
+    up = up.to(device=input.device, dtype=input.dtype)
+    down = down.to(device=input.device, dtype=input.dtype)
+    if down.ndim == 2:
+        hidden = torch.nn.functional.linear(input, down)
+        return output + torch.nn.functional.linear(hidden, up)
+    hidden = torch.nn.functional.conv2d(input, down, None, s.stride, s.padding, s.dilation)
+    return output + torch.nn.functional.conv2d(hidden, up)
+
+
 class disable_weight_init:
     class Linear(torch.nn.Linear):
         ldm_patched_cast_weights = False
+        lora_branch = None
         def reset_parameters(self):
             return None
 
@@ -22,12 +38,16 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.ldm_patched_cast_weights:
-                return self.forward_ldm_patched_cast_weights(*args, **kwargs)
+                output = self.forward_ldm_patched_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                output = super().forward(*args, **kwargs)
+            if self.lora_branch is not None:
+                output = apply_lora_branch(self, args[0] if len(args) > 0 else kwargs['input'], output)
+            return output
 
     class Conv2d(torch.nn.Conv2d):
         ldm_patched_cast_weights = False
+        lora_branch = None
         def reset_parameters(self):
             return None
 
@@ -37,9 +57,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.ldm_patched_cast_weights:
-                return self.forward_ldm_patched_cast_weights(*args, **kwargs)
+                output = self.forward_ldm_patched_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                output = super().forward(*args, **kwargs)
+            if self.lora_branch is not None:
+                output = apply_lora_branch(self, args[0] if len(args) > 0 else kwargs['input'], output)
+            return output
 
     class Conv3d(torch.nn.Conv3d):
         ldm_patched_cast_weights = False
@@ -130,6 +130,18 @@ class CLIP:
             return cond, pooled
         return cond
 
+    def encode_from_tokens_batch(self, tokens_list, return_pooled=False):
+        if self.layer_idx is not None:
+            self.cond_stage_model.clip_layer(self.layer_idx)
+        else:
+            self.cond_stage_model.reset_clip_layer()
+
+        self.load_model()
+        results = self.cond_stage_model.encode_token_weights_batch(tokens_list)
+        if return_pooled:
+            return results
+        return [cond for cond, pooled in results]
+
     def encode(self, text):
         tokens = self.tokenize(text)
         return self.encode_from_tokens(tokens)
@@ -427,8 +439,8 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
 
     return (ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
-def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, vae_filename_param=None):
-    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path)
+def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, vae_filename_param=None, use_mmap=False):
+    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path, use_mmap=use_mmap)
     sd_keys = sd.keys()
     clip = None
     clipvision = None
@@ -467,7 +479,7 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
             vae_sd = ldm_patched.modules.utils.state_dict_prefix_replace(sd, {"first_stage_model.": ""}, filter_keys=True)
             vae_sd = model_config.process_vae_state_dict(vae_sd)
         else:
-            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename_param)
+            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename_param, use_mmap=use_mmap)
             vae_filename = vae_filename_param
         vae = VAE(sd=vae_sd)
 
@@ -493,6 +505,41 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     return model_patcher, clip, vae, vae_filename, clipvision
 
 
+def load_checkpoint_from_parts(model_config, model_type, unet_sd, clip_sd=None, vae_sd=None, embedding_directory=None):
+    # builds the models from state dicts that were already split and converted by an earlier load of the checkpoint
+    parameters = ldm_patched.modules.utils.calculate_parameters(unet_sd)
+    unet_dtype = model_config.unet_config["dtype"]
+    load_device = model_management.get_torch_device()
+    model_config.set_manual_cast(model_management.unet_manual_cast(unet_dtype, load_device))
+
+    class WeightsLoader(torch.nn.Module):
+        pass
+
+    inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
+    # the model type was detected on the full checkpoint, the keys it depends on are not part of the UNet state dict
+    model = model_config.get_model(unet_sd, "", device=inital_load_device, model_type=model_type)
+    model.load_model_weights(unet_sd, "")
+
+    vae = None
+    if vae_sd is not None:
+        vae = VAE(sd=vae_sd)
+
+    clip = None
+    clip_target = model_config.clip_target()
+    if clip_sd is not None and clip_target is not None:
+        w = WeightsLoader()
+        clip = CLIP(clip_target, embedding_directory=embedding_directory)
+        w.cond_stage_model = clip.cond_stage_model
+        load_model_weights(w, clip_sd)
+
+    model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
+    if inital_load_device != torch.device("cpu"):
+        print("loaded straight to GPU")
+        model_management.load_model_gpu(model_patcher)
+
+    return model_patcher, clip, vae
+
+
 def load_unet_state_dict(sd): #load unet in diffusers format
     parameters = ldm_patched.modules.utils.calculate_parameters(sd)
     unet_dtype = model_management.unet_dtype(model_params=parameters)
@@ -7,6 +7,7 @@ import traceback
 import zipfile
 from . import model_management
 import ldm_patched.modules.clip_model
+from ldm_patched.modules.embedding_index import get_embedding_index
 import json
 
 def gen_empty_tokens(special_tokens, length):
@@ -58,6 +59,9 @@ class ClipTokenWeightEncoder:
             return out[-1:].to(model_management.intermediate_device()), first_pooled
         return torch.cat(output, dim=-2).to(model_management.intermediate_device()), first_pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        return [self.encode_token_weights(token_weight_pairs) for token_weight_pairs in token_weight_pairs_list]
+
 class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
     """Uses the CLIP transformer encoder for text (from huggingface)"""
     LAYERS = [
@@ -285,34 +289,11 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
     if isinstance(embedding_directory, str):
         embedding_directory = [embedding_directory]
 
-    embedding_directory = expand_directory_list(embedding_directory)
-
-    valid_file = None
-    for embed_dir in embedding_directory:
-        embed_path = os.path.abspath(os.path.join(embed_dir, embedding_name))
-        embed_dir = os.path.abspath(embed_dir)
-        try:
-            if os.path.commonpath((embed_dir, embed_path)) != embed_dir:
-                continue
-        except:
-            continue
-        if not os.path.isfile(embed_path):
-            extensions = ['.safetensors', '.pt', '.bin']
-            for x in extensions:
-                t = embed_path + x
-                if os.path.isfile(t):
-                    valid_file = t
-                    break
-        else:
-            valid_file = embed_path
-        if valid_file is not None:
-            break
-
-    if valid_file is None:
-        return None
-
-    embed_path = valid_file
+    index = get_embedding_index(embedding_directory)
+    return index.load(embedding_name, lambda embed_path: load_embed_file(embed_path, embedding_name, embedding_size, embed_key),
+                      key=(embedding_size, embed_key))
 
+def load_embed_file(embed_path, embedding_name, embedding_size, embed_key=None):
     embed_out = None
 
     try:
@@ -514,5 +495,8 @@ class SD1ClipModel(torch.nn.Module):
         out, pooled = getattr(self, self.clip).encode_token_weights(token_weight_pairs)
         return out, pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        return getattr(self, self.clip).encode_token_weights_batch([x[self.clip_name] for x in token_weight_pairs_list])
+
     def load_sd(self, sd):
         return getattr(self, self.clip).load_sd(sd)
@@ -55,6 +55,11 @@ class SDXLClipModel(torch.nn.Module):
         l_out, l_pooled = self.clip_l.encode_token_weights(token_weight_pairs_l)
         return torch.cat([l_out, g_out], dim=-1), g_pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        g_results = self.clip_g.encode_token_weights_batch([x["g"] for x in token_weight_pairs_list])
+        l_results = self.clip_l.encode_token_weights_batch([x["l"] for x in token_weight_pairs_list])
+        return [(torch.cat([l_out, g_out], dim=-1), g_pooled) for (g_out, g_pooled), (l_out, _) in zip(g_results, l_results)]
+
     def load_sd(self, sd):
         if "text_model.encoder.layers.30.mlp.fc1.weight" in sd:
             return self.clip_g.load_sd(sd)
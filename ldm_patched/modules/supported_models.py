@@ -125,7 +125,7 @@ class SDXLRefiner(supported_models_base.BASE):
 
     latent_format = latent_formats.SDXL
 
-    def get_model(self, state_dict, prefix="", device=None):
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
         return model_base.SDXLRefiner(self, device=device)
 
     def process_clip_state_dict(self, state_dict):
@@ -169,8 +169,10 @@ class SDXL(supported_models_base.BASE):
         else:
             return model_base.ModelType.EPS
 
-    def get_model(self, state_dict, prefix="", device=None):
-        out = model_base.SDXL(self, model_type=self.model_type(state_dict, prefix), device=device)
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
+        if model_type is None:
+            model_type = self.model_type(state_dict, prefix)
+        out = model_base.SDXL(self, model_type=model_type, device=device)
         if self.inpaint_model():
             out.set_inpaint()
         return out
@@ -245,7 +247,7 @@ class SVD_img2vid(supported_models_base.BASE):
 
     sampling_settings = {"sigma_max": 700.0, "sigma_min": 0.002}
 
-    def get_model(self, state_dict, prefix="", device=None):
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
         out = model_base.SVD_img2vid(self, device=device)
         return out
 
@@ -271,7 +273,7 @@ class Stable_Zero123(supported_models_base.BASE):
 
     latent_format = latent_formats.SD15
 
-    def get_model(self, state_dict, prefix="", device=None):
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
         out = model_base.Stable_Zero123(self, device=device, cc_projection_weight=state_dict["cc_projection.weight"], cc_projection_bias=state_dict["cc_projection.bias"])
         return out
 
@@ -302,7 +304,7 @@ class SD_X4Upscaler(SD20):
         "linear_end": 0.02,
     }
 
-    def get_model(self, state_dict, prefix="", device=None):
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
         out = model_base.SD_X4Upscaler(self, device=device)
         return out
 
@@ -43,11 +43,13 @@ class BASE:
         for x in self.unet_extra_config:
             self.unet_config[x] = self.unet_extra_config[x]
 
-    def get_model(self, state_dict, prefix="", device=None):
+    def get_model(self, state_dict, prefix="", device=None, model_type=None):
+        if model_type is None:
+            model_type = self.model_type(state_dict, prefix)
         if self.noise_aug_config is not None:
-            out = model_base.SD21UNCLIP(self, self.noise_aug_config, model_type=self.model_type(state_dict, prefix), device=device)
+            out = model_base.SD21UNCLIP(self, self.noise_aug_config, model_type=model_type, device=device)
         else:
-            out = model_base.BaseModel(self, model_type=self.model_type(state_dict, prefix), device=device)
+            out = model_base.BaseModel(self, model_type=model_type, device=device)
         if self.inpaint_model():
             out.set_inpaint()
         return out
@@ -1,15 +1,60 @@
 import torch
+import json
 import math
+import mmap
 import struct
 import ldm_patched.modules.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+def load_safetensors_mmap(ckpt):
+    # tensors are views of a copy-on-write mapping of the file, their pages are only read when they are copied into
+    # the model, so the state dict itself takes no anonymous memory
+    with open(ckpt, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    sd = {}
+    for k, info in header.items():
+        if k == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        element_size = torch.empty((), dtype=dtype).element_size()
+        count = (end - begin) // element_size
+        if count == 0:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+        elif offset % element_size != 0:
+            sd[k] = torch.frombuffer(bytearray(buffer[offset:data_start + end]), dtype=dtype).reshape(info["shape"])
+        else:
+            sd[k] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(info["shape"])
+    return sd
+
+def load_torch_file(ckpt, safe_load=False, device=None, use_mmap=False):
     if device is None:
         device = torch.device("cpu")
-    if ckpt.lower().endswith(".safetensors"):
+    if ckpt.lower().endswith(".safetensors") and use_mmap and device.type == "cpu":
+        sd = load_safetensors_mmap(ckpt)
+    elif ckpt.lower().endswith(".safetensors"):
         sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_size(t):
+    return t.nelement() * t.element_size() if t is not None else 0
+
+
+class WeightStreamer:
+    """
+    Streams the weights of modules left on the host in lowvram mode to the device.
+
+    The weights are pinned until detach() restores the pageable ones, and while one module computes, the weights of the
+    modules expected next are copied on a separate CUDA stream until budget bytes are in flight. The execution order is
+    learned from the forward calls, starting with the order of the modules in the model. A module whose weights were
+    not prefetched is copied when it runs, as without streaming.
+    """
+
+    def __init__(self, modules, device, budget):
+        self.modules = list(modules)
+        self.device = device
+        self.budget = budget
+        self.stream = torch.cuda.Stream(device)
+        self.next_module = {a: b for a, b in zip(self.modules, self.modules[1:] + self.modules[:1])}
+        self.last_module = None
+        self.inflight = OrderedDict()
+        self.inflight_bytes = 0
+        self.prefetched = 0
+        self.missed = 0
+        self.pageable = {}
+
+        for module in self.modules:
+            for param in module.parameters(recurse=False):
+                if param.device.type == 'cpu' and not param.is_pinned():
+                    self.pageable[param] = param.data
+                    param.data = param.data.pin_memory()
+            module.weight_streamer = self
+
+    def detach(self):
+        for module in self.modules:
+            module.weight_streamer = None
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        self.inflight.clear()
+        self.inflight_bytes = 0
+        # page-locked host memory cannot be swapped, do not keep it once the model is no longer streamed
+        for param, data in self.pageable.items():
+            if param.device.type == 'cpu' and param.is_pinned():
+                param.data = data
+        self.pageable.clear()
+
+    def copy(self, module):
+        weight = module.weight.to(self.device, non_blocking=True)
+        bias = module.bias.to(self.device, non_blocking=True) if module.bias is not None else None
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return weight, bias, event, tensor_size(module.weight) + tensor_size(module.bias)
+
+    def prefetch(self, module):
+        count = 0
+        while count < len(self.modules):
+            module = self.next_module[module]
+            count += 1
+            if module in self.inflight:
+                continue
+            size = tensor_size(module.weight) + tensor_size(module.bias)
+            if self.inflight_bytes + size > self.budget:
+                break
+            with torch.cuda.stream(self.stream):
+                self.inflight[module] = self.copy(module)
+            self.inflight_bytes += size
+
+    def take(self, module):
+        # entries prefetched before this module were skipped by this forward pass
+        while len(self.inflight) > 0:
+            other, entry = self.inflight.popitem(last=False)
+            self.inflight_bytes -= entry[3]
+            if other is module:
+                return entry
+        return None
+
+    def get(self, module, input):
+        if self.last_module is not None:
+            self.next_module[self.last_module] = module
+        self.last_module = module
+
+        entry = self.take(module)
+        if entry is None:
+            self.missed += 1
+            with torch.cuda.stream(self.stream):
+                entry = self.copy(module)
+        else:
+            self.prefetched += 1
+
+        weight, bias, event, _ = entry
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(event)
+        # the copies were allocated on the copy stream, keep their memory until the compute stream is done with it
+        weight.record_stream(compute_stream)
+        if bias is not None:
+            bias.record_stream(compute_stream)
+
+        self.prefetch(module)
+        return weight.to(dtype=input.dtype), bias.to(dtype=input.dtype) if bias is not None else None
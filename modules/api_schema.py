@@ -0,0 +1,238 @@
+import base64
+import io
+import random
+from typing import List, Literal, Optional
+
+import numpy as np
+from PIL import Image
+from pydantic import BaseModel, Field
+
+import args_manager
+import modules.config
+import modules.constants as constants
+import modules.flags as flags
+from modules.async_worker import AsyncTask
+from modules.flags import Performance, MetadataScheme
+from modules.task_queue import TaskPriority
+from modules.util import get_enabled_loras
+
+
+def default_resolution():
+    width, height = modules.config.default_aspect_ratio.replace('×', ' ').split(' ')[:2]
+    return int(width), int(height)
+
+
+class LoraSetting(BaseModel):
+    enabled: bool = True
+    name: str = 'None'
+    weight: float = 1.0
+
+
+class ImagePrompt(BaseModel):
+    image: str = Field(description='Base64 encoded image.')
+    stop: float = 0.5
+    weight: float = 0.6
+    type: Literal[tuple(flags.ip_list)] = flags.default_ip
+
+
+class GenerationRequest(BaseModel):
+    prompt: str = modules.config.default_prompt
+    negative_prompt: str = modules.config.default_prompt_negative
+    style_selections: List[str] = Field(default_factory=lambda: list(modules.config.default_styles))
+    performance_selection: Performance = Performance(modules.config.default_performance)
+    width: int = Field(default_factory=lambda: default_resolution()[0])
+    height: int = Field(default_factory=lambda: default_resolution()[1])
+    image_number: int = Field(default=modules.config.default_image_number, ge=1,
+                              le=modules.config.default_max_image_number)
+    output_format: str = modules.config.default_output_format
+    seed: int = Field(default=-1, description='Use -1 for a random seed.')
+    read_wildcards_in_order: bool = False
+    sharpness: float = modules.config.default_sample_sharpness
+    guidance_scale: float = modules.config.default_cfg_scale
+    base_model_name: str = modules.config.default_base_model_name
+    refiner_model_name: str = modules.config.default_refiner_model_name
+    refiner_switch: float = modules.config.default_refiner_switch
+    loras: List[LoraSetting] = Field(default_factory=lambda: [
+        LoraSetting(enabled=enabled, name=name, weight=weight)
+        for enabled, name, weight in modules.config.default_loras])
+
+    uov_method: str = flags.disabled
+    uov_input_image: Optional[str] = Field(default=None, description='Base64 encoded image.')
+    outpaint_selections: List[str] = Field(default_factory=list)
+    inpaint_input_image: Optional[str] = Field(default=None, description='Base64 encoded image.')
+    inpaint_mask_image: Optional[str] = Field(default=None, description='Base64 encoded mask, white is inpainted.')
+    inpaint_additional_prompt: str = ''
+    image_prompts: List[ImagePrompt] = Field(default_factory=list)
+
+    sampler_name: str = modules.config.default_sampler
+    scheduler_name: str = modules.config.default_scheduler
+    vae_name: str = modules.config.default_vae
+    clip_skip: int = modules.config.default_clip_skip
+    adaptive_cfg: float = modules.config.default_cfg_tsnr
+    adm_scaler_positive: float = 1.5
+    adm_scaler_negative: float = 0.8
+    adm_scaler_end: float = 0.3
+    refiner_swap_method: str = flags.refiner_swap_method
+    controlnet_softness: float = 0.25
+    canny_low_threshold: int = 64
+    canny_high_threshold: int = 128
+    overwrite_step: int = modules.config.default_overwrite_step
+    overwrite_switch: float = modules.config.default_overwrite_switch
+    overwrite_width: int = -1
+    overwrite_height: int = -1
+    overwrite_vary_strength: float = -1
+    overwrite_upscale_strength: float = modules.config.default_overwrite_upscale
+    freeu_enabled: bool = False
+    freeu_b1: float = 1.01
+    freeu_b2: float = 1.02
+    freeu_s1: float = 0.99
+    freeu_s2: float = 0.95
+    inpaint_engine: str = modules.config.default_inpaint_engine_version
+    inpaint_strength: float = 1.0
+    inpaint_respective_field: float = 0.618
+    inpaint_erode_or_dilate: int = 0
+    inpaint_disable_initial_latent: bool = False
+    invert_mask: bool = modules.config.default_invert_mask_checkbox
+
+    black_out_nsfw: bool = modules.config.default_black_out_nsfw
+    disable_preview: bool = False
+    disable_intermediate_results: bool = False
+    disable_seed_increment: bool = False
+    generate_image_grid: bool = False
+    save_metadata_to_images: bool = modules.config.default_save_metadata_to_images
+    metadata_scheme: MetadataScheme = MetadataScheme(modules.config.default_metadata_scheme)
+
+    priority: TaskPriority = TaskPriority.NORMAL
+    client_id: Optional[str] = None
+    bypass_cache: bool = Field(default=False, description='Sample again even if identical images were generated '
+                                                          'before.')
+
+
+def decode_image(data, mode='RGB'):
+    if data is None:
+        return None
+    if ',' in data and data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    return np.array(Image.open(io.BytesIO(base64.b64decode(data))).convert(mode))
+
+
+def encode_image(image, output_format='jpeg'):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format=output_format)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def build_async_task(request: GenerationRequest) -> AsyncTask:
+    task = AsyncTask(args=[])
+    task.args = request.model_dump(mode='json')
+    task.priority = request.priority
+    task.client_id = request.client_id
+    task.bypass_result_cache = request.bypass_cache
+
+    task.generate_image_grid = request.generate_image_grid
+    task.prompt = request.prompt
+    task.negative_prompt = request.negative_prompt
+    task.style_selections = list(request.style_selections)
+
+    task.performance_selection = request.performance_selection
+    task.steps = task.performance_selection.steps()
+    task.original_steps = task.steps
+
+    task.aspect_ratios_selection = f'{request.width}×{request.height}'
+    task.image_number = request.image_number
+    task.output_format = request.output_format
+    seed = request.seed
+    if seed < constants.MIN_SEED or seed > constants.MAX_SEED:
+        seed = random.randint(constants.MIN_SEED, constants.MAX_SEED)
+    task.seed = seed
+    task.read_wildcards_in_order = request.read_wildcards_in_order
+    task.sharpness = request.sharpness
+    task.cfg_scale = request.guidance_scale
+    task.base_model_name = request.base_model_name
+    task.refiner_model_name = request.refiner_model_name
+    task.refiner_switch = request.refiner_switch
+    task.loras = get_enabled_loras([(lora.enabled, lora.name, lora.weight) for lora in request.loras])
+
+    task.uov_method = request.uov_method
+    task.uov_input_image = decode_image(request.uov_input_image)
+    task.outpaint_selections = list(request.outpaint_selections)
+    task.inpaint_input_image = None
+    if request.inpaint_input_image is not None:
+        task.inpaint_input_image = dict(image=decode_image(request.inpaint_input_image),
+                                        mask=decode_image(request.inpaint_mask_image))
+    task.inpaint_additional_prompt = request.inpaint_additional_prompt
+    task.inpaint_mask_image_upload = None
+
+    task.cn_tasks = {x: [] for x in flags.ip_list}
+    for image_prompt in request.image_prompts:
+        task.cn_tasks[image_prompt.type].append([decode_image(image_prompt.image), image_prompt.stop,
+                                                 image_prompt.weight])
+    has_image_prompts = len(request.image_prompts) > 0
+
+    if task.inpaint_input_image is not None:
+        task.current_tab = 'inpaint'
+    elif task.uov_input_image is not None:
+        task.current_tab = 'uov'
+    else:
+        task.current_tab = 'ip'
+    task.input_image_checkbox = task.inpaint_input_image is not None or task.uov_input_image is not None \
+        or has_image_prompts
+    task.mixing_image_prompt_and_vary_upscale = has_image_prompts
+    task.mixing_image_prompt_and_inpaint = has_image_prompts
+
+    task.disable_preview = request.disable_preview
+    task.disable_intermediate_results = request.disable_intermediate_results
+    task.disable_seed_increment = request.disable_seed_increment
+    task.black_out_nsfw = request.black_out_nsfw
+    task.adm_scaler_positive = request.adm_scaler_positive
+    task.adm_scaler_negative = request.adm_scaler_negative
+    task.adm_scaler_end = request.adm_scaler_end
+    task.adaptive_cfg = request.adaptive_cfg
+    task.clip_skip = request.clip_skip
+    task.sampler_name = request.sampler_name
+    task.scheduler_name = request.scheduler_name
+    task.vae_name = request.vae_name
+    task.overwrite_step = request.overwrite_step
+    task.overwrite_switch = request.overwrite_switch
+    task.overwrite_width = request.overwrite_width
+    task.overwrite_height = request.overwrite_height
+    task.overwrite_vary_strength = request.overwrite_vary_strength
+    task.overwrite_upscale_strength = request.overwrite_upscale_strength
+    task.debugging_cn_preprocessor = False
+    task.skipping_cn_preprocessor = False
+    task.canny_low_threshold = request.canny_low_threshold
+    task.canny_high_threshold = request.canny_high_threshold
+    task.refiner_swap_method = request.refiner_swap_method
+    task.controlnet_softness = request.controlnet_softness
+    task.freeu_enabled = request.freeu_enabled
+    task.freeu_b1 = request.freeu_b1
+    task.freeu_b2 = request.freeu_b2
+    task.freeu_s1 = request.freeu_s1
+    task.freeu_s2 = request.freeu_s2
+    task.debugging_inpaint_preprocessor = False
+    task.inpaint_disable_initial_latent = request.inpaint_disable_initial_latent
+    task.inpaint_engine = request.inpaint_engine
+    task.inpaint_strength = request.inpaint_strength
+    task.inpaint_respective_field = request.inpaint_respective_field
+    task.inpaint_advanced_masking_checkbox = request.inpaint_mask_image is not None
+    task.invert_mask_checkbox = request.invert_mask
+    task.inpaint_erode_or_dilate = request.inpaint_erode_or_dilate
+    task.save_final_enhanced_image_only = False
+    task.save_metadata_to_images = request.save_metadata_to_images if not args_manager.args.disable_metadata else False
+    task.metadata_scheme = request.metadata_scheme if not args_manager.args.disable_metadata \
+        else MetadataScheme.FOOOCUS
+
+    # enhance is not exposed by the API yet
+    task.debugging_dino = False
+    task.dino_erode_or_dilate = 0
+    task.debugging_enhance_masks_checkbox = False
+    task.enhance_input_image = None
+    task.enhance_checkbox = False
+    task.enhance_uov_method = flags.disabled
+    task.enhance_uov_processing_order = flags.enhancement_uov_before
+    task.enhance_uov_prompt_type = flags.enhancement_uov_prompt_type_original
+    task.enhance_ctrls = []
+    task.should_enhance = False
+    task.images_to_enhance_count = 0
+    task.enhance_stats = {}
+    return task
@@ -0,0 +1,297 @@
+import asyncio
+import base64
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from pydantic import ValidationError
+
+import args_manager
+import ldm_patched.modules.model_management as model_management
+import modules.async_worker as worker
+from modules.api_schema import GenerationRequest, build_async_task, encode_image
+from modules.auth import auth_enabled, check_auth
+
+max_task_history = 256
+
+
+class ApiTask:
+    def __init__(self, task):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.created = time.time()
+        self.events = []
+        self.finished = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def publish(self, flag, product):
+        with self.condition:
+            if flag == 'preview' and len(self.events) > 0 and self.events[-1][0] == 'preview':
+                # only the latest preview is of interest to clients that are behind
+                self.events[-1] = (flag, product)
+            else:
+                self.events.append((flag, product))
+            if flag == 'finish':
+                self.finished = True
+            self.condition.notify_all()
+
+    def wait_for_events(self, cursor, timeout=1.0):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.events) > cursor or self.finished, timeout=timeout)
+            return list(self.events[cursor:]), self.finished
+
+    @property
+    def status(self):
+        if self.cancelled:
+            return 'cancelled'
+        if self.finished:
+            return 'finished'
+        if self.task.processing:
+            return 'running'
+        return 'queued'
+
+
+tasks_lock = threading.Lock()
+api_tasks = OrderedDict()
+
+
+def pump_events(api_task):
+    while not api_task.finished:
+        flag, product = api_task.task.yields.get()
+        api_task.publish(flag, product)
+
+
+def submit(request: GenerationRequest):
+    task = build_async_task(request)
+    api_task = ApiTask(task)
+    with tasks_lock:
+        api_tasks[api_task.id] = api_task
+        while len(api_tasks) > max_task_history:
+            oldest_id, oldest = next(iter(api_tasks.items()))
+            if not oldest.finished:
+                break
+            del api_tasks[oldest_id]
+
+    threading.Thread(target=pump_events, args=(api_task,), daemon=True).start()
+    worker.enqueue_task(task)
+    print(f'[API] Task {api_task.id} queued.')
+    return api_task
+
+
+def get_api_task(task_id):
+    with tasks_lock:
+        api_task = api_tasks.get(task_id)
+    if api_task is None:
+        raise HTTPException(status_code=404, detail=f'Task {task_id} not found.')
+    return api_task
+
+
+def serialize_images(images, include_images=True):
+    serialized = []
+    for image in images:
+        if isinstance(image, str):
+            item = dict(path=image)
+            if include_images and os.path.exists(image):
+                with open(image, 'rb') as f:
+                    item['image'] = base64.b64encode(f.read()).decode('ascii')
+        elif isinstance(image, np.ndarray):
+            item = dict(path=None)
+            if include_images:
+                item['image'] = encode_image(image, 'png')
+        else:
+            continue
+        serialized.append(item)
+    return serialized
+
+
+def serialize_event(flag, product, include_images=True):
+    if flag == 'preview':
+        percentage, title, image = product
+        return dict(type='preview', percentage=percentage, title=title,
+                    image=encode_image(image) if include_images and isinstance(image, np.ndarray) else None)
+    return dict(type=flag, images=serialize_images(product, include_images))
+
+
+def serialize_task(api_task, include_images=False):
+    task = api_task.task
+    progress, title = 0, None
+    for flag, product in reversed(api_task.events):
+        if flag == 'preview':
+            progress, title = product[0], product[1]
+            break
+    if api_task.finished:
+        progress = 100
+    images = task.results if api_task.finished else []
+    return dict(
+        task_id=api_task.id,
+        status=api_task.status,
+        position=worker.async_tasks.position(task),
+        created=api_task.created,
+        progress=progress,
+        title=title,
+        seed=task.seed,
+        images=serialize_images(images, include_images)
+    )
+
+
+def authorized(username, password):
+    if not auth_enabled:
+        return True
+    return username is not None and password is not None and check_auth(username, password)
+
+
+basic_auth = HTTPBasic(auto_error=False)
+
+
+def require_auth(credentials: HTTPBasicCredentials = Depends(basic_auth)):
+    if not auth_enabled:
+        return
+    if credentials is None or not authorized(credentials.username, credentials.password):
+        raise HTTPException(status_code=401, detail='Unauthorized', headers={'WWW-Authenticate': 'Basic'})
+
+
+def websocket_authorized(websocket: WebSocket):
+    if not auth_enabled:
+        return True
+    header = websocket.headers.get('authorization', '')
+    if not header.lower().startswith('basic '):
+        return False
+    try:
+        username, _, password = base64.b64decode(header[6:]).decode('utf-8').partition(':')
+    except Exception:
+        return False
+    return authorized(username, password)
+
+
+async def stream_events(websocket: WebSocket, api_task, include_images=True):
+    cursor = 0
+    finished = False
+    while not finished:
+        events, finished = await asyncio.to_thread(api_task.wait_for_events, cursor)
+        cursor += len(events)
+        for flag, product in events:
+            await websocket.send_json(serialize_event(flag, product, include_images))
+
+
+def create_app():
+    app = FastAPI(title='Fooocus API')
+
+    @app.post('/v1/generation', dependencies=[Depends(require_auth)])
+    def generation(request: GenerationRequest):
+        return serialize_task(submit(request))
+
+    @app.get('/v1/tasks/{task_id}', dependencies=[Depends(require_auth)])
+    def task_status(task_id: str, include_images: bool = False):
+        return serialize_task(get_api_task(task_id), include_images)
+
+    @app.post('/v1/tasks/{task_id}/stop', dependencies=[Depends(require_auth)])
+    def task_stop(task_id: str):
+        api_task = get_api_task(task_id)
+        api_task.task.last_stop = 'stop'
+        if api_task.task.processing:
+            worker.interrupt_task(api_task.task)
+        elif worker.cancel_task(api_task.task):
+            api_task.cancelled = True
+            api_task.task.yields.append(['finish', api_task.task.results])
+        return serialize_task(api_task)
+
+    @app.post('/v1/tasks/{task_id}/skip', dependencies=[Depends(require_auth)])
+    def task_skip(task_id: str):
+        api_task = get_api_task(task_id)
+        api_task.task.last_stop = 'skip'
+        if api_task.task.processing:
+            worker.interrupt_task(api_task.task)
+        return serialize_task(api_task)
+
+    @app.delete('/v1/tasks/{task_id}', dependencies=[Depends(require_auth)])
+    def task_cancel(task_id: str):
+        api_task = get_api_task(task_id)
+        if not worker.cancel_task(api_task.task):
+            raise HTTPException(status_code=409, detail=f'Task {task_id} is not queued.')
+        api_task.cancelled = True
+        api_task.task.last_stop = 'stop'
+        api_task.task.yields.append(['finish', api_task.task.results])
+        return serialize_task(api_task)
+
+    @app.get('/v1/queue', dependencies=[Depends(require_auth)])
+    def queue_status():
+        stats = worker.async_tasks.stats()
+        with tasks_lock:
+            unfinished = [api_task for api_task in api_tasks.values() if not api_task.finished]
+        stats['tasks'] = [serialize_task(api_task) for api_task in unfinished]
+        if worker.result_cache is not None:
+            stats['result_cache'] = worker.result_cache.stats()
+        if worker.prefetcher is not None:
+            stats['prefetch'] = worker.prefetcher.stats()
+        import modules.default_pipeline as pipeline
+        if pipeline.cond_cache is not None:
+            stats['conditioning_cache'] = pipeline.cond_cache.stats()
+        if pipeline.final_expansion is not None:
+            stats['expansion_cache'] = pipeline.final_expansion.stats()
+        stats['models'] = dict(model_management.model_stats, policy=model_management.eviction_policy.name)
+        return stats
+
+    @app.websocket('/v1/tasks/{task_id}/events')
+    async def task_events(websocket: WebSocket, task_id: str, include_images: bool = True):
+        if not websocket_authorized(websocket):
+            await websocket.close(code=1008)
+            return
+        await websocket.accept()
+        with tasks_lock:
+            api_task = api_tasks.get(task_id)
+        if api_task is None:
+            await websocket.send_json(dict(type='error', detail=f'Task {task_id} not found.'))
+            await websocket.close()
+            return
+        try:
+            await stream_events(websocket, api_task, include_images)
+            await websocket.close()
+        except WebSocketDisconnect:
+            pass
+
+    @app.websocket('/v1/generation')
+    async def generation_events(websocket: WebSocket, include_images: bool = True):
+        if not websocket_authorized(websocket):
+            await websocket.close(code=1008)
+            return
+        await websocket.accept()
+        try:
+            try:
+                request = GenerationRequest.model_validate(await websocket.receive_json())
+            except ValidationError as e:
+                await websocket.send_json(dict(type='error', detail=e.errors(include_url=False)))
+                await websocket.close()
+                return
+            api_task = submit(request)
+            await websocket.send_json(dict(type='queued', **serialize_task(api_task)))
+            await stream_events(websocket, api_task, include_images)
+            await websocket.close()
+        except WebSocketDisconnect:
+            pass
+
+    return app
+
+
+def start(host=None, port=None, block=False):
+    import uvicorn
+
+    host = host if host is not None else args_manager.args.listen
+    if port is None:
+        port = args_manager.args.api_port if args_manager.args.api_port is not None else args_manager.args.port
+    if port is None:
+        port = 7865
+    config = uvicorn.Config(create_app(), host=host, port=port, log_level='warning')
+    server = uvicorn.Server(config)
+    print(f'[API] Serving on http://{host}:{port}/v1 (docs at /docs).')
+
+    if block:
+        server.run()
+    else:
+        threading.Thread(target=server.run, daemon=True).start()
+    return server
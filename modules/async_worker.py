@@ -1,7 +1,9 @@
 import threading
 
 from extras.inpaint_mask import generate_mask_from_image, SAMOptions
-from modules.patch import PatchSettings, patch_settings, patch_all
+from modules.patch import PatchSettings, patch_all
+from modules.task_queue import TaskQueue, TaskPriority
+from modules.progress_channel import ProgressChannel
 import modules.config
 
 patch_all()
@@ -15,10 +17,16 @@ class AsyncTask:
         import args_manager
 
         self.args = args.copy()
-        self.yields = []
+        self.yields = ProgressChannel()
         self.results = []
         self.last_stop = False
         self.processing = False
+        self.priority = TaskPriority.NORMAL
+        self.client_id = None
+        self.remote_worker = None
+        self.job_id = None
+        self.finished_images = {}
+        self.bypass_result_cache = False
 
         self.performance_loras = []
 
@@ -158,7 +166,230 @@ class AsyncTask:
         self.images_to_enhance_count = 0
         self.enhance_stats = {}
 
-async_tasks = []
+    def get_model_signature(self):
+        performance_lora = self.performance_selection.lora_filename()
+        refiner_model_name = self.refiner_model_name
+        if performance_lora is not None or refiner_model_name == self.base_model_name:
+            refiner_model_name = 'None'
+        return self.base_model_name, refiner_model_name, self.vae_name, str(self.loras), performance_lora
+
+
+def get_affinity_key(task):
+    if len(task.args) == 0:
+        return None
+    return task.get_model_signature()
+
+
+def create_task_queue():
+    import args_manager
+    return TaskQueue(affinity_key=get_affinity_key if args_manager.args.queue_affinity_limit > 0 else None,
+                     max_affinity_bypass=args_manager.args.queue_affinity_limit)
+
+
+async_tasks = create_task_queue()
+
+
+def open_job_journal():
+    import os
+    import args_manager
+    from modules.job_journal import JobJournal
+    if args_manager.args.job_journal is None:
+        return None
+    path = args_manager.args.job_journal or os.path.join(modules.config.path_outputs, 'jobs.db')
+    try:
+        journal = JobJournal(path)
+    except Exception as e:
+        print(f'[Journal] Cannot open job journal {path}: {e}')
+        return None
+    print(f'[Journal] Recording jobs in {path}')
+    return journal
+
+
+job_journal = open_job_journal()
+
+
+def create_result_cache():
+    import os
+    import args_manager
+    from modules.result_cache import ResultCache
+    from modules.worker_pool import is_worker_process
+    if args_manager.args.result_cache_size <= 0:
+        return None
+    # pool workers share the file of the main process, which is the only one compacting it
+    return ResultCache(path=os.path.join(modules.config.path_outputs, 'result_cache.jsonl'),
+                       max_entries=args_manager.args.result_cache_size,
+                       max_age=args_manager.args.result_cache_max_age * 3600,
+                       compact=not is_worker_process())
+
+
+result_cache = create_result_cache()
+
+
+def get_task_model_files(task):
+    import modules.flags
+    from modules.util import get_file_from_folder_list
+    base_model_name, refiner_model_name, vae_name, _, performance_lora = task.get_model_signature()
+    files = [get_file_from_folder_list(base_model_name, modules.config.paths_checkpoints)]
+    if refiner_model_name != 'None':
+        files.append(get_file_from_folder_list(refiner_model_name, modules.config.paths_checkpoints))
+    if vae_name != modules.flags.default_vae:
+        files.append(get_file_from_folder_list(vae_name, modules.config.path_vae))
+    lora_names = [name for name, _ in task.loras] + ([performance_lora] if performance_lora is not None else [])
+    files += [get_file_from_folder_list(name, modules.config.paths_loras) for name in lora_names if name != 'None']
+    return files
+
+
+def create_prefetcher():
+    import args_manager
+    from modules.prefetch import ModelPrefetcher
+    prefetcher = ModelPrefetcher(max_bytes=int(args_manager.args.prefetch_size * 1024 ** 3))
+    if prefetcher.max_bytes <= 0:
+        return None
+
+    def prefetch_next_task():
+        upcoming = [task for task in async_tasks.peek() if len(task.args) > 0]
+        prefetcher.schedule(get_task_model_files(upcoming[0]) if len(upcoming) > 0 else [])
+
+    async_tasks.add_listener(prefetch_next_task)
+    return prefetcher
+
+
+prefetcher = create_prefetcher()
+
+
+def get_models_needed_soon():
+    import modules.default_pipeline as pipeline
+    import extras.censor
+    from modules.sdxl_styles import fooocus_expansion
+    from modules.util import get_file_from_folder_list
+    upcoming = [task for task in async_tasks.peek() if len(task.args) > 0]
+    if len(upcoming) == 0:
+        return []
+
+    task = upcoming[0]
+    filenames = [get_file_from_folder_list(name, modules.config.paths_checkpoints)
+                 for name in [task.base_model_name, task.refiner_model_name] if name != 'None']
+    patchers = []
+    for model in [pipeline.model_base, pipeline.model_refiner]:
+        if model.filename is None or model.filename not in filenames:
+            continue
+        patchers.append(model.unet_with_lora)
+        if model.clip_with_lora is not None:
+            patchers.append(model.clip_with_lora.patcher)
+        if model.vae is not None:
+            patchers.append(model.vae.patcher)
+    if fooocus_expansion in task.style_selections and pipeline.final_expansion is not None:
+        patchers.append(pipeline.final_expansion.patcher)
+    if task.black_out_nsfw:
+        patchers.append(extras.censor.default_censor.__self__.safety_checker_model)
+    return [patcher.model for patcher in patchers if patcher is not None]
+
+
+def install_eviction_policy():
+    import args_manager
+    import ldm_patched.modules.model_management as model_management
+    from modules.model_eviction import CostAwareEvictionPolicy
+    if args_manager.args.eviction_policy == 'cost':
+        model_management.eviction_policy = CostAwareEvictionPolicy(needed_soon=get_models_needed_soon)
+
+
+install_eviction_policy()
+
+
+def set_job_status(task, status):
+    if job_journal is None or task.job_id is None:
+        return
+    try:
+        job_journal.set_status(task.job_id, status)
+    except Exception as e:
+        print(f'[Journal] Cannot update job {task.job_id}: {e}')
+
+
+def get_job_state(task):
+    # the parameters the task was created from, an API request with the seed that was drawn for it
+    args = task.args
+    if isinstance(args, dict):
+        args = dict(args, seed=task.seed)
+    return dict(args=args, priority=int(task.priority), client_id=task.client_id,
+                bypass_result_cache=task.bypass_result_cache)
+
+
+def restore_job_task(state):
+    if isinstance(state['args'], dict):
+        from modules.api_schema import GenerationRequest, build_async_task
+        task = build_async_task(GenerationRequest(**state['args']))
+    else:
+        task = AsyncTask(args=state['args'])
+    task.priority = TaskPriority(state['priority'])
+    task.client_id = state['client_id']
+    task.bypass_result_cache = state['bypass_result_cache']
+    return task
+
+
+def enqueue_task(task):
+    if job_journal is not None and task.job_id is None:
+        try:
+            task.job_id = job_journal.add_job(get_job_state(task), task.image_number)
+        except Exception as e:
+            print(f'[Journal] Cannot record job, it will not be resumed after a restart: {e}')
+    async_tasks.put(task)
+
+
+def cancel_task(task):
+    from modules.job_journal import CANCELLED
+    if not async_tasks.cancel(task):
+        return False
+    set_job_status(task, CANCELLED)
+    return True
+
+
+def drain_resumed_task(task):
+    while True:
+        flag, product = task.yields.get()
+        if flag == 'finish':
+            print(f'[Journal] Resumed job {task.job_id} finished with {len(product)} image(s).')
+            return
+
+
+def resume_jobs(max_finished_age=7 * 24 * 3600):
+    import modules.worker_pool
+    if job_journal is None or modules.worker_pool.is_worker_process():
+        return []
+
+    removed = job_journal.remove_finished_jobs(max_finished_age)
+    if removed > 0:
+        print(f'[Journal] Removed {removed} old finished job(s).')
+
+    from modules.job_journal import FINISHED, FAILED
+    resumed = []
+    for job_id, state in job_journal.get_unfinished_jobs():
+        try:
+            task = restore_job_task(state)
+        except Exception as e:
+            print(f'[Journal] Cannot restore job {job_id}: {e}')
+            job_journal.set_status(job_id, FAILED)
+            continue
+        task.job_id = job_id
+        task.finished_images = job_journal.get_images(job_id)
+        task.results = list(task.finished_images.values())
+        if len(task.finished_images) >= task.image_number:
+            print(f'[Journal] Job {job_id} had saved all {task.image_number} image(s) already.')
+            job_journal.set_status(job_id, FINISHED)
+            continue
+        print(f'[Journal] Resuming job {job_id}, {len(task.finished_images)}/{task.image_number} image(s) '
+              f'were already saved.')
+        threading.Thread(target=drain_resumed_task, args=(task,), daemon=True).start()
+        async_tasks.put(task)
+        resumed.append(task)
+    return resumed
+
+
+def interrupt_task(task):
+    import ldm_patched.modules.model_management as model_management
+    if task.remote_worker is not None:
+        task.remote_worker.interrupt(task)
+    else:
+        model_management.interrupt_current_processing()
 
 
 class EarlyReturnException(BaseException):
@@ -185,18 +416,25 @@ def worker():
     import ldm_patched.modules.model_management
     import extras.preprocessors as preprocessors
     import modules.inpaint_worker as inpaint_worker
+    import modules.task_context as task_context
+    import modules.job_journal
     import modules.constants as constants
     import extras.ip_adapter as ip_adapter
     import extras.face_crop
     import fooocus_version
+    import args_manager
 
     from extras.censor import default_censor
     from modules.sdxl_styles import apply_style, get_random_style, fooocus_expansion, apply_arrays, random_style_name
-    from modules.private_logger import log
+    from modules.private_logger import log, save_image, log_html
+    from modules.post_processing import PostProcessingStage
+    from modules.lazy_conditioning import LazyConditioning
+    from modules.result_cache import get_cache_key
+    from modules.prefetch import get_file_key
     from extras.expansion import safe_str
     from modules.util import (remove_empty_str, HWC3, resize_image, get_image_shape_ceil, set_image_shape_ceil,
                               get_shape_ceil, resample_image, erode_or_dilate, parse_lora_references_from_prompt,
-                              apply_wildcards)
+                              apply_wildcards, get_file_from_folder_list)
     from modules.upscaler import perform_upscale
     from modules.flags import Performance
     from modules.meta_parser import get_metadata_parser
@@ -213,6 +451,9 @@ def worker():
     except Exception as e:
         print(e)
 
+    post_processing = PostProcessingStage(max_workers=args_manager.args.post_processing_workers)
+    inline_post_processing = PostProcessingStage(max_workers=0)
+
     def progressbar(async_task, number, text):
         print(f'[Fooocus] {text}')
         async_task.yields.append(['preview', (number, text, None)])
@@ -280,7 +521,7 @@ def worker():
     def process_task(all_steps, async_task, callback, controlnet_canny_path, controlnet_cpds_path, current_task_id,
                      denoising_strength, final_scheduler_name, goals, initial_latent, steps, switch, positive_cond,
                      negative_cond, task, loras, tiled, use_expansion, width, height, base_progress, preparation_steps,
-                     total_count, show_intermediate_results, persist_image=True):
+                     total_count, show_intermediate_results, persist_image=True, stage=None):
         if async_task.last_stop is not False:
             ldm_patched.modules.model_management.interrupt_current_processing()
         if 'cn' in goals:
@@ -311,21 +552,66 @@ def worker():
             disable_preview=async_task.disable_preview
         )
         del positive_cond, negative_cond  # Save memory
-        if inpaint_worker.current_task is not None:
-            imgs = [inpaint_worker.current_task.post_process(x) for x in imgs]
+        if task_context.current().inpaint_task is not None:
+            imgs = [task_context.current().inpaint_task.post_process(x) for x in imgs]
         current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps)
         if modules.config.default_black_out_nsfw or async_task.black_out_nsfw:
             progressbar(async_task, current_progress, 'Checking for NSFW content ...')
             imgs = default_censor(imgs)
         progressbar(async_task, current_progress, f'Saving image {current_task_id + 1}/{total_count} to system ...')
-        img_paths = save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image)
-        yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
-                     do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
 
-        return imgs, img_paths, current_progress
+        def show_images(img_paths):
+            yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
+                         do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+
+        save_and_log_async(async_task, height, [(x, task) for x in imgs], use_expansion, width, loras, persist_image,
+                           show_images, stage)
+        return imgs, current_progress
+
+    def process_task_batch(all_steps, async_task, callback, current_task_id, final_scheduler_name, steps, switch,
+                           batch_tasks, loras, use_expansion, width, height, base_progress, preparation_steps,
+                           total_count, show_intermediate_results, persist_image=True, stage=None):
+        if async_task.last_stop is not False:
+            ldm_patched.modules.model_management.interrupt_current_processing()
+        imgs = pipeline.process_diffusion(
+            positive_cond=pipeline.stack_conds([task['c'] for task in batch_tasks]),
+            negative_cond=pipeline.stack_conds([task['uc'] for task in batch_tasks]),
+            steps=steps,
+            switch=switch,
+            width=width,
+            height=height,
+            image_seed=[task['task_seed'] for task in batch_tasks],
+            callback=callback,
+            sampler_name=async_task.sampler_name,
+            scheduler_name=final_scheduler_name,
+            cfg_scale=async_task.cfg_scale,
+            refiner_swap_method=async_task.refiner_swap_method,
+            disable_preview=async_task.disable_preview
+        )
+        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps * len(batch_tasks))
+        if modules.config.default_black_out_nsfw or async_task.black_out_nsfw:
+            progressbar(async_task, current_progress, 'Checking for NSFW content ...')
+            imgs = default_censor(imgs)
+        progressbar(async_task, current_progress, f'Saving images {current_task_id + 1}-{current_task_id + len(imgs)}/{total_count} to system ...')
+
+        def show_images(img_paths):
+            yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
+                         do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+
+        save_and_log_async(async_task, height, list(zip(imgs, batch_tasks)), use_expansion, width, loras,
+                           persist_image, show_images, stage)
+        return imgs, current_progress
+
+    def get_task_batches(async_task, goals, tasks, width, height):
+        if args_manager.args.batched_sampling is None or len(goals) > 0 or len(tasks) < 2 \
+                or async_task.sampler_name not in flags.BATCHABLE_SAMPLERS:
+            return [[task] for task in tasks]
+
+        batch_size = pipeline.get_sampling_batch_size(width, height, args_manager.args.batched_sampling)
+        return [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
 
     def apply_patch_settings(async_task):
-        patch_settings[pid] = PatchSettings(
+        task_context.current().patch_settings = PatchSettings(
             async_task.sharpness,
             async_task.adm_scaler_end,
             async_task.adm_scaler_positive,
@@ -334,64 +620,136 @@ def worker():
             async_task.adaptive_cfg
         )
 
-    def save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image=True) -> list:
-        img_paths = []
-        for x in imgs:
-            d = [('Prompt', 'prompt', task['log_positive_prompt']),
-                 ('Negative Prompt', 'negative_prompt', task['log_negative_prompt']),
-                 ('Fooocus V2 Expansion', 'prompt_expansion', task['expansion']),
-                 ('Styles', 'styles',
-                  str(task['styles'] if not use_expansion else [fooocus_expansion] + task['styles'])),
-                 ('Performance', 'performance', async_task.performance_selection.value),
-                 ('Steps', 'steps', async_task.steps),
-                 ('Resolution', 'resolution', str((width, height))),
-                 ('Guidance Scale', 'guidance_scale', async_task.cfg_scale),
-                 ('Sharpness', 'sharpness', async_task.sharpness),
-                 ('ADM Guidance', 'adm_guidance', str((
-                     modules.patch.patch_settings[pid].positive_adm_scale,
-                     modules.patch.patch_settings[pid].negative_adm_scale,
-                     modules.patch.patch_settings[pid].adm_scaler_end))),
-                 ('Base Model', 'base_model', async_task.base_model_name),
-                 ('Refiner Model', 'refiner_model', async_task.refiner_model_name),
-                 ('Refiner Switch', 'refiner_switch', async_task.refiner_switch)]
-
-            if async_task.refiner_model_name != 'None':
-                if async_task.overwrite_switch > 0:
-                    d.append(('Overwrite Switch', 'overwrite_switch', async_task.overwrite_switch))
-                if async_task.refiner_swap_method != flags.refiner_swap_method:
-                    d.append(('Refiner Swap Method', 'refiner_swap_method', async_task.refiner_swap_method))
-            if modules.patch.patch_settings[pid].adaptive_cfg != modules.config.default_cfg_tsnr:
-                d.append(
-                    ('CFG Mimicking from TSNR', 'adaptive_cfg', modules.patch.patch_settings[pid].adaptive_cfg))
-
-            if async_task.clip_skip > 1:
-                d.append(('CLIP Skip', 'clip_skip', async_task.clip_skip))
-            d.append(('Sampler', 'sampler', async_task.sampler_name))
-            d.append(('Scheduler', 'scheduler', async_task.scheduler_name))
-            d.append(('VAE', 'vae', async_task.vae_name))
-            d.append(('Seed', 'seed', str(task['task_seed'])))
-
-            if async_task.freeu_enabled:
-                d.append(('FreeU', 'freeu',
-                          str((async_task.freeu_b1, async_task.freeu_b2, async_task.freeu_s1, async_task.freeu_s2))))
-
-            for li, (n, w) in enumerate(loras):
-                if n != 'None':
-                    d.append((f'LoRA {li + 1}', f'lora_combined_{li + 1}', f'{n} : {w}'))
-
-            metadata_parser = None
-            if async_task.save_metadata_to_images:
-                metadata_parser = modules.meta_parser.get_metadata_parser(async_task.metadata_scheme)
-                metadata_parser.set_data(task['log_positive_prompt'], task['positive'],
-                                         task['log_negative_prompt'], task['negative'],
-                                         async_task.steps, async_task.base_model_name, async_task.refiner_model_name,
-                                         loras, async_task.vae_name)
-            d.append(('Metadata Scheme', 'metadata_scheme',
-                      async_task.metadata_scheme.value if async_task.save_metadata_to_images else async_task.save_metadata_to_images))
-            d.append(('Version', 'version', 'Fooocus v' + fooocus_version.version))
-            img_paths.append(log(x, d, metadata_parser, async_task.output_format, task, persist_image))
-
-        return img_paths
+    def get_log_metadata(async_task, height, task, use_expansion, width, loras):
+        d = [('Prompt', 'prompt', task['log_positive_prompt']),
+             ('Negative Prompt', 'negative_prompt', task['log_negative_prompt']),
+             ('Fooocus V2 Expansion', 'prompt_expansion', task['expansion']),
+             ('Styles', 'styles',
+              str(task['styles'] if not use_expansion else [fooocus_expansion] + task['styles'])),
+             ('Performance', 'performance', async_task.performance_selection.value),
+             ('Steps', 'steps', async_task.steps),
+             ('Resolution', 'resolution', str((width, height))),
+             ('Guidance Scale', 'guidance_scale', async_task.cfg_scale),
+             ('Sharpness', 'sharpness', async_task.sharpness),
+             ('ADM Guidance', 'adm_guidance', str((
+                 task_context.current().patch_settings.positive_adm_scale,
+                 task_context.current().patch_settings.negative_adm_scale,
+                 task_context.current().patch_settings.adm_scaler_end))),
+             ('Base Model', 'base_model', async_task.base_model_name),
+             ('Refiner Model', 'refiner_model', async_task.refiner_model_name),
+             ('Refiner Switch', 'refiner_switch', async_task.refiner_switch)]
+
+        if async_task.refiner_model_name != 'None':
+            if async_task.overwrite_switch > 0:
+                d.append(('Overwrite Switch', 'overwrite_switch', async_task.overwrite_switch))
+            if async_task.refiner_swap_method != flags.refiner_swap_method:
+                d.append(('Refiner Swap Method', 'refiner_swap_method', async_task.refiner_swap_method))
+        if task_context.current().patch_settings.adaptive_cfg != modules.config.default_cfg_tsnr:
+            d.append(
+                ('CFG Mimicking from TSNR', 'adaptive_cfg', task_context.current().patch_settings.adaptive_cfg))
+
+        if async_task.clip_skip > 1:
+            d.append(('CLIP Skip', 'clip_skip', async_task.clip_skip))
+        d.append(('Sampler', 'sampler', async_task.sampler_name))
+        d.append(('Scheduler', 'scheduler', async_task.scheduler_name))
+        d.append(('VAE', 'vae', async_task.vae_name))
+        d.append(('Seed', 'seed', str(task['task_seed'])))
+
+        if async_task.freeu_enabled:
+            d.append(('FreeU', 'freeu',
+                      str((async_task.freeu_b1, async_task.freeu_b2, async_task.freeu_s1, async_task.freeu_s2))))
+
+        for li, (n, w) in enumerate(loras):
+            if n != 'None':
+                d.append((f'LoRA {li + 1}', f'lora_combined_{li + 1}', f'{n} : {w}'))
+
+        metadata_parser = None
+        if async_task.save_metadata_to_images:
+            metadata_parser = modules.meta_parser.get_metadata_parser(async_task.metadata_scheme)
+            metadata_parser.set_data(task['log_positive_prompt'], task['positive'],
+                                     task['log_negative_prompt'], task['negative'],
+                                     async_task.steps, async_task.base_model_name, async_task.refiner_model_name,
+                                     loras, async_task.vae_name)
+        d.append(('Metadata Scheme', 'metadata_scheme',
+                  async_task.metadata_scheme.value if async_task.save_metadata_to_images else async_task.save_metadata_to_images))
+        d.append(('Version', 'version', 'Fooocus v' + fooocus_version.version))
+        return d, metadata_parser
+
+    def record_images(async_task, img_paths, tasks, cache=True):
+        if cache and result_cache is not None:
+            paths_by_key = {}
+            for img_path, task in zip(img_paths, tasks):
+                if 'result_cache_key' in task:
+                    paths_by_key.setdefault(task['result_cache_key'], []).append(img_path)
+            for key, paths in paths_by_key.items():
+                result_cache.put(key, paths)
+
+        # images of jobs with enhance are not final yet, such jobs are resumed from the start
+        if job_journal is None or async_task.job_id is None or async_task.should_enhance:
+            return
+        for img_path, task in zip(img_paths, tasks):
+            if 'task_index' not in task:
+                continue
+            try:
+                job_journal.add_image(async_task.job_id, task['task_index'], task['task_seed'], img_path)
+            except Exception as e:
+                print(f'[Journal] Cannot record image of job {async_task.job_id}: {e}')
+
+    def get_model_file_key(name, folders):
+        # the name alone misses a file replaced under the same name
+        if name in ['None', flags.default_vae]:
+            return name
+        return get_file_key(get_file_from_folder_list(name, folders))
+
+    def get_result_cache_key(async_task, task, loras, use_expansion, width, height, switch):
+        return get_cache_key(dict(
+            positive=task['positive'],
+            negative=task['negative'],
+            seed=task['task_seed'],
+            use_expansion=use_expansion,
+            performance=async_task.performance_selection.value,
+            steps=async_task.steps,
+            switch=switch,
+            width=width,
+            height=height,
+            sampler_name=async_task.sampler_name,
+            scheduler_name=async_task.scheduler_name,
+            cfg_scale=async_task.cfg_scale,
+            sharpness=async_task.sharpness,
+            adaptive_cfg=async_task.adaptive_cfg,
+            adm_scaler=[async_task.adm_scaler_positive, async_task.adm_scaler_negative, async_task.adm_scaler_end],
+            clip_skip=async_task.clip_skip,
+            base_model=get_model_file_key(async_task.base_model_name, modules.config.paths_checkpoints),
+            refiner_model=get_model_file_key(async_task.refiner_model_name, modules.config.paths_checkpoints),
+            refiner_swap_method=async_task.refiner_swap_method,
+            vae=get_model_file_key(async_task.vae_name, modules.config.path_vae),
+            loras=[[get_model_file_key(name, modules.config.paths_loras), weight] for name, weight in loras],
+            freeu=[async_task.freeu_enabled, async_task.freeu_b1, async_task.freeu_b2, async_task.freeu_s1,
+                   async_task.freeu_s2],
+            black_out_nsfw=modules.config.default_black_out_nsfw or async_task.black_out_nsfw,
+            output_format=async_task.output_format,
+            save_metadata_to_images=async_task.save_metadata_to_images,
+            metadata_scheme=async_task.metadata_scheme,
+            version=fooocus_version.version
+        ))
+
+    def save_and_log_async(async_task, height, items, use_expansion, width, loras, persist_image, done, stage=None):
+        # metadata is collected here, encoding and writing the images runs on the post-processing stage
+        entries = [(x, task) + get_log_metadata(async_task, height, task, use_expansion, width, loras)
+                   for x, task in items]
+
+        def save_images():
+            return [save_image(x, d, metadata_parser, async_task.output_format, persist_image)
+                    for x, task, d, metadata_parser in entries]
+
+        def log_images(img_paths):
+            if not args_manager.args.disable_image_log:
+                for img_path, (x, task, d, metadata_parser) in zip(img_paths, entries):
+                    log_html(img_path, d, task)
+            record_images(async_task, img_paths, [task for x, task in items])
+            done(img_paths)
+
+        return (stage or inline_post_processing).submit(save_images, log_images)
 
     def apply_control_nets(async_task, height, ip_adapter_face_path, ip_adapter_path, width, current_progress):
         for task in async_task.cn_tasks[flags.cn_canny]:
@@ -483,23 +841,23 @@ def worker():
         if not skip_apply_outpaint:
             inpaint_image, inpaint_mask = apply_outpaint(async_task, inpaint_image, inpaint_mask)
 
-        inpaint_worker.current_task = inpaint_worker.InpaintWorker(
+        task_context.current().inpaint_task = inpaint_worker.InpaintWorker(
             image=inpaint_image,
             mask=inpaint_mask,
             use_fill=denoising_strength > 0.99,
             k=inpaint_respective_field
         )
         if async_task.debugging_inpaint_preprocessor:
-            yield_result(async_task, inpaint_worker.current_task.visualize_mask_processing(), 100,
+            yield_result(async_task, task_context.current().inpaint_task.visualize_mask_processing(), 100,
                          async_task.black_out_nsfw, do_not_show_finished_images=True)
             raise EarlyReturnException
 
         if advance_progress:
             current_progress += 1
         progressbar(async_task, current_progress, 'VAE Inpaint encoding ...')
-        inpaint_pixel_fill = core.numpy_to_pytorch(inpaint_worker.current_task.interested_fill)
-        inpaint_pixel_image = core.numpy_to_pytorch(inpaint_worker.current_task.interested_image)
-        inpaint_pixel_mask = core.numpy_to_pytorch(inpaint_worker.current_task.interested_mask)
+        inpaint_pixel_fill = core.numpy_to_pytorch(task_context.current().inpaint_task.interested_fill)
+        inpaint_pixel_image = core.numpy_to_pytorch(task_context.current().inpaint_task.interested_image)
+        inpaint_pixel_mask = core.numpy_to_pytorch(task_context.current().inpaint_task.interested_mask)
         candidate_vae, candidate_vae_swap = pipeline.get_candidate_vae(
             steps=async_task.steps,
             switch=switch,
@@ -524,10 +882,10 @@ def worker():
         latent_fill = core.encode_vae(
             vae=candidate_vae,
             pixels=inpaint_pixel_fill)['samples']
-        inpaint_worker.current_task.load_latent(
+        task_context.current().inpaint_task.load_latent(
             latent_fill=latent_fill, latent_mask=latent_mask, latent_swap=latent_swap)
         if inpaint_parameterized:
-            pipeline.final_unet = inpaint_worker.current_task.patch(
+            pipeline.final_unet = task_context.current().inpaint_task.patch(
                 inpaint_head_model_path=inpaint_head_model_path,
                 inpaint_latent=latent_inpaint,
                 inpaint_latent_mask=latent_mask,
@@ -537,7 +895,7 @@ def worker():
             initial_latent = {'samples': latent_fill}
         B, C, H, W = latent_fill.shape
         height, width = H * 8, W * 8
-        final_height, final_width = inpaint_worker.current_task.image.shape[:2]
+        final_height, final_width = task_context.current().inpaint_task.image.shape[:2]
         print(f'Final resolution is {str((final_width, final_height))}, latent is {str((width, height))}.')
 
         return denoising_strength, initial_latent, width, height, current_progress
@@ -639,7 +997,8 @@ def worker():
         return steps, switch, width, height
 
     def process_prompt(async_task, prompt, negative_prompt, base_model_additional_loras, image_number, disable_seed_increment, use_expansion, use_style,
-                       use_synthetic_refiner, current_progress, advance_progress=False):
+                       use_synthetic_refiner, current_progress, advance_progress=False, lazy=False,
+                       skip_indices=(), reuse_result=None):
         prompts = remove_empty_str([safe_str(p) for p in prompt.splitlines()], default='')
         negative_prompts = remove_empty_str([safe_str(p) for p in negative_prompt.splitlines()], default='')
         prompt = prompts[0]
@@ -658,16 +1017,13 @@ def worker():
                                                           modules.config.default_max_lora_number,
                                                           lora_filenames=lora_filenames)
         loras += async_task.performance_loras
-        pipeline.refresh_everything(refiner_model_name=async_task.refiner_model_name,
-                                    base_model_name=async_task.base_model_name,
-                                    loras=loras, base_model_additional_loras=base_model_additional_loras,
-                                    use_synthetic_refiner=use_synthetic_refiner, vae_name=async_task.vae_name)
-        pipeline.set_clip_skip(async_task.clip_skip)
         if advance_progress:
             current_progress += 1
         progressbar(async_task, current_progress, 'Processing prompts ...')
         tasks = []
         for i in range(image_number):
+            if i in skip_indices:
+                continue
             if disable_seed_increment:
                 task_seed = async_task.seed % (constants.MAX_SEED + 1)
             else:
@@ -715,6 +1071,7 @@ def worker():
             negative_basic_workloads = remove_empty_str(negative_basic_workloads, default=task_negative_prompt)
 
             tasks.append(dict(
+                task_index=i,
                 task_seed=task_seed,
                 task_prompt=task_prompt,
                 task_negative_prompt=task_negative_prompt,
@@ -729,30 +1086,80 @@ def worker():
                 log_negative_prompt='\n'.join([task_negative_prompt] + task_extra_negative_prompts),
                 styles=task_styles
             ))
-        if use_expansion:
-            if advance_progress:
-                current_progress += 1
-            for i, t in enumerate(tasks):
 
+        # tasks with a reusable result are dropped, models are not loaded when none are left
+        if reuse_result is not None and len(tasks) > 0:
+            tasks = [t for t in tasks if not reuse_result(t, loras, use_expansion)]
+            if len(tasks) == 0:
+                return tasks, use_expansion, loras, current_progress, None
+
+        pipeline.refresh_everything(refiner_model_name=async_task.refiner_model_name,
+                                    base_model_name=async_task.base_model_name,
+                                    loras=loras, base_model_additional_loras=base_model_additional_loras,
+                                    use_synthetic_refiner=use_synthetic_refiner, vae_name=async_task.vae_name)
+        pipeline.set_clip_skip(async_task.clip_skip)
+
+        use_negative = abs(float(async_task.cfg_scale) - 1.0) >= 1e-4
+
+        def expand_task(i, t, report=True):
+            if not use_expansion or t.get('expanded', False):
+                return
+            if report:
                 progressbar(async_task, current_progress, f'Preparing Fooocus text #{i + 1} ...')
-                expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
-                print(f'[Prompt Expansion] {expansion}')
-                t['expansion'] = expansion
-                t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
-        if advance_progress:
-            current_progress += 1
-        for i, t in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Encoding positive #{i + 1} ...')
+            expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
+            print(f'[Prompt Expansion] {expansion}')
+            t['expansion'] = expansion
+            t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
+            t['expanded'] = True
+
+        def encode_task(i, t, report=True):
+            expand_task(i, t, report=report)
+            if report:
+                progressbar(async_task, current_progress, f'Encoding positive #{i + 1} ...')
             t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
-        if advance_progress:
-            current_progress += 1
-        for i, t in enumerate(tasks):
-            if abs(float(async_task.cfg_scale) - 1.0) < 1e-4:
+            if not use_negative:
                 t['uc'] = pipeline.clone_cond(t['c'])
             else:
-                progressbar(async_task, current_progress, f'Encoding negative #{i + 1} ...')
+                if report:
+                    progressbar(async_task, current_progress, f'Encoding negative #{i + 1} ...')
                 t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'])
-        return tasks, use_expansion, loras, current_progress
+
+        if advance_progress:
+            current_progress += 3 if use_expansion else 2
+
+        def prepare_tasks(batch):
+            # expands and encodes the prompts of the tasks in batched passes that encode_task finds cached
+            if use_expansion:
+                progressbar(async_task, current_progress, f'Preparing Fooocus text for {len(batch)} prompts ...')
+                pipeline.final_expansion.expand_batch([t['task_prompt'] for t in batch],
+                                                      [t['task_seed'] for t in batch])
+            for t in batch:
+                expand_task(None, t, report=False)
+            progressbar(async_task, current_progress, f'Encoding {len(batch)} prompts ...')
+            texts = [text for t in batch for text in t['positive']]
+            if use_negative:
+                texts += [text for t in batch for text in t['negative']]
+            pipeline.clip_encode_batch(texts)
+
+        # with lazy conditioning only the first task is encoded before sampling starts, the others in the
+        # background or before the sampling batch that needs them, see LazyConditioning
+        background = lazy and len(tasks) > 1 and can_encode_in_background()
+        conditioning = LazyConditioning(tasks, lambda i, t: encode_task(i, t, report=not background),
+                                        background=background, prepare=None if background else prepare_tasks)
+        if lazy and len(tasks) > 0:
+            conditioning.require(0)
+            conditioning.start()
+        elif len(tasks) > 0:
+            conditioning.require(len(tasks) - 1)
+            for i in range(len(tasks)):
+                conditioning.require(i)
+        return tasks, use_expansion, loras, current_progress, conditioning
+
+    def can_encode_in_background():
+        # the text models must not compete with sampling for the device, model_management is not thread safe
+        model_management = ldm_patched.modules.model_management
+        return model_management.is_device_cpu(model_management.text_encoder_device()) \
+            and not model_management.is_device_cpu(model_management.get_torch_device())
 
     def apply_freeu(async_task):
         print(f'FreeU is enabled!')
@@ -1001,7 +1408,7 @@ def worker():
                 base_model_additional_loras += [(inpaint_patch_model_path, 1.0)]
         progressbar(async_task, current_progress, 'Preparing enhance prompts ...')
         # positive and negative conditioning aren't available here anymore, process prompt again
-        tasks_enhance, use_expansion, loras, current_progress = process_prompt(
+        tasks_enhance, use_expansion, loras, current_progress, _ = process_prompt(
             async_task, prompt, negative_prompt, base_model_additional_loras, 1, True,
             use_expansion, use_style, use_synthetic_refiner, current_progress)
         task_enhance = tasks_enhance[0]
@@ -1017,13 +1424,13 @@ def worker():
                 inpaint_parameterized, inpaint_strength,
                 inpaint_respective_field, switch, inpaint_disable_initial_latent,
                 current_progress, True)
-        imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
-                                                         controlnet_cpds_path, current_task_id, denoising_strength,
-                                                         final_scheduler_name, goals, initial_latent, steps, switch,
-                                                         task_enhance['c'], task_enhance['uc'], task_enhance, loras,
-                                                         tiled, use_expansion, width, height, current_progress,
-                                                         preparation_steps, total_count, show_intermediate_results,
-                                                         persist_image)
+        imgs, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
+                                              controlnet_cpds_path, current_task_id, denoising_strength,
+                                              final_scheduler_name, goals, initial_latent, steps, switch,
+                                              task_enhance['c'], task_enhance['uc'], task_enhance, loras,
+                                              tiled, use_expansion, width, height, current_progress,
+                                              preparation_steps, total_count, show_intermediate_results,
+                                              persist_image)
 
         del task_enhance['c'], task_enhance['uc']  # Save memory
         return current_progress, imgs[0], prompt, negative_prompt
@@ -1033,7 +1440,7 @@ def worker():
                         prompt, negative_prompt, final_scheduler_name, height, img, preparation_steps, switch, tiled,
                         total_count, use_expansion, use_style, use_synthetic_refiner, width, persist_image=True):
         # reset inpaint worker to prevent tensor size issues and not mix upscale and inpainting
-        inpaint_worker.current_task = None
+        task_context.current().inpaint_task = None
 
         current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * (done_steps_upscaling + done_steps_inpainting))
         goals_enhance = []
@@ -1120,7 +1527,7 @@ def worker():
 
         skip_prompt_processing = False
 
-        inpaint_worker.current_task = None
+        task_context.current().inpaint_task = None
         inpaint_parameterized = async_task.inpaint_engine != 'None'
         inpaint_image = None
         inpaint_mask = None
@@ -1134,6 +1541,7 @@ def worker():
 
         goals = []
         tasks = []
+        conditioning = None
         current_progress = 1
 
         if async_task.input_image_checkbox:
@@ -1155,12 +1563,40 @@ def worker():
 
         progressbar(async_task, current_progress, 'Initializing ...')
 
+        cached_results = []
+
+        def reuse_cached_result(task, loras, use_expansion):
+            task['result_cache_key'] = get_result_cache_key(async_task, task, loras, use_expansion, width, height,
+                                                            switch)
+            if async_task.bypass_result_cache:
+                return False
+            img_paths = result_cache.get(task['result_cache_key'])
+            if img_paths is None:
+                return False
+            cached_results.append((task, img_paths))
+            return True
+
+        use_result_cache = result_cache is not None and len(goals) == 0 and not async_task.should_enhance
+
         loras = async_task.loras
         if not skip_prompt_processing:
-            tasks, use_expansion, loras, current_progress = process_prompt(async_task, async_task.prompt, async_task.negative_prompt,
-                                                         base_model_additional_loras, async_task.image_number,
-                                                         async_task.disable_seed_increment, use_expansion, use_style,
-                                                         use_synthetic_refiner, current_progress, advance_progress=True)
+            tasks, use_expansion, loras, current_progress, conditioning = process_prompt(
+                async_task, async_task.prompt, async_task.negative_prompt, base_model_additional_loras,
+                async_task.image_number, async_task.disable_seed_increment, use_expansion, use_style,
+                use_synthetic_refiner, current_progress, advance_progress=True, lazy=True,
+                skip_indices=async_task.finished_images,
+                reuse_result=reuse_cached_result if use_result_cache else None)
+            if len(async_task.finished_images) > 0:
+                print(f'[Journal] Skipping {len(async_task.finished_images)} image(s) saved before the restart.')
+            for task, img_paths in cached_results:
+                print(f'[Result Cache] Reusing {len(img_paths)} image(s) of seed {task["task_seed"]}.')
+                record_images(async_task, img_paths, [task] * len(img_paths), cache=False)
+                yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
+                             do_not_show_finished_images=async_task.disable_intermediate_results)
+            async_task.image_number = len(tasks)
+            if len(tasks) == 0 and len(cached_results) > 0:
+                async_task.processing = False
+                return
 
         if len(goals) > 0:
             current_progress += 1
@@ -1267,46 +1703,83 @@ def worker():
         preparation_steps = current_progress
         total_count = async_task.image_number
 
+        current_batch_size = 1
+
         def callback(step, x0, x, total_steps, y):
             if step == 0:
                 async_task.callback_steps = 0
-            async_task.callback_steps += (100 - preparation_steps) / float(all_steps)
+            async_task.callback_steps += (100 - preparation_steps) / float(all_steps) * current_batch_size
+            if current_batch_size > 1:
+                image_text = f'images {current_task_id + 1}-{current_task_id + current_batch_size}/{total_count}'
+            else:
+                image_text = f'image {current_task_id + 1}/{total_count}'
             async_task.yields.append(['preview', (
                 int(current_progress + async_task.callback_steps),
-                f'Sampling step {step + 1}/{total_steps}, image {current_task_id + 1}/{total_count} ...', y)])
+                f'Sampling step {step + 1}/{total_steps}, {image_text} ...', y)])
 
         show_intermediate_results = len(tasks) > 1 or async_task.should_enhance
         persist_image = not async_task.should_enhance or not async_task.save_final_enhanced_image_only
 
-        for current_task_id, task in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
-            execution_start_time = time.perf_counter()
+        try:
+            current_task_id = 0
+            for task_batch in get_task_batches(async_task, goals, tasks, width, height):
+                current_batch_size = len(task_batch)
+                if current_batch_size > 1:
+                    progressbar(async_task, current_progress, f'Preparing tasks {current_task_id + 1}-{current_task_id + current_batch_size}/{async_task.image_number} ...')
+                else:
+                    progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
+                execution_start_time = time.perf_counter()
 
-            try:
-                imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
-                                                                 controlnet_cpds_path, current_task_id,
-                                                                 denoising_strength, final_scheduler_name, goals,
-                                                                 initial_latent, async_task.steps, switch, task['c'],
-                                                                 task['uc'], task, loras, tiled, use_expansion, width,
-                                                                 height, current_progress, preparation_steps,
-                                                                 async_task.image_number, show_intermediate_results,
-                                                                 persist_image)
-
-                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + 1))
-                images_to_enhance += imgs
+                try:
+                    if conditioning is not None:
+                        # encodes the prompts of the whole sampling batch together
+                        conditioning.require(current_task_id + current_batch_size - 1)
+                        for i in range(current_task_id, current_task_id + current_batch_size):
+                            conditioning.require(i)
+                    if current_batch_size > 1:
+                        imgs, current_progress = process_task_batch(all_steps, async_task, callback,
+                                                                    current_task_id, final_scheduler_name,
+                                                                    async_task.steps, switch, task_batch, loras,
+                                                                    use_expansion, width, height,
+                                                                    current_progress, preparation_steps,
+                                                                    async_task.image_number,
+                                                                    show_intermediate_results, persist_image,
+                                                                    post_processing)
+                    else:
+                        task = task_batch[0]
+                        imgs, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
+                                                              controlnet_cpds_path, current_task_id,
+                                                              denoising_strength, final_scheduler_name, goals,
+                                                              initial_latent, async_task.steps, switch, task['c'],
+                                                              task['uc'], task, loras, tiled, use_expansion, width,
+                                                              height, current_progress, preparation_steps,
+                                                              async_task.image_number, show_intermediate_results,
+                                                              persist_image, post_processing)
+
+                    current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + current_batch_size))
+                    images_to_enhance += imgs
 
-            except ldm_patched.modules.model_management.InterruptProcessingException:
-                if async_task.last_stop == 'skip':
-                    print('User skipped')
-                    async_task.last_stop = False
-                    continue
-                else:
-                    print('User stopped')
-                    break
+                except ldm_patched.modules.model_management.InterruptProcessingException:
+                    if async_task.last_stop == 'skip':
+                        print('User skipped')
+                        async_task.last_stop = False
+                        continue
+                    else:
+                        print('User stopped')
+                        break
+                finally:
+                    current_task_id += current_batch_size
 
-            del task['c'], task['uc']  # Save memory
-            execution_time = time.perf_counter() - execution_start_time
-            print(f'Generating and saving time: {execution_time:.2f} seconds')
+                for task in task_batch:
+                    del task['c'], task['uc']  # Save memory
+                execution_time = time.perf_counter() - execution_start_time
+                print(f'Generating and saving time: {execution_time:.2f} seconds')
+        finally:
+            if conditioning is not None:
+                conditioning.cancel()
+
+        current_batch_size = 1
+        post_processing.join()
 
         if not async_task.should_enhance:
             print(f'[Enhance] Skipping, preconditions aren\'t met')
@@ -1463,23 +1936,46 @@ def worker():
         return
 
     while True:
-        time.sleep(0.01)
-        if len(async_tasks) > 0:
-            task = async_tasks.pop(0)
-
+        task = async_tasks.get()
+        consumer_stats = async_tasks.consumer_stats()
+        print(f'[Queue] Task started after waiting {consumer_stats["wait_time_last"]:.2f} seconds, '
+              f'{len(async_tasks)} task(s) pending, {consumer_stats["model_switches_avoided"]} model switch(es) '
+              f'avoided.')
+
+        task_context.activate(task_context.TaskContext())
+        set_job_status(task, modules.job_journal.RUNNING)
+        try:
+            handler(task)
+            if task.generate_image_grid:
+                build_image_wall(task)
+            stopped = task.last_stop == 'stop'
+            set_job_status(task, modules.job_journal.STOPPED if stopped else modules.job_journal.FINISHED)
+            task.yields.append(['finish', task.results])
+            pipeline.prepare_text_encoder(async_call=True)
+        except:
+            traceback.print_exc()
             try:
-                handler(task)
-                if task.generate_image_grid:
-                    build_image_wall(task)
-                task.yields.append(['finish', task.results])
-                pipeline.prepare_text_encoder(async_call=True)
+                post_processing.join()
             except:
                 traceback.print_exc()
-                task.yields.append(['finish', task.results])
-            finally:
-                if pid in modules.patch.patch_settings:
-                    del modules.patch.patch_settings[pid]
+            set_job_status(task, modules.job_journal.FAILED)
+            task.yields.append(['finish', task.results])
+        finally:
+            task_context.activate(None)
     pass
 
 
 threading.Thread(target=worker, daemon=True).start()
+
+
+def start_worker_pool():
+    import args_manager
+    if args_manager.args.worker_devices is None:
+        return
+    import modules.worker_pool
+    devices = [d.strip() for d in args_manager.args.worker_devices.split(',') if d.strip() != '']
+    modules.worker_pool.start_pool(async_tasks, devices)
+
+
+start_worker_pool()
+resume_jobs()
@@ -0,0 +1,143 @@
+import os
+import threading
+from collections import OrderedDict
+
+from modules.result_cache import get_cache_key
+
+
+def save_value(value, path):
+    import torch
+    torch.save(value, path)
+
+
+def load_value(path):
+    import torch
+    # only tensors and plain containers of them are accepted
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+class ConditioningCache:
+    """
+    Least recently used cache of text encoder results that is kept across tasks.
+
+    Keys are JSON-serializable lists, typically the identity of the CLIP weights including their LoRAs, the CLIP skip
+    and the prompt text, and are stored by their hash. At most max_entries results are kept in memory. If path is
+    given, every result is also saved to a file there with torch.save, at most max_disk_entries of them, so that results
+    survive restarts and memory evictions; a result read from disk moves back to memory. Files are read with
+    weights_only, so a file placed in the directory by someone else cannot run code.
+    """
+
+    def __init__(self, max_entries=256, path=None, max_disk_entries=4096):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None:
+            self.load_index()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get_file_path(self, key_hash):
+        return os.path.join(self.path, f'{key_hash}.pt')
+
+    def load_index(self):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            for f in os.listdir(self.path):
+                if f.endswith('.pkl'):
+                    # pickled by earlier versions, never loaded again
+                    os.remove(os.path.join(self.path, f))
+            files = [f for f in os.listdir(self.path) if f.endswith('.pt')]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(self.path, f)))
+        except Exception as e:
+            print(f'[CLIP Cache] Cannot read {self.path}: {e}')
+            self.path = None
+            return
+        for f in files:
+            self.disk_entries[f[:-len('.pt')]] = True
+        self.evict()
+
+    def get(self, key):
+        key_hash = get_cache_key(key)
+        with self.lock:
+            value = self.entries.get(key_hash)
+            if value is not None:
+                self.entries.move_to_end(key_hash)
+                self.hits += 1
+                return value
+
+            if key_hash in self.disk_entries:
+                try:
+                    value = load_value(self.get_file_path(key_hash))
+                except Exception as e:
+                    print(f'[CLIP Cache] Cannot read cached result: {e}')
+                    self.remove_file(key_hash)
+                else:
+                    self.disk_entries.move_to_end(key_hash)
+                    self.entries[key_hash] = value
+                    self.disk_hits += 1
+                    self.evict()
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        key_hash = get_cache_key(key)
+        with self.lock:
+            self.entries[key_hash] = value
+            self.entries.move_to_end(key_hash)
+            if self.path is not None and key_hash not in self.disk_entries:
+                # readers in other processes see either no file or the complete one
+                file_path = self.get_file_path(key_hash)
+                temp_path = f'{file_path}.{os.getpid()}.tmp'
+                try:
+                    save_value(value, temp_path)
+                    os.replace(temp_path, file_path)
+                    self.disk_entries[key_hash] = True
+                except Exception as e:
+                    print(f'[CLIP Cache] Cannot save result: {e}')
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+            self.evict()
+
+    def remove_file(self, key_hash):
+        self.disk_entries.pop(key_hash, None)
+        try:
+            os.remove(self.get_file_path(key_hash))
+        except OSError:
+            pass
+
+    def evict(self):
+        while len(self.entries) > max(0, self.max_entries):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        while len(self.disk_entries) > max(0, self.max_disk_entries):
+            self.remove_file(next(iter(self.disk_entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return dict(
+                entries=len(self.entries),
+                disk_entries=len(self.disk_entries),
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                hit_rate=(self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+            )
@@ -9,8 +9,10 @@ import ldm_patched.modules.model_patcher
 import ldm_patched.modules.utils
 import ldm_patched.modules.controlnet
 import modules.sample_hijack
+import modules.task_context
 import ldm_patched.modules.samplers
 import ldm_patched.modules.latent_formats
+import args_manager
 
 from ldm_patched.modules.sd import load_checkpoint_guess_config
 from ldm_patched.contrib.external import VAEDecode, EmptyLatentImage, VAEEncode, VAEEncodeTiled, VAEDecodeTiled, \
@@ -18,7 +20,10 @@ from ldm_patched.contrib.external import VAEDecode, EmptyLatentImage, VAEEncode,
 from ldm_patched.contrib.external_freelunch import FreeU_V2
 from ldm_patched.modules.sample import prepare_mask
 from modules.lora import match_lora
+from modules.lora_merge import get_tensors_size, get_merged_weights
 from modules.util import get_file_from_folder_list
+from modules.memory_monitor import PeakMemoryMonitor
+from modules.model_cache import ModelCache
 from ldm_patched.modules.lora import model_lora_keys_unet, model_lora_keys_clip
 from modules.config import path_embeddings
 from ldm_patched.contrib.external_model_advanced import ModelSamplingDiscrete, ModelSamplingContinuousEDM
@@ -34,8 +39,42 @@ opModelSamplingDiscrete = ModelSamplingDiscrete()
 opModelSamplingContinuousEDM = ModelSamplingContinuousEDM()
 
 
+def create_split_checkpoint_cache():
+    if args_manager.args.split_checkpoint_cache is None:
+        return None
+    from modules.split_checkpoint_cache import SplitCheckpointCache
+    from modules.config import paths_checkpoints
+    path = args_manager.args.split_checkpoint_cache or \
+        os.path.join(os.path.dirname(os.path.abspath(paths_checkpoints[0])), 'checkpoints_split')
+    return SplitCheckpointCache(path)
+
+
+split_checkpoint_cache = create_split_checkpoint_cache()
+
+# parsed LoRA files and LoRA-merged weights of recent LoRA combinations, see StableDiffusionModel.refresh_loras
+lora_cache = ModelCache(max_bytes=int(args_manager.args.lora_cache_size * 1024 ** 3))
+merged_weight_cache = ModelCache(max_bytes=int(args_manager.args.lora_merge_cache_size * 1024 ** 3))
+
+
+def load_lora(lora_filename, lora_key_map_unet, lora_key_map_clip, architecture):
+    stat = os.stat(lora_filename)
+    # key maps only differ between model architectures, named by the class of the model config
+    key = (lora_filename, stat.st_mtime, stat.st_size, architecture)
+    cached = lora_cache.get(key)
+    if cached is not None:
+        return cached
+
+    lora_unmatch = ldm_patched.modules.utils.load_torch_file(lora_filename, safe_load=False)
+    lora_unet, lora_unmatch = match_lora(lora_unmatch, lora_key_map_unet)
+    lora_clip, lora_unmatch = match_lora(lora_unmatch, lora_key_map_clip)
+    result = lora_unet, lora_clip, lora_unmatch
+    lora_cache.put(key, result, get_tensors_size(result))
+    return result
+
+
 class StableDiffusionModel:
-    def __init__(self, unet=None, vae=None, clip=None, clip_vision=None, filename=None, vae_filename=None):
+    def __init__(self, unet=None, vae=None, clip=None, clip_vision=None, filename=None, vae_filename=None,
+                 lora_key_map_unet=None, lora_key_map_clip=None):
         self.unet = unet
         self.vae = vae
         self.clip = clip
@@ -45,15 +84,21 @@ class StableDiffusionModel:
         self.unet_with_lora = unet
         self.clip_with_lora = clip
         self.visited_loras = ''
+        # merged weight cache keys of the last LoRA combination per patcher, see get_merged_weights
+        self.merged_weights_keys = {}
 
         self.lora_key_map_unet = {}
         self.lora_key_map_clip = {}
 
-        if self.unet is not None:
+        if lora_key_map_unet is not None:
+            self.lora_key_map_unet = lora_key_map_unet
+        elif self.unet is not None:
             self.lora_key_map_unet = model_lora_keys_unet(self.unet.model, self.lora_key_map_unet)
             self.lora_key_map_unet.update({x: x for x in self.unet.model.state_dict().keys()})
 
-        if self.clip is not None:
+        if lora_key_map_clip is not None:
+            self.lora_key_map_clip = lora_key_map_clip
+        elif self.clip is not None:
             self.lora_key_map_clip = model_lora_keys_clip(self.clip.cond_stage_model, self.lora_key_map_clip)
             self.lora_key_map_clip.update({x: x for x in self.clip.cond_stage_model.state_dict().keys()})
 
@@ -91,11 +136,12 @@ class StableDiffusionModel:
 
         self.unet_with_lora = self.unet.clone() if self.unet is not None else None
         self.clip_with_lora = self.clip.clone() if self.clip is not None else None
+        clip_loras = []
 
         for lora_filename, weight in loras_to_load:
-            lora_unmatch = ldm_patched.modules.utils.load_torch_file(lora_filename, safe_load=False)
-            lora_unet, lora_unmatch = match_lora(lora_unmatch, self.lora_key_map_unet)
-            lora_clip, lora_unmatch = match_lora(lora_unmatch, self.lora_key_map_clip)
+            lora_unet, lora_clip, lora_unmatch = load_lora(lora_filename, self.lora_key_map_unet,
+                                                           self.lora_key_map_clip,
+                                                           type(self.unet.model.model_config).__name__)
 
             if len(lora_unmatch) > 12:
                 # model mismatch
@@ -115,12 +161,34 @@ class StableDiffusionModel:
 
             if self.clip_with_lora is not None and len(lora_clip) > 0:
                 loaded_keys = self.clip_with_lora.add_patches(lora_clip, weight)
+                clip_loras.append((lora_filename, os.path.getmtime(lora_filename), weight))
                 print(f'Loaded LoRA [{lora_filename}] for CLIP [{self.filename}] '
                       f'with {len(loaded_keys)} keys at weight {weight}.')
                 for item in lora_clip:
                     if item not in loaded_keys:
                         print("CLIP LoRA key skipped: ", item)
 
+        if self.clip_with_lora is not None:
+            # identifies the CLIP weights with their LoRAs for conditioning cached across tasks
+            self.clip_with_lora.cond_cache_key = [self.filename, os.path.getmtime(self.filename), clip_loras]
+
+        if len(loras_to_load) > 0 and not args_manager.args.runtime_lora:
+            loras_key = str(sorted(loras_to_load))
+            # a checkpoint replaced under the same name must not get the merged weights of the old file
+            stat = os.stat(self.filename)
+            model_key = (self.filename, stat.st_mtime, stat.st_size, self.vae_filename)
+            patchers = [('unet', self.unet_with_lora)]
+            if self.clip_with_lora is not None:
+                patchers.append(('clip', self.clip_with_lora.patcher))
+            for name, patcher in patchers:
+                if patcher is not None and len(patcher.patches) > 0:
+                    key = model_key + (name, loras_key)
+                    patcher.weight_cache = get_merged_weights(merged_weight_cache, patcher, key,
+                                                              self.merged_weights_keys.get(name))
+                    self.merged_weights_keys[name] = key
+        else:
+            self.merged_weights_keys = {}
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -144,9 +212,27 @@ def apply_controlnet(positive, negative, control_net, image, strength, start_per
 @torch.no_grad()
 @torch.inference_mode()
 def load_model(ckpt_filename, vae_filename=None):
-    unet, clip, vae, vae_filename, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=path_embeddings,
-                                                                vae_filename_param=vae_filename)
-    return StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, filename=ckpt_filename, vae_filename=vae_filename)
+    use_mmap = not args_manager.args.disable_mmap_loading
+    with PeakMemoryMonitor() as monitor:
+        cached = None
+        if split_checkpoint_cache is not None:
+            cached = split_checkpoint_cache.load(ckpt_filename, vae_filename, embedding_directory=path_embeddings,
+                                                 use_mmap=use_mmap)
+        if cached is not None:
+            unet, clip, vae, vae_filename, lora_key_map_unet, lora_key_map_clip = cached
+            model = StableDiffusionModel(unet=unet, clip=clip, vae=vae, filename=ckpt_filename,
+                                         vae_filename=vae_filename, lora_key_map_unet=lora_key_map_unet,
+                                         lora_key_map_clip=lora_key_map_clip)
+        else:
+            unet, clip, vae, vae_filename, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=path_embeddings,
+                                                                        vae_filename_param=vae_filename,
+                                                                        use_mmap=use_mmap)
+            model = StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, filename=ckpt_filename, vae_filename=vae_filename)
+    print(f'[Checkpoint] Loaded {ckpt_filename} in {monitor.summary()}.')
+
+    if cached is None and split_checkpoint_cache is not None:
+        split_checkpoint_cache.save(ckpt_filename, model, has_vae=vae_filename is None)
+    return model
 
 
 @torch.no_grad()
@@ -274,6 +360,10 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
 
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    elif isinstance(seed, list):
+        # one seed per batch item, so every sample gets the same noise as when it is sampled alone
+        noise = torch.cat([ldm_patched.modules.sample.prepare_noise(latent_image[i:i + 1], s)
+                           for i, s in enumerate(seed)], dim=0)
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
         noise = ldm_patched.modules.sample.prepare_noise(latent_image, seed, batch_inds)
@@ -301,9 +391,12 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
         if callback_function is not None:
             callback_function(previewer_start + step, x0, x, previewer_end, y)
 
+    sampling_seed = seed[0] if isinstance(seed, list) else seed
+
     disable_pbar = False
-    modules.sample_hijack.current_refiner = refiner
-    modules.sample_hijack.refiner_switch_step = refiner_switch
+    context = modules.task_context.current()
+    context.refiner = refiner
+    context.refiner_switch_step = refiner_switch
     ldm_patched.modules.samplers.sample = modules.sample_hijack.sample_hacked
 
     try:
@@ -315,12 +408,12 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
                                                     last_step=last_step,
                                                     force_full_denoise=force_full_denoise, noise_mask=noise_mask,
                                                     callback=callback,
-                                                    disable_pbar=disable_pbar, seed=seed, sigmas=sigmas)
+                                                    disable_pbar=disable_pbar, seed=sampling_seed, sigmas=sigmas)
 
         out = latent.copy()
         out["samples"] = samples
     finally:
-        modules.sample_hijack.current_refiner = None
+        context.refiner = None
 
     return out
 
@@ -1,16 +1,23 @@
 import modules.core as core
 import os
+import re
+import math
+import copy
 import torch
 import modules.patch
 import modules.config
 import modules.flags
 import ldm_patched.modules.model_management
 import ldm_patched.modules.latent_formats
-import modules.inpaint_worker
+import modules.task_context
 import extras.vae_interpose as vae_interpose
+import args_manager
 from extras.expansion import FooocusExpansion
 
+from ldm_patched.modules.embedding_index import get_embedding_index, refresh_embedding_indexes
 from ldm_patched.modules.model_base import SDXL, SDXLRefiner
+from modules.cond_cache import ConditioningCache
+from modules.model_cache import ModelCache
 from modules.sample_hijack import clip_separate
 from modules.util import get_file_from_folder_list, get_enabled_loras
 
@@ -27,6 +34,21 @@ final_refiner_vae = None
 
 loaded_ControlNets = {}
 
+checkpoint_cache = ModelCache(max_bytes=int(args_manager.args.checkpoint_cache_size * 1024 ** 3))
+
+
+def create_cond_cache():
+    if args_manager.args.clip_cache_size <= 0:
+        return None
+    path = args_manager.args.clip_cache
+    if path == '':
+        path = os.path.join(os.path.dirname(os.path.abspath(modules.config.paths_checkpoints[0])), 'clip_cache')
+    return ConditioningCache(max_entries=args_manager.args.clip_cache_size, path=path)
+
+
+# text encoder results of earlier tasks, see clip_encode_single
+cond_cache = create_cond_cache()
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -57,6 +79,33 @@ def assert_model_integrity():
     return True
 
 
+def get_model_size(model):
+    components = [
+        model.unet.model if model.unet is not None else None,
+        model.clip.cond_stage_model if model.clip is not None else None,
+        model.vae.first_stage_model if model.vae is not None else None,
+        model.clip_vision.model if model.clip_vision is not None else None
+    ]
+    return sum(ldm_patched.modules.model_management.module_size(m) for m in components if m is not None)
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def load_checkpoint(filename, vae_filename=None):
+    key = (filename, vae_filename)
+    model = checkpoint_cache.get(key)
+    if model is not None:
+        print(f'[Checkpoint Cache] Using {filename} from RAM.')
+        return model
+
+    model = core.load_model(filename, vae_filename)
+    if checkpoint_cache.max_bytes > 0:
+        size = get_model_size(model)
+        if not checkpoint_cache.put(key, model, size):
+            print(f'[Checkpoint Cache] {filename} ({size / 1024 ** 3:.2f} GB) exceeds the cache size.')
+    return model
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def refresh_base_model(name, vae_name=None):
@@ -71,7 +120,7 @@ def refresh_base_model(name, vae_name=None):
     if model_base.filename == filename and model_base.vae_filename == vae_filename:
         return
 
-    model_base = core.load_model(filename, vae_filename)
+    model_base = load_checkpoint(filename, vae_filename)
     print(f'Base model loaded: {model_base.filename}')
     print(f'VAE loaded: {model_base.vae_filename}')
     return
@@ -93,7 +142,8 @@ def refresh_refiner_model(name):
         print(f'Refiner unloaded.')
         return
 
-    model_refiner = core.load_model(filename)
+    # the cached model may also be used as base model later, so its components are dropped on a copy
+    model_refiner = copy.copy(load_checkpoint(filename))
     print(f'Refiner model loaded: {model_refiner.filename}')
 
     if isinstance(model_refiner.unet.model, SDXL):
@@ -142,22 +192,88 @@ def refresh_loras(loras, base_model_additional_loras=None):
     return
 
 
+def get_embedding_files(text):
+    # the file and mtime of every embedding the text may reference, or None for names without a file, so that
+    # changing, adding or removing an embedding changes the key
+    if 'embedding:' not in text:
+        return []
+    index = get_embedding_index(modules.config.path_embeddings)
+    files = []
+    for name in re.findall(r'embedding:([^\s()]+)', text):
+        path = None
+        for candidate in [name, name.strip(','), name.rsplit(':', 1)[0]]:
+            path = index.find(candidate)
+            if path is not None:
+                break
+        files.append([name, path, index.mtimes.get(path)])
+    return files
+
+
+def get_cond_cache_key(clip, text):
+    # clips without an identity, such as ones patched outside of refresh_loras, are only cached within a task
+    if cond_cache is None or getattr(clip, 'cond_cache_key', None) is None:
+        return None
+    return [clip.cond_cache_key, clip.layer_idx, text, get_embedding_files(text)]
+
+
+def get_cached_cond(clip, text):
+    cached = clip.fcs_cond_cache.get(text, None)
+    if cached is not None:
+        return cached
+
+    cache_key = get_cond_cache_key(clip, text)
+    if cache_key is not None:
+        cached = cond_cache.get(cache_key)
+        if cached is not None:
+            clip.fcs_cond_cache[text] = cached
+    return cached
+
+
+def put_cached_cond(clip, text, result):
+    clip.fcs_cond_cache[text] = result
+    cache_key = get_cond_cache_key(clip, text)
+    if cache_key is not None:
+        cond_cache.put(cache_key, result)
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode_single(clip, text, verbose=False):
-    cached = clip.fcs_cond_cache.get(text, None)
+    cached = get_cached_cond(clip, text)
     if cached is not None:
         if verbose:
             print(f'[CLIP Cached] {text}')
         return cached
+
     tokens = clip.tokenize(text)
     result = clip.encode_from_tokens(tokens, return_pooled=True)
-    clip.fcs_cond_cache[text] = result
+    put_cached_cond(clip, text, result)
     if verbose:
         print(f'[CLIP Encoded] {text}')
     return result
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_batch(texts, verbose=False):
+    """Encodes the texts not cached yet together and caches them, so that clip_encode finds all of them."""
+    global final_clip
+
+    if final_clip is None:
+        return None
+
+    missing = [text for text in dict.fromkeys(texts) if get_cached_cond(final_clip, text) is None]
+    if len(missing) > 0:
+        tokens_list = [final_clip.tokenize(text) for text in missing]
+        results = final_clip.encode_from_tokens_batch(tokens_list, return_pooled=True)
+        for text, result in zip(missing, results):
+            put_cached_cond(final_clip, text, result)
+        if verbose:
+            print(f'[CLIP Encoded] {len(missing)} prompts in one batch')
+
+    return [final_clip.fcs_cond_cache[text] for text in texts]
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def clone_cond(conds):
@@ -177,6 +293,25 @@ def clone_cond(conds):
     return results
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def stack_conds(conds_list):
+    results = []
+
+    for entries in zip(*conds_list):
+        cond_list = [c for c, p in entries]
+
+        # padding with repeat doesn't change result, same as CONDCrossAttn.concat
+        crossattn_max_len = math.lcm(*[int(c.shape[1]) for c in cond_list])
+        cond_list = [c.repeat(1, crossattn_max_len // c.shape[1], 1) if c.shape[1] < crossattn_max_len else c
+                     for c in cond_list]
+
+        pooled = torch.cat([p["pooled_output"] for c, p in entries], dim=0)
+        results.append([torch.cat(cond_list, dim=0), {"pooled_output": pooled}])
+
+    return results
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode(texts, pool_top_k=1):
@@ -268,6 +403,10 @@ def refresh_everything(refiner_model_name, base_model_name, loras,
     if final_expansion is None:
         final_expansion = FooocusExpansion()
 
+    # built at startup, afterwards only rescanned when embedding files changed, tokenizing does not touch the disk
+    get_embedding_index(modules.config.path_embeddings)
+    refresh_embedding_indexes()
+
     prepare_text_encoder(async_call=True)
     clear_all_caches()
     return
@@ -337,6 +476,26 @@ def get_candidate_vae(steps, switch, denoise=1.0, refiner_swap_method='joint'):
     return final_vae, final_refiner_vae
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def get_sampling_batch_size(width, height, max_batch_size=0):
+    device = ldm_patched.modules.model_management.get_torch_device()
+
+    free_memory = ldm_patched.modules.model_management.get_free_memory(device)
+    free_memory -= ldm_patched.modules.model_management.LoadedModel(final_unet).model_memory_required(device)
+    free_memory -= ldm_patched.modules.model_management.minimum_inference_memory()
+
+    # cond and uncond are evaluated together, so every image costs two UNet batch items
+    memory_per_image = final_unet.memory_required([2, 4, height // 8, width // 8])
+    batch_size = max(1, int(free_memory // memory_per_image))
+
+    if max_batch_size > 0:
+        batch_size = min(batch_size, max_batch_size)
+
+    print(f'[Sampler] batch size = {batch_size}')
+    return batch_size
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def process_diffusion(positive_cond, negative_cond, steps, switch, width, height, image_seed, callback, sampler_name, scheduler_name, latent=None, denoise=1.0, tiled=False, cfg_scale=7.0, refiner_swap_method='joint', disable_preview=False):
@@ -364,8 +523,11 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     print(f'[Sampler] refiner_swap_method = {refiner_swap_method}')
 
+    # a list of seeds samples one image per seed in a single batch
+    batch_size = len(image_seed) if isinstance(image_seed, list) else 1
+
     if latent is None:
-        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=1)
+        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=batch_size)
     else:
         initial_latent = latent
 
@@ -449,10 +611,10 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
         decoded_latent = core.decode_vae(vae=target_model, latent_image=sampled_latent, tiled=tiled)
 
     if refiner_swap_method == 'vae':
-        modules.patch.patch_settings[os.getpid()].eps_record = 'vae'
+        modules.task_context.current().patch_settings.eps_record = 'vae'
 
-        if modules.inpaint_worker.current_task is not None:
-            modules.inpaint_worker.current_task.unswap()
+        if modules.task_context.current().inpaint_task is not None:
+            modules.task_context.current().inpaint_task.unswap()
 
         sampled_latent = core.ksampler(
             model=target_unet,
@@ -487,10 +649,10 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
                                   denoise=denoise)[switch:] * k_sigmas
         len_sigmas = len(sigmas) - 1
 
-        noise_mean = torch.mean(modules.patch.patch_settings[os.getpid()].eps_record, dim=1, keepdim=True)
+        noise_mean = torch.mean(modules.task_context.current().patch_settings.eps_record, dim=1, keepdim=True)
 
-        if modules.inpaint_worker.current_task is not None:
-            modules.inpaint_worker.current_task.swap()
+        if modules.task_context.current().inpaint_task is not None:
+            modules.task_context.current().inpaint_task.swap()
 
         sampled_latent = core.ksampler(
             model=target_model,
@@ -498,7 +660,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
             negative=clip_separate(negative_cond, target_model=target_model.model, target_clip=target_clip),
             latent=sampled_latent,
             steps=len_sigmas, start_step=0, last_step=len_sigmas, disable_noise=False, force_full_denoise=True,
-            seed=image_seed+1,
+            seed=[s + 1 for s in image_seed] if isinstance(image_seed, list) else image_seed + 1,
             denoise=denoise,
             callback_function=callback,
             cfg=cfg_scale,
@@ -517,5 +679,5 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
         decoded_latent = core.decode_vae(vae=target_model, latent_image=sampled_latent, tiled=tiled)
 
     images = core.pytorch_to_numpy(decoded_latent)
-    modules.patch.patch_settings[os.getpid()].eps_record = None
+    modules.task_context.current().patch_settings.eps_record = None
     return images
@@ -53,6 +53,12 @@ SAMPLER_EXTRA = {
 
 SAMPLERS = KSAMPLER | SAMPLER_EXTRA
 
+# samplers that are deterministic or draw their noise from the per-seed Brownian tree,
+# so sampling several seeds in one batch gives the same images as sampling them one by one
+BATCHABLE_SAMPLERS = ["euler", "heun", "heunpp2", "dpm_2", "lms", "dpmpp_sde", "dpmpp_sde_gpu", "dpmpp_2m",
+                      "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddim", "uni_pc",
+                      "uni_pc_bh2"]
+
 KSAMPLER_NAMES = list(KSAMPLER.keys())
 
 SCHEDULER_NAMES = ["normal", "karras", "exponential", "sgm_uniform", "simple", "ddim_uniform", "lcm", "turbo", "align_your_steps", "tcd", "edm_playground_v2.5"]
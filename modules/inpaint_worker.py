@@ -20,9 +20,6 @@ class InpaintHead(torch.nn.Module):
         return torch.nn.functional.conv2d(input=x, weight=self.head)
 
 
-current_task = None
-
-
 def box_blur(x, k):
     x = Image.fromarray(x)
     x = x.filter(ImageFilter.BoxBlur(k))
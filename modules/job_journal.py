@@ -0,0 +1,130 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+STOPPED = 'stopped'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+# jobs in these states were interrupted by a crash or restart and are picked up again on startup
+unfinished_statuses = (QUEUED, RUNNING)
+
+
+def encode_value(value):
+    # job parameters are stored as JSON, arrays such as input images as their raw bytes
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return dict(__ndarray__=base64.b64encode(np.ascontiguousarray(value).tobytes()).decode('ascii'),
+                    dtype=value.dtype.str, shape=list(value.shape))
+    if isinstance(value, dict):
+        return {str(k): encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f'Cannot store {type(value).__name__} in the journal')
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            data = base64.b64decode(value['__ndarray__'])
+            return np.frombuffer(data, dtype=np.dtype(value['dtype'])).reshape(value['shape']).copy()
+        return {k: decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    return value
+
+
+class JobJournal:
+    """
+    Durable record of submitted jobs in a SQLite database.
+
+    A job is stored with its parameters as JSON when it is queued, and every saved image is recorded with its index,
+    seed and output path as soon as it is written. Each change is committed on its own, so after a crash the journal
+    knows which jobs were unfinished and which of their images already exist. Several processes may share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                    'id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, '
+                                    'updated REAL NOT NULL, image_number INTEGER NOT NULL, state BLOB NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS images ('
+                                    'job_id TEXT NOT NULL, image_index INTEGER NOT NULL, seed INTEGER, '
+                                    'path TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (job_id, image_index))')
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def add_job(self, state, image_number, job_id=None):
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO jobs (id, status, created, updated, image_number, state) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     (job_id, QUEUED, now, now, int(image_number), json.dumps(encode_value(state))))
+        return job_id
+
+    def set_status(self, job_id, status):
+        self.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?', (status, time.time(), job_id))
+
+    def get_status(self, job_id):
+        rows = self.execute('SELECT status FROM jobs WHERE id = ?', (job_id,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def add_image(self, job_id, image_index, seed, path):
+        self.execute('INSERT OR REPLACE INTO images (job_id, image_index, seed, path, created) VALUES (?, ?, ?, ?, ?)',
+                     (job_id, int(image_index), seed, path, time.time()))
+
+    def get_images(self, job_id):
+        rows = self.execute('SELECT image_index, path FROM images WHERE job_id = ? ORDER BY image_index', (job_id,))
+        return {image_index: path for image_index, path in rows}
+
+    def get_unfinished_jobs(self):
+        placeholders = ', '.join('?' for _ in unfinished_statuses)
+        rows = self.execute(f'SELECT id, state FROM jobs WHERE status IN ({placeholders}) ORDER BY created',
+                            unfinished_statuses)
+        jobs = []
+        for job_id, state in rows:
+            try:
+                jobs.append((job_id, decode_value(json.loads(state))))
+            except Exception as e:
+                print(f'[Journal] Cannot restore job {job_id}: {e}')
+                self.set_status(job_id, FAILED)
+        return jobs
+
+    def remove_finished_jobs(self, max_age):
+        cutoff = time.time() - max_age
+        placeholders = ', '.join('?' for _ in unfinished_statuses)
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.execute(f'DELETE FROM images WHERE job_id IN (SELECT id FROM jobs WHERE updated < ? '
+                                        f'AND status NOT IN ({placeholders}))', (cutoff,) + unfinished_statuses)
+                removed = self.connection.execute(f'DELETE FROM jobs WHERE updated < ? '
+                                                  f'AND status NOT IN ({placeholders})',
+                                                  (cutoff,) + unfinished_statuses).rowcount
+                self.connection.execute('COMMIT')
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
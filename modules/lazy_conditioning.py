@@ -0,0 +1,74 @@
+import threading
+
+import modules.task_context as task_context
+
+
+class LazyConditioning:
+    """
+    Encodes the prompts of a list of tasks on demand.
+
+    encode(index, task) fills in the conditioning of one task. With background=True a thread encodes the tasks in
+    order while the caller samples the earlier ones. Otherwise a request for a task that is not ready yet encodes the
+    tasks up to it on the calling thread, between its sampling batches. prepare(tasks), if given, is called first
+    with those tasks when there are several of them, to encode their prompts in one batch.
+    """
+
+    def __init__(self, tasks, encode, background=False, prepare=None):
+        self.tasks = tasks
+        self.encode = encode
+        self.background = background
+        self.prepare = prepare
+        self.ready = [threading.Event() for _ in tasks]
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.cancelled = False
+        self.thread = None
+
+    def encode_next(self):
+        with self.lock:
+            index = self.next_index
+            if self.cancelled or index >= len(self.tasks):
+                return False
+            self.next_index += 1
+        try:
+            self.encode(index, self.tasks[index])
+        except BaseException as e:
+            self.errors[index] = e
+        finally:
+            self.ready[index].set()
+        return True
+
+    def start(self):
+        if not self.background:
+            return self
+        context = task_context.current()
+
+        def run():
+            task_context.activate(context)
+            while self.encode_next():
+                pass
+            task_context.activate(None)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+    def require(self, index):
+        if not self.ready[index].is_set() and self.thread is None:
+            with self.lock:
+                pending = self.tasks[self.next_index:index + 1]
+            if self.prepare is not None and len(pending) > 1 and not self.cancelled:
+                self.prepare(pending)
+            while not self.ready[index].is_set() and self.encode_next():
+                pass
+        self.ready[index].wait()
+        if index in self.errors:
+            raise self.errors[index]
+        return self.tasks[index]
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,136 @@
+import torch
+
+import ldm_patched.modules.model_management as model_management
+from ldm_patched.modules.model_patcher import patches_equal
+
+# upper bound of the float32 memory one batch of weights and LoRA products may take on the merge device
+max_batch_bytes = 512 * 1024 ** 2
+
+
+def get_lora_shape(patches, weight):
+    """
+    Returns the (out, in) shape of the flattened weight if all patches are plain LoRAs at model strength 1, which can
+    be summed up as one low rank product. Returns None for anything else, those keys are merged one by one.
+    """
+    out_features = weight.shape[0]
+    in_features = weight.numel() // out_features
+    for alpha, v, strength_model in patches:
+        if strength_model != 1.0 or isinstance(v, list) or len(v) != 2 or v[0] != 'lora':
+            return None
+        mat1, mat2, _, mat3 = v[1][:4]
+        if mat3 is not None or mat1.shape[0] != out_features or mat2.numel() // mat2.shape[0] != in_features \
+                or mat1.numel() // mat1.shape[0] != mat2.shape[0]:
+            return None
+    return out_features, in_features
+
+
+def get_low_rank_factors(patches, device):
+    # the sum of alpha * up @ down over all patches is [alpha * up_1, ..., alpha * up_n] @ [down_1; ...; down_n]
+    ups = []
+    downs = []
+    for alpha, v, _ in patches:
+        mat1, mat2, lora_alpha = v[1][:3]
+        if lora_alpha is not None:
+            alpha *= lora_alpha / mat2.shape[0]
+        ups.append(model_management.cast_to_device(mat1, device, torch.float32).flatten(start_dim=1) * alpha)
+        downs.append(model_management.cast_to_device(mat2, device, torch.float32).flatten(start_dim=1))
+    return torch.cat(ups, dim=1), torch.cat(downs, dim=0)
+
+
+def get_batch_size(shape, rank, device):
+    out_features, in_features = shape
+    # merged weights plus the zero padded factors of one key in float32
+    key_bytes = 4 * (out_features * in_features + (out_features + in_features) * rank)
+    budget = max_batch_bytes
+    if device.type != 'cpu':
+        budget = min(budget, model_management.get_free_memory(device) // 4)
+    return max(1, int(budget // key_bytes))
+
+
+def calculate_weights_batched(self, keys, model_sd, device_to=None):
+    """
+    Replacement of ModelPatcher.calculate_weights that merges keys patched only by plain LoRAs in batches.
+
+    Such keys are grouped by their flattened weight shape, all LoRAs of a key are concatenated into one low rank
+    product, and each batch of keys is merged with a single baddbmm on the load device. Batches are sized so that
+    their float32 buffers stay below max_batch_bytes. Keys with other patch types are merged one by one as before.
+    """
+    groups = {}
+    for key in keys:
+        weight = model_sd[key]
+        shape = get_lora_shape(self.patches[key], weight)
+        if shape is None:
+            yield key, self.calculate_key_weight(key, weight, device_to)
+        else:
+            groups.setdefault(shape, []).append(key)
+
+    for shape, group_keys in groups.items():
+        device = device_to if device_to is not None else model_sd[group_keys[0]].device
+        rank = max(sum(v[1][1].shape[0] for _, v, _ in self.patches[key]) for key in group_keys)
+        batch_size = get_batch_size(shape, rank, device)
+
+        for i in range(0, len(group_keys), batch_size):
+            batch_keys = group_keys[i:i + batch_size]
+            factors = [get_low_rank_factors(self.patches[key], device) for key in batch_keys]
+            batch_rank = max(up.shape[1] for up, _ in factors)
+            ups = torch.zeros((len(batch_keys), shape[0], batch_rank), dtype=torch.float32, device=device)
+            downs = torch.zeros((len(batch_keys), batch_rank, shape[1]), dtype=torch.float32, device=device)
+            for j, (up, down) in enumerate(factors):
+                ups[j, :, :up.shape[1]] = up
+                downs[j, :down.shape[0]] = down
+            del factors
+
+            merged = torch.stack([model_management.cast_to_device(model_sd[key], device, torch.float32).reshape(shape)
+                                  for key in batch_keys])
+            merged.baddbmm_(ups, downs)
+            del ups, downs
+
+            for j, key in enumerate(batch_keys):
+                weight = model_sd[key]
+                yield key, merged[j].reshape(weight.shape).to(dtype=weight.dtype, copy=True)
+            del merged
+
+
+def get_tensors_size(value):
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, dict):
+        return sum(get_tensors_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_tensors_size(v) for v in value)
+    return 0
+
+
+def reuse_merged_weights(patcher, previous):
+    # keys whose patches are the same as in the previous LoRA combination of the model keep their merged weights
+    if previous is None:
+        return {}
+    weights = {k: v for k, v in previous.items() if k in patcher.patches and patches_equal(v[0], patcher.patches[k])}
+    if len(weights) > 0:
+        print(f'[LoRA] Reusing {len(weights)} of {len(patcher.patches)} merged weights.')
+    return weights
+
+
+def get_merged_weights(cache, patcher, key, previous_key=None):
+    """
+    Returns the dict of merged weights for patcher.weight_cache, kept in cache under key, or None if the cache is
+    disabled or the weights do not fit its budget. A new entry starts with the weights of the entry of previous_key
+    whose patches did not change, the others are filled in by patch_model.
+
+    The entry is counted with every weight it refers to, also the reused ones, which stay alive with it when the
+    entry they were computed for is evicted.
+    """
+    if cache.max_bytes <= 0:
+        return None
+    weights = cache.get(key)
+    if weights is not None:
+        return weights
+
+    weights = reuse_merged_weights(patcher, cache.peek(previous_key) if previous_key is not None else None)
+    # the exact size is known before the weights are computed
+    model_sd = patcher.model_state_dict()
+    size = sum(get_tensors_size(model_sd[k]) for k in patcher.patches if k in model_sd)
+    if not cache.put(key, weights, size):
+        print(f'[LoRA] Merged weights of {size / (1024 ** 2):.0f} MB do not fit the merge cache.')
+        return None
+    return weights
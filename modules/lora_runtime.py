@@ -0,0 +1,33 @@
+import torch
+
+import ldm_patched.modules.utils
+from modules.lora_merge import get_lora_shape, get_low_rank_factors
+
+
+def patch_weight_at_runtime(self, key, device_to=None):
+    """
+    Replacement of ModelPatcher.patch_weight_at_runtime that leaves the weights of LoRA patched layers untouched.
+
+    All LoRAs of a Linear or Conv2d weight are folded into one up and down matrix that the layer applies as a side
+    branch in forward. Nothing is merged or backed up, so switching LoRAs only costs these small matrices, while
+    every forward pass pays two extra low rank products. Keys with other patch types are still merged.
+    """
+    if not key.endswith('.weight'):
+        return False
+    module = ldm_patched.modules.utils.get_attr(self.model, key[:-len('.weight')])
+    if not hasattr(module, 'lora_branch'):
+        return False
+    if isinstance(module, torch.nn.Conv2d) and (module.groups != 1 or module.padding_mode != 'zeros'):
+        return False
+
+    weight = module.weight
+    if get_lora_shape(self.patches[key], weight) is None:
+        return False
+
+    up, down = get_low_rank_factors(self.patches[key], self.load_device)
+    if weight.ndim == 4:
+        up = up.reshape(up.shape[0], up.shape[1], 1, 1)
+        down = down.reshape(down.shape[0], *weight.shape[1:])
+    module.lora_branch = (up.to(weight.dtype), down.to(weight.dtype))
+    self.runtime_patched_modules.append(module)
+    return True
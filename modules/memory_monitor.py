@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+def get_process_rss():
+    import psutil
+    return psutil.Process().memory_info().rss
+
+
+class PeakMemoryMonitor:
+    """
+    Samples the resident set size of the process on a background thread while the with block runs.
+
+    After the block, elapsed is its duration in seconds and peak_rss the largest RSS seen in bytes, including the
+    values at entry and exit. The sampling interval bounds how short a peak can be and still be noticed.
+    """
+
+    def __init__(self, interval=0.05, read_rss=get_process_rss):
+        self.interval = interval
+        self.read_rss = read_rss
+        self.start_rss = 0
+        self.peak_rss = 0
+        self.end_rss = 0
+        self.elapsed = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def sample(self):
+        rss = self.read_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start_rss = self.sample()
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.start_time
+        self.end_rss = self.sample()
+        return False
+
+    def summary(self):
+        gb = 1024 ** 3
+        return f'{self.elapsed:.2f} seconds, peak RSS {self.peak_rss / gb:.2f} GB ' \
+               f'(+{(self.peak_rss - self.start_rss) / gb:.2f} GB while loading, ' \
+               f'+{(self.end_rss - self.start_rss) / gb:.2f} GB kept)'
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+
+class ModelCache:
+    """
+    Least recently used cache of loaded models, LoRAs or weights kept in RAM.
+
+    Entries are stored with their size in bytes. Once the sizes add up to more than max_bytes the least recently used
+    entries are dropped, so that they are freed as soon as nothing else refers to them. An entry larger than the
+    whole budget is not cached. With max_bytes=0 the cache is disabled.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        # lookup that neither counts as a hit or miss nor changes the eviction order
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, model, size):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return False
+            self.entries[key] = (model, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                entries=len(self.entries),
+                total_bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions
+            )
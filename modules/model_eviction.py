@@ -0,0 +1,38 @@
+class CostAwareEvictionPolicy:
+    """
+    Eviction policy for model_management.free_memory that unloads the models cheapest to bring back first.
+
+    The value of a loaded model is the time its last load took per GB, divided by one plus the number of loads since
+    it was last requested, and multiplied by needed_soon_weight if needed_soon() returns its torch module. Models
+    with the lowest value are unloaded first, ties keep least recently used order. A model without a measured load
+    time is assumed to load at default_bandwidth bytes per second, so without measurements this is plain LRU.
+    """
+
+    name = 'cost'
+
+    def __init__(self, needed_soon=None, needed_soon_weight=4.0, default_bandwidth=2 * 1024 ** 3):
+        self.needed_soon = needed_soon
+        self.needed_soon_weight = needed_soon_weight
+        self.default_bandwidth = default_bandwidth
+
+    def get_needed_soon(self):
+        if self.needed_soon is None:
+            return []
+        try:
+            return list(self.needed_soon())
+        except Exception as e:
+            print(f'[Memory] Cannot get the models needed by queued tasks: {e}')
+            return []
+
+    def get_value(self, candidate, clock, needed):
+        size = max(candidate.model_memory(), 1)
+        load_time = candidate.load_time if candidate.load_time is not None else size / self.default_bandwidth
+        value = load_time * 1024 ** 3 / size
+        value /= 1 + max(0, clock - candidate.last_used)
+        if any(getattr(candidate.model, 'model', None) is model for model in needed):
+            value *= self.needed_soon_weight
+        return value
+
+    def order(self, candidates, clock):
+        needed = self.get_needed_soon()
+        return sorted(candidates, key=lambda candidate: self.get_value(candidate, clock, needed))
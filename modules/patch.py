@@ -9,7 +9,7 @@ import modules.anisotropic as anisotropic
 import ldm_patched.ldm.modules.attention
 import ldm_patched.k_diffusion.sampling
 import ldm_patched.modules.sd1_clip
-import modules.inpaint_worker as inpaint_worker
+import modules.task_context as task_context
 import ldm_patched.ldm.modules.diffusionmodules.openaimodel
 import ldm_patched.ldm.modules.diffusionmodules.model
 import ldm_patched.modules.sd
@@ -20,12 +20,15 @@ import ldm_patched.modules.args_parser
 import warnings
 import safetensors.torch
 import modules.constants as constants
+import args_manager
 
 from ldm_patched.modules.samplers import calc_cond_uncond_batch
 from ldm_patched.k_diffusion.sampling import BatchedBrownianTree
 from ldm_patched.ldm.modules.diffusionmodules.openaimodel import forward_timestep_embed, apply_control
 from modules.patch_precision import patch_all_precision
 from modules.patch_clip import patch_all_clip
+from modules.lora_merge import calculate_weights_batched
+from modules.lora_runtime import patch_weight_at_runtime
 
 
 class PatchSettings:
@@ -46,8 +49,6 @@ class PatchSettings:
         self.eps_record = None
 
 
-patch_settings = {}
-
 
 def calculate_weight_patched(self, patches, weight, key):
     for p in patches:
@@ -210,13 +211,13 @@ class BrownianTreeNoiseSamplerPatched:
 
 
 def compute_cfg(uncond, cond, cfg_scale, t):
-    pid = os.getpid()
-    mimic_cfg = float(patch_settings[pid].adaptive_cfg)
+    settings = task_context.current().patch_settings
+    mimic_cfg = float(settings.adaptive_cfg)
     real_cfg = float(cfg_scale)
 
     real_eps = uncond + real_cfg * (cond - uncond)
 
-    if cfg_scale > patch_settings[pid].adaptive_cfg:
+    if cfg_scale > settings.adaptive_cfg:
         mimicked_eps = uncond + mimic_cfg * (cond - uncond)
         return real_eps * t + mimicked_eps * (1 - t)
     else:
@@ -224,13 +225,13 @@ def compute_cfg(uncond, cond, cfg_scale, t):
 
 
 def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options=None, seed=None):
-    pid = os.getpid()
+    settings = task_context.current().patch_settings
 
     if math.isclose(cond_scale, 1.0) and not model_options.get("disable_cfg1_optimization", False):
         final_x0 = calc_cond_uncond_batch(model, cond, None, x, timestep, model_options)[0]
 
-        if patch_settings[pid].eps_record is not None:
-            patch_settings[pid].eps_record = ((x - final_x0) / timestep).cpu()
+        if settings.eps_record is not None:
+            settings.eps_record = ((x - final_x0) / timestep).cpu()
 
         return final_x0
 
@@ -239,16 +240,16 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
     positive_eps = x - positive_x0
     negative_eps = x - negative_x0
 
-    alpha = 0.001 * patch_settings[pid].sharpness * patch_settings[pid].global_diffusion_progress
+    alpha = 0.001 * settings.sharpness * settings.global_diffusion_progress
 
     positive_eps_degraded = anisotropic.adaptive_anisotropic_filter(x=positive_eps, g=positive_x0)
     positive_eps_degraded_weighted = positive_eps_degraded * alpha + positive_eps * (1.0 - alpha)
 
     final_eps = compute_cfg(uncond=negative_eps, cond=positive_eps_degraded_weighted,
-                            cfg_scale=cond_scale, t=patch_settings[pid].global_diffusion_progress)
+                            cfg_scale=cond_scale, t=settings.global_diffusion_progress)
 
-    if patch_settings[pid].eps_record is not None:
-        patch_settings[pid].eps_record = (final_eps / timestep).cpu()
+    if settings.eps_record is not None:
+        settings.eps_record = (final_eps / timestep).cpu()
 
     return x - final_eps
 
@@ -268,14 +269,14 @@ def sdxl_encode_adm_patched(self, **kwargs):
     height = kwargs.get("height", 1024)
     target_width = width
     target_height = height
-    pid = os.getpid()
+    settings = task_context.current().patch_settings
 
     if kwargs.get("prompt_type", "") == "negative":
-        width = float(width) * patch_settings[pid].negative_adm_scale
-        height = float(height) * patch_settings[pid].negative_adm_scale
+        width = float(width) * settings.negative_adm_scale
+        height = float(height) * settings.negative_adm_scale
     elif kwargs.get("prompt_type", "") == "positive":
-        width = float(width) * patch_settings[pid].positive_adm_scale
-        height = float(height) * patch_settings[pid].positive_adm_scale
+        width = float(width) * settings.positive_adm_scale
+        height = float(height) * settings.positive_adm_scale
 
     def embedder(number_list):
         h = self.embedder(torch.tensor(number_list, dtype=torch.float32))
@@ -295,10 +296,10 @@ def sdxl_encode_adm_patched(self, **kwargs):
 
 
 def patched_KSamplerX0Inpaint_forward(self, x, sigma, uncond, cond, cond_scale, denoise_mask, model_options={}, seed=None):
-    if inpaint_worker.current_task is not None:
+    if task_context.current().inpaint_task is not None:
         latent_processor = self.inner_model.inner_model.process_latent_in
-        inpaint_latent = latent_processor(inpaint_worker.current_task.latent).to(x)
-        inpaint_mask = inpaint_worker.current_task.latent_mask.to(x)
+        inpaint_latent = latent_processor(task_context.current().inpaint_task.latent).to(x)
+        inpaint_mask = task_context.current().inpaint_task.latent_mask.to(x)
 
         if getattr(self, 'energy_generator', None) is None:
             # avoid bad results by using different seeds.
@@ -329,7 +330,7 @@ def patched_KSamplerX0Inpaint_forward(self, x, sigma, uncond, cond, cond_scale,
 
 def timed_adm(y, timesteps):
     if isinstance(y, torch.Tensor) and int(y.dim()) == 2 and int(y.shape[1]) == 5632:
-        y_mask = (timesteps > 999.0 * (1.0 - float(patch_settings[os.getpid()].adm_scaler_end))).to(y)[..., None]
+        y_mask = (timesteps > 999.0 * (1.0 - float(task_context.current().patch_settings.adm_scaler_end))).to(y)[..., None]
         y_with_adm = y[..., :2816].clone()
         y_without_adm = y[..., 2816:].clone()
         return y_with_adm * y_mask + y_without_adm * (1.0 - y_mask)
@@ -339,7 +340,7 @@ def timed_adm(y, timesteps):
 def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
     t_emb = ldm_patched.ldm.modules.diffusionmodules.openaimodel.timestep_embedding(timesteps, self.model_channels, repeat_only=False).to(x.dtype)
     emb = self.time_embed(t_emb)
-    pid = os.getpid()
+    settings = task_context.current().patch_settings
 
     guided_hint = self.input_hint_block(hint, emb, context)
 
@@ -365,17 +366,17 @@ def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
     h = self.middle_block(h, emb, context)
     outs.append(self.middle_block_out(h, emb, context))
 
-    if patch_settings[pid].controlnet_softness > 0:
+    if settings.controlnet_softness > 0:
         for i in range(10):
             k = 1.0 - float(i) / 9.0
-            outs[i] = outs[i] * (1.0 - patch_settings[pid].controlnet_softness * k)
+            outs[i] = outs[i] * (1.0 - settings.controlnet_softness * k)
 
     return outs
 
 
 def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
     self.current_step = 1.0 - timesteps.to(x) / 999.0
-    patch_settings[os.getpid()].global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
+    task_context.current().patch_settings.global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
 
     y = timed_adm(y, timesteps)
 
@@ -498,6 +499,9 @@ def patch_all():
 
     ldm_patched.modules.model_management.load_models_gpu = patched_load_models_gpu
     ldm_patched.modules.model_patcher.ModelPatcher.calculate_weight = calculate_weight_patched
+    ldm_patched.modules.model_patcher.ModelPatcher.calculate_weights = calculate_weights_batched
+    if args_manager.args.runtime_lora:
+        ldm_patched.modules.model_patcher.ModelPatcher.patch_weight_at_runtime = patch_weight_at_runtime
     ldm_patched.controlnet.cldm.ControlNet.forward = patched_cldm_forward
     ldm_patched.ldm.modules.diffusionmodules.openaimodel.UNetModel.forward = patched_unet_forward
     ldm_patched.modules.model_base.SDXL.encode_adm = sdxl_encode_adm_patched
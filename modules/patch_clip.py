@@ -62,6 +62,72 @@ def patched_encode_token_weights(self, token_weight_pairs):
     return torch.cat(output, dim=-2).to(ldm_patched.modules.model_management.intermediate_device()), first_pooled
 
 
+def patched_encode_token_weights_batch(self, token_weight_pairs_list, max_batch_size=64):
+    # same as patched_encode_token_weights for each prompt, with the chunks of all prompts encoded together
+    rows = []
+    prompts = []
+    for token_weight_pairs in token_weight_pairs_list:
+        max_token_len = 0
+        has_weights = False
+        for x in token_weight_pairs:
+            tokens = list(map(lambda a: a[0], x))
+            max_token_len = max(len(tokens), max_token_len)
+            has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
+        prompts.append((len(rows), len(token_weight_pairs), has_weights, max_token_len))
+        rows += [list(map(lambda a: a[0], x)) for x in token_weight_pairs]
+
+    empty_rows = {}
+    for start, sections, has_weights, max_token_len in prompts:
+        if (has_weights or sections == 0) and max_token_len not in empty_rows:
+            empty_rows[max_token_len] = len(rows)
+            rows.append(ldm_patched.modules.sd1_clip.gen_empty_tokens(self.special_tokens, max_token_len))
+
+    # rows of the same length are encoded in batches of at most max_batch_size
+    row_out = [None] * len(rows)
+    row_pooled = [None] * len(rows)
+    by_length = {}
+    for index, tokens in enumerate(rows):
+        by_length.setdefault(len(tokens), []).append(index)
+    for indices in by_length.values():
+        for i in range(0, len(indices), max_batch_size):
+            batch = indices[i:i + max_batch_size]
+            out, pooled = self.encode([rows[index] for index in batch])
+            for j, index in enumerate(batch):
+                row_out[index] = out[j:j + 1]
+                row_pooled[index] = pooled[j:j + 1] if pooled is not None else None
+
+    intermediate_device = ldm_patched.modules.model_management.intermediate_device()
+    results = []
+    for k, (start, sections, has_weights, max_token_len) in enumerate(prompts):
+        token_weight_pairs = token_weight_pairs_list[k]
+        empty_row = empty_rows.get(max_token_len)
+        first_row = start if sections > 0 else empty_row
+        first_pooled = row_pooled[first_row]
+        if first_pooled is not None:
+            first_pooled = first_pooled.to(intermediate_device)
+
+        output = []
+        for section in range(sections):
+            z = row_out[start + section]
+            if has_weights:
+                original_mean = z.mean()
+                z_empty = row_out[empty_row][0]
+                for i in range(len(z)):
+                    for j in range(len(z[i])):
+                        weight = token_weight_pairs[section][j][1]
+                        if weight != 1.0:
+                            z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
+                new_mean = z.mean()
+                z = z * (original_mean / new_mean)
+            output.append(z)
+
+        if len(output) == 0:
+            results.append((row_out[empty_row].to(intermediate_device), first_pooled))
+        else:
+            results.append((torch.cat(output, dim=-2).to(intermediate_device), first_pooled))
+    return results
+
+
 def patched_SDClipModel__init__(self, max_length=77, freeze=True, layer="last", layer_idx=None,
                                 textmodel_json_config=None, dtype=None, special_tokens=None,
                                 layer_norm_hidden_state=True, **kwargs):
@@ -188,6 +254,7 @@ def patched_ClipVisionModel_encode_image(self, image):
 
 def patch_all_clip():
     ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights = patched_encode_token_weights
+    ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights_batch = patched_encode_token_weights_batch
     ldm_patched.modules.sd1_clip.SDClipModel.__init__ = patched_SDClipModel__init__
     ldm_patched.modules.sd1_clip.SDClipModel.forward = patched_SDClipModel_forward
     ldm_patched.modules.clip_vision.ClipVisionModel.__init__ = patched_ClipVisionModel__init__
@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import modules.task_context as task_context
+
+
+class PostProcessingStage:
+    """
+    Finishes images in the background while the next ones are sampled.
+
+    work() runs on a pool of max_workers threads. done(result) runs on a single thread in submission order, so
+    results are logged and shown in the same order as they were sampled. At most max_pending jobs are in flight,
+    submit() blocks when the stage is full. With max_workers=0 everything runs inline.
+    """
+
+    def __init__(self, max_workers=2, max_pending=None):
+        if max_pending is None:
+            max_pending = max_workers * 2
+        self.slots = threading.Semaphore(max(1, max_pending))
+        self.pool = None
+        self.completion = None
+        if max_workers > 0:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='post_processing')
+            self.completion = ThreadPoolExecutor(max_workers=1, thread_name_prefix='post_processing_done')
+        self.pending = []
+
+    def submit(self, work, done=None) -> Future:
+        if self.pool is None:
+            future = Future()
+            result = work()
+            if done is not None:
+                done(result)
+            future.set_result(result)
+            return future
+
+        self.slots.acquire()
+        context = task_context.current()
+
+        def run_work():
+            task_context.activate(context)
+            try:
+                return work()
+            finally:
+                task_context.activate(None)
+
+        work_future = self.pool.submit(run_work)
+
+        def run_done():
+            try:
+                result = work_future.result()
+                if done is not None:
+                    task_context.activate(context)
+                    done(result)
+                return result
+            finally:
+                task_context.activate(None)
+                self.slots.release()
+
+        future = self.completion.submit(run_done)
+        self.pending.append(future)
+        return future
+
+    def join(self):
+        pending, self.pending = self.pending, []
+        error = None
+        for future in pending:
+            exception = future.exception()
+            if exception is not None and error is None:
+                error = exception
+        if error is not None:
+            raise error
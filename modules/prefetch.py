@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+
+def get_available_memory():
+    import psutil
+    return psutil.virtual_memory().available
+
+
+def get_file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime, stat.st_size
+
+
+class ModelPrefetcher:
+    """
+    Reads the model files of the next queued job on a background thread, so that they are in the page cache when
+    the job loads them.
+
+    schedule() replaces the files to read and cancels a prefetch still in progress, which is checked after every
+    chunk. At most max_bytes, and never more than half of the available RAM, are read per schedule. Files that do not
+    fit are skipped. Files read by an earlier
+    schedule are not read again as long as they are still wanted and unchanged. With max_bytes=0 nothing is read.
+    """
+
+    def __init__(self, max_bytes=0, chunk_size=16 * 1024 * 1024, available_memory=get_available_memory):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.available_memory = available_memory
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.pending = None
+        self.scheduled = None
+        self.busy = False
+        self.warm = set()
+        self.thread = None
+        self.prefetched_files = 0
+        self.prefetched_bytes = 0
+        self.skipped_files = 0
+        self.cancelled = 0
+
+    def schedule(self, paths):
+        if self.max_bytes <= 0:
+            return
+        with self.condition:
+            paths = list(paths)
+            if paths == self.scheduled:
+                return
+            if self.busy or self.pending is not None:
+                self.cancelled += 1
+            self.generation += 1
+            self.pending = paths
+            self.scheduled = paths
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def is_current(self, generation):
+        return self.generation == generation
+
+    def wait(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending is None and not self.busy, timeout=timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                paths = self.pending
+                generation = self.generation
+                self.pending = None
+                self.busy = True
+            try:
+                self.prefetch(paths, generation)
+            except Exception as e:
+                print(f'[Prefetch] Failed: {e}')
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def prefetch(self, paths, generation):
+        keys = [key for key in (get_file_key(path) for path in dict.fromkeys(paths)) if key is not None]
+        with self.condition:
+            self.warm &= set(keys)
+
+        start_time = time.perf_counter()
+        budget = min(self.max_bytes, self.available_memory() // 2)
+        read_files = 0
+        read_bytes = 0
+        for key in keys:
+            path, _, size = key
+            if key in self.warm:
+                continue
+            if size > budget:
+                self.skipped_files += 1
+                continue
+            size_read = self.read_file(path, generation)
+            if size_read is None:
+                return
+            budget -= size_read
+            read_files += 1
+            read_bytes += size_read
+            with self.condition:
+                self.warm.add(key)
+                self.prefetched_files += 1
+                self.prefetched_bytes += size_read
+
+        if read_files > 0:
+            print(f'[Prefetch] Read {read_files} file(s), {read_bytes / 1024 ** 3:.2f} GB in '
+                  f'{time.perf_counter() - start_time:.2f} seconds.')
+
+    def read_file(self, path, generation):
+        # returns the number of bytes read, or None if a newer schedule cancelled this one
+        size_read = 0
+        with open(path, 'rb', buffering=0) as fp:
+            while True:
+                if not self.is_current(generation):
+                    return None
+                chunk = fp.read(self.chunk_size)
+                if not chunk:
+                    return size_read
+                size_read += len(chunk)
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                max_bytes=self.max_bytes,
+                prefetched_files=self.prefetched_files,
+                prefetched_bytes=self.prefetched_bytes,
+                skipped_files=self.skipped_files,
+                cancelled=self.cancelled
+            )
@@ -0,0 +1,52 @@
+import threading
+from collections import deque
+
+
+class ProgressChannel:
+    """
+    Per-task channel between the worker and the thread presenting its progress.
+
+    At most one 'preview' is pending at any time: a new preview replaces the pending one, so a slow consumer only
+    ever sees the latest frame and the channel stays bounded. All other events, such as 'results' and 'finish', are
+    kept and delivered in order. Consumers block in get() until an event arrives.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = deque()
+        self.pending_preview = None
+        self.previews_dropped = 0
+
+    def __deepcopy__(self, memo):
+        # gradio deep copies the initial value of gr.State, locks cannot be copied
+        return ProgressChannel()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.events)
+
+    def put(self, event):
+        flag, product = event
+        with self.condition:
+            if flag == 'preview' and self.pending_preview is not None:
+                # compare by identity, products may hold numpy arrays
+                for index, pending in enumerate(self.events):
+                    if pending is self.pending_preview:
+                        del self.events[index]
+                        break
+                self.previews_dropped += 1
+            event = [flag, product]
+            self.events.append(event)
+            self.pending_preview = event if flag == 'preview' else self.pending_preview
+            self.condition.notify_all()
+
+    append = put
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.events) > 0, timeout=timeout):
+                return None
+            event = self.events.popleft()
+            if event is self.pending_preview:
+                self.pending_preview = None
+            return event
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def get_cache_key(values) -> str:
+    data = json.dumps(values, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Maps the hash of a fully resolved generation task to the paths of the images it produced.
+
+    Entries are kept in least recently used order and evicted when there are more than max_entries or when they are
+    older than max_age seconds. An entry is dropped as soon as one of its images no longer exists. If path is given,
+    entries are appended to that file as JSON lines and loaded again on startup, and a miss first reads the lines
+    other processes appended since. Only the cache created with compact=True rewrites the file to drop stale lines,
+    on startup and whenever the file has more than compact_factor times max_entries lines, the other processes
+    sharing the file must not.
+    """
+
+    compact_factor = 2
+
+    def __init__(self, path=None, max_entries=1000, max_age=None, compact=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.compacts = compact
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.file_id = None
+        self.offset = 0
+        self.lines = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None:
+            self.load(compact)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def is_valid(self, entry, now):
+        created, paths = entry
+        if self.max_age is not None and now - created > self.max_age:
+            return False
+        return all(os.path.exists(path) for path in paths)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries and self.path is not None:
+                self.read_new_entries()
+            entry = self.entries.get(key)
+            if entry is not None and not self.is_valid(entry, time.time()):
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, paths):
+        entry = (time.time(), list(paths))
+        with self.lock:
+            if self.path is not None and self.compacts:
+                # counts the lines other processes appended and keeps their entries for the compaction
+                self.read_new_entries()
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.evict()
+            if self.path is not None:
+                self.append(key, entry)
+                if self.compacts and self.lines > self.compact_factor * max(1, self.max_entries):
+                    self.compact()
+
+    def evict(self):
+        if self.max_age is not None:
+            now = time.time()
+            for key in [key for key, (created, _) in self.entries.items() if now - created > self.max_age]:
+                del self.entries[key]
+                self.evictions += 1
+        while len(self.entries) > max(0, self.max_entries):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def read_new_entries(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_dev, stat.st_ino) != self.file_id or stat.st_size < self.offset:
+            # replaced by compaction, read it again from the start
+            self.file_id = (stat.st_dev, stat.st_ino)
+            self.offset = 0
+            self.lines = 0
+        if stat.st_size == self.offset:
+            return
+        try:
+            with open(self.path, 'rb') as fp:
+                fp.seek(self.offset)
+                for line in fp:
+                    # a line without a newline is still being written by another process
+                    if not line.endswith(b'\n'):
+                        break
+                    self.offset += len(line)
+                    self.lines += 1
+                    try:
+                        item = json.loads(line)
+                        self.entries[item['key']] = (float(item['created']), list(item['paths']))
+                        self.entries.move_to_end(item['key'])
+                    except Exception as e:
+                        print(f'[Result Cache] Skipping invalid line: {e}')
+        except OSError as e:
+            print(f'[Result Cache] Loading failed: {e}')
+        self.evict()
+
+    def load(self, compact):
+        with self.lock:
+            self.read_new_entries()
+            now = time.time()
+            for key in [key for key, entry in self.entries.items() if not self.is_valid(entry, now)]:
+                del self.entries[key]
+            if compact:
+                self.compact()
+
+    def compact(self):
+        # write the file again to drop evicted and invalid entries, readers see either the old or the new file
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        self.save(list(self.entries.items()), temp_path)
+        try:
+            os.replace(temp_path, self.path)
+            stat = os.stat(self.path)
+            self.file_id = (stat.st_dev, stat.st_ino)
+            self.offset = stat.st_size
+            self.lines = len(self.entries)
+        except OSError as e:
+            print(f'[Result Cache] Saving failed: {e}')
+
+    def append(self, key, entry):
+        created, paths = entry
+        try:
+            with open(self.path, 'ab') as fp:
+                # the own line is not read again unless other processes appended lines that were not read yet
+                stat = os.fstat(fp.fileno())
+                up_to_date = (stat.st_dev, stat.st_ino) == self.file_id and fp.tell() == self.offset
+                fp.write(json.dumps(dict(key=key, created=created, paths=paths)).encode('utf-8') + b'\n')
+                if up_to_date:
+                    self.offset = fp.tell()
+                    self.lines += 1
+        except Exception as e:
+            print(f'[Result Cache] Saving failed: {e}')
+
+    def save(self, items, path):
+        try:
+            with open(path, 'wt', encoding='utf-8') as fp:
+                for key, (created, paths) in items:
+                    json.dump(dict(key=key, created=created, paths=paths), fp)
+                    fp.write('\n')
+        except Exception as e:
+            print(f'[Result Cache] Saving failed: {e}')
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                entries=len(self.entries),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                hit_rate=self.hits / lookups if lookups > 0 else 0.0
+            )
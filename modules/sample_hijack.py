@@ -1,6 +1,7 @@
 import torch
 import ldm_patched.modules.samplers
 import ldm_patched.modules.model_management
+import modules.task_context
 
 from collections import namedtuple
 from ldm_patched.contrib.external_align_your_steps import AlignYourStepsScheduler
@@ -14,10 +15,6 @@ from ldm_patched.modules.samplers import resolve_areas_and_cond_masks, wrap_mode
     create_cond_with_same_area_if_none, pre_run_control, apply_empty_x_to_equal_area, encode_model_conds
 
 
-current_refiner = None
-refiner_switch_step = -1
-
-
 @torch.no_grad()
 @torch.inference_mode()
 def clip_separate_inner(c, p, target_model=None, target_clip=None):
@@ -87,7 +84,8 @@ def clip_separate_after_preparation(cond, target_model=None, target_clip=None):
 @torch.no_grad()
 @torch.inference_mode()
 def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas, model_options={}, latent_image=None, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
-    global current_refiner
+    context = modules.task_context.current()
+    current_refiner = context.refiner
 
     positive = positive[:]
     negative = negative[:]
@@ -147,7 +145,7 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
         return
 
     def callback_wrap(step, x0, x, total_steps):
-        if step == refiner_switch_step and current_refiner is not None:
+        if step == context.refiner_switch_step and current_refiner is not None:
             refiner_switch()
         if callback is not None:
             # residual_noise_preview = x - x0
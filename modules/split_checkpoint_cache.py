@@ -0,0 +1,137 @@
+import json
+import os
+import time
+
+import torch
+
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.supported_models as supported_models
+import ldm_patched.modules.utils
+from ldm_patched.modules.model_base import ModelType
+from ldm_patched.modules.sd import load_checkpoint_from_parts
+from modules.hash_cache import sha256_from_cache
+
+split_cache_version = 1
+
+
+def dtype_to_str(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def encode_unet_config(unet_config):
+    return {k: dtype_to_str(v) if isinstance(v, torch.dtype) else v for k, v in unet_config.items()}
+
+
+def decode_unet_config(unet_config):
+    result = dict(unet_config)
+    result['dtype'] = getattr(torch, result['dtype'])
+    return result
+
+
+class SplitCheckpointCache:
+    """
+    Directory of checkpoints that were already detected, converted and split into UNet, CLIP and VAE.
+
+    Each checkpoint gets a folder named after its hash with one safetensors file per part, stored in the dtypes the
+    models are loaded in, and a meta.json holding the detected model config, the model type and the LoRA key maps.
+    Loading from there skips model detection, state dict conversion and unpickling of .ckpt files. An entry is
+    rebuilt when the checkpoint file or the dtypes selected for this device changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_entry_path(self, filename):
+        return os.path.join(self.path, sha256_from_cache(filename))
+
+    def get_dtypes(self, parameters):
+        return dict(unet=dtype_to_str(model_management.unet_dtype(model_params=parameters)),
+                    clip=dtype_to_str(model_management.text_encoder_dtype()),
+                    vae=dtype_to_str(model_management.vae_dtype()))
+
+    def read_meta(self, filename):
+        meta_path = os.path.join(self.get_entry_path(filename), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'rt', encoding='utf-8') as fp:
+            meta = json.load(fp)
+        stat = os.stat(filename)
+        if meta.get('version') != split_cache_version or meta['size'] != stat.st_size \
+                or meta['mtime'] != stat.st_mtime or meta['dtypes'] != self.get_dtypes(meta['parameters']):
+            return None
+        return meta
+
+    def load(self, filename, vae_filename=None, embedding_directory=None, use_mmap=False):
+        try:
+            meta = self.read_meta(filename)
+        except Exception as e:
+            print(f'[Split Cache] Cannot read cache entry of {filename}: {e}')
+            return None
+        if meta is None or (vae_filename is None and not meta['has_vae']):
+            return None
+
+        entry_path = self.get_entry_path(filename)
+        unet_sd = ldm_patched.modules.utils.load_torch_file(os.path.join(entry_path, 'unet.safetensors'),
+                                                            use_mmap=use_mmap)
+        clip_sd = None
+        if meta['has_clip']:
+            clip_sd = ldm_patched.modules.utils.load_torch_file(os.path.join(entry_path, 'clip.safetensors'),
+                                                                use_mmap=use_mmap)
+        if vae_filename is not None:
+            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename, use_mmap=use_mmap)
+        else:
+            vae_sd = ldm_patched.modules.utils.load_torch_file(os.path.join(entry_path, 'vae.safetensors'),
+                                                               use_mmap=use_mmap)
+
+        model_config = getattr(supported_models, meta['model_config'])(decode_unet_config(meta['unet_config']))
+        unet, clip, vae = load_checkpoint_from_parts(model_config, ModelType[meta['model_type']], unet_sd, clip_sd,
+                                                     vae_sd, embedding_directory=embedding_directory)
+        print(f'[Split Cache] Loaded {filename} from {entry_path}')
+        return unet, clip, vae, vae_filename, meta['lora_key_map_unet'], meta['lora_key_map_clip']
+
+    def save(self, filename, model, has_vae=True):
+        start_time = time.perf_counter()
+        entry_path = self.get_entry_path(filename)
+        unet_model = model.unet.model
+        parameters = ldm_patched.modules.utils.calculate_parameters(unet_model.diffusion_model.state_dict())
+        stat = os.stat(filename)
+        meta = dict(
+            version=split_cache_version,
+            filename=os.path.basename(filename),
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            parameters=parameters,
+            dtypes=self.get_dtypes(parameters),
+            model_config=type(unet_model.model_config).__name__,
+            unet_config=encode_unet_config(unet_model.model_config.unet_config),
+            model_type=unet_model.model_type.name,
+            has_clip=model.clip is not None,
+            has_vae=has_vae and model.vae is not None,
+            lora_key_map_unet=model.lora_key_map_unet,
+            lora_key_map_clip=model.lora_key_map_clip
+        )
+
+        parts = [('unet', unet_model.diffusion_model.state_dict())]
+        if meta['has_clip']:
+            parts.append(('clip', {f'cond_stage_model.{k}': v for k, v in
+                                   model.clip.cond_stage_model.state_dict().items()}))
+        if meta['has_vae']:
+            parts.append(('vae', model.vae.first_stage_model.state_dict()))
+
+        try:
+            os.makedirs(entry_path, exist_ok=True)
+            meta_path = os.path.join(entry_path, 'meta.json')
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            for name, sd in parts:
+                sd = {k: v.detach().cpu().contiguous() for k, v in sd.items()}
+                ldm_patched.modules.utils.save_torch_file(sd, os.path.join(entry_path, f'{name}.safetensors'))
+            # meta.json is written last, an entry without it is incomplete and ignored
+            with open(meta_path, 'wt', encoding='utf-8') as fp:
+                json.dump(meta, fp)
+        except Exception as e:
+            print(f'[Split Cache] Cannot save {filename}: {e}')
+            return False
+
+        print(f'[Split Cache] Saved {filename} to {entry_path} in {time.perf_counter() - start_time:.2f} seconds')
+        return True
@@ -0,0 +1,32 @@
+import threading
+
+
+class TaskContext:
+    """
+    Sampling state of one task: patch settings, the inpaint worker and the refiner to swap to.
+
+    The context is bound to the thread running the task, so patched model code finds the settings of its own task
+    instead of sharing them through module globals or the process id.
+    """
+
+    def __init__(self):
+        self.patch_settings = None
+        self.inpaint_task = None
+        self.refiner = None
+        self.refiner_switch_step = -1
+
+
+thread_state = threading.local()
+
+
+def current() -> TaskContext:
+    context = getattr(thread_state, 'context', None)
+    if context is None:
+        context = TaskContext()
+        thread_state.context = context
+    return context
+
+
+def activate(context):
+    thread_state.context = context
+    return context
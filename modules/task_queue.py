@@ -0,0 +1,246 @@
+import threading
+import time
+from enum import IntEnum
+
+
+class TaskPriority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class QueueEntry:
+    def __init__(self, task, priority, client_id, affinity_key=None):
+        self.task = task
+        self.priority = TaskPriority(priority)
+        self.client_id = client_id
+        self.affinity_key = affinity_key
+        self.bypass_count = 0
+        self.enqueue_time = time.perf_counter()
+
+
+class TaskQueue:
+    """
+    Blocking job queue for AsyncTask objects.
+
+    Tasks are dispatched by priority class first. Within a class, the client that was served least recently goes
+    first, so one client submitting many jobs cannot starve the others. Ties keep arrival order.
+
+    If affinity_key is given, a task whose key equals the one of the task previously dispatched to the same consumer
+    may jump ahead within its priority class, so that jobs sharing the same models run back to back on the worker
+    that has them loaded. Consumers are named by the consumer argument of get(), None for the local worker. The task
+    it jumps over is bypassed at most max_affinity_bypass times before it is dispatched regardless of affinity.
+
+    move() reorders the tasks of one client within a priority class, set_priority moves a task to another class.
+
+    Callbacks added with add_listener are called without arguments after every change of the queued tasks.
+    """
+
+    def __init__(self, affinity_key=None, max_affinity_bypass=4):
+        self.condition = threading.Condition()
+        self.entries = []
+        self.affinity_key = affinity_key
+        self.max_affinity_bypass = max_affinity_bypass
+        self.consumers = {}
+        self.client_last_served = {}
+        self.dispatch_counter = 0
+        self.cancelled_count = 0
+        self.model_switches = 0
+        self.model_switches_avoided = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.wait_time_last = 0.0
+        self.listeners = []
+
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def notify_listeners(self):
+        for callback in self.listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f'[Queue] Listener failed: {e}')
+
+    def put(self, task, priority=None, client_id=None):
+        if priority is None:
+            priority = getattr(task, 'priority', TaskPriority.NORMAL)
+        if client_id is None:
+            client_id = getattr(task, 'client_id', None)
+
+        affinity_key = None
+        if self.affinity_key is not None:
+            try:
+                affinity_key = self.affinity_key(task)
+            except Exception as e:
+                print(f'[Queue] Cannot compute model affinity of task: {e}')
+
+        with self.condition:
+            self.entries.append(QueueEntry(task, priority, client_id, affinity_key))
+            self.condition.notify()
+        self.notify_listeners()
+
+    append = put
+
+    def get_consumer(self, consumer):
+        if consumer not in self.consumers:
+            self.consumers[consumer] = dict(last_affinity_key=None, dispatched=0, model_switches=0,
+                                            model_switches_avoided=0, wait_time_last=0.0)
+        return self.consumers[consumer]
+
+    def get(self, timeout=None, consumer=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.entries) > 0, timeout=timeout):
+                return None
+
+            state = self.get_consumer(consumer)
+            bypass_counts = {id(e): e.bypass_count for e in self.entries}
+            entry, bypassed = self.select_entry(self.entries, self.client_last_served, state['last_affinity_key'],
+                                                bypass_counts)
+            self.entries.remove(entry)
+
+            if bypassed is not None:
+                bypassed.bypass_count += 1
+                state['model_switches_avoided'] += 1
+                self.model_switches_avoided += 1
+            if self.affinity_key is not None and state['dispatched'] > 0 \
+                    and entry.affinity_key != state['last_affinity_key']:
+                state['model_switches'] += 1
+                self.model_switches += 1
+
+            self.dispatch_counter += 1
+            self.client_last_served[entry.client_id] = self.dispatch_counter
+            state['dispatched'] += 1
+            state['last_affinity_key'] = entry.affinity_key
+
+            wait_time = time.perf_counter() - entry.enqueue_time
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            self.wait_time_last = wait_time
+            state['wait_time_last'] = wait_time
+        self.notify_listeners()
+        return entry.task
+
+    def select_entry(self, entries, client_last_served, last_affinity_key, bypass_counts):
+        def fair_key(item):
+            index, entry = item
+            return entry.priority, client_last_served.get(entry.client_id, 0), index
+
+        fair = min(enumerate(entries), key=fair_key)[1]
+
+        if self.affinity_key is None or last_affinity_key is None or fair.affinity_key == last_affinity_key \
+                or bypass_counts[id(fair)] >= self.max_affinity_bypass:
+            return fair, None
+
+        same_models = [(index, entry) for index, entry in enumerate(entries)
+                       if entry.priority == fair.priority and entry.affinity_key == last_affinity_key]
+        if len(same_models) == 0:
+            return fair, None
+
+        return min(same_models, key=fair_key)[1], fair
+
+    def peek(self, count=1, consumer=None):
+        # the order in which the given consumer would get the tasks if it were the only one
+        with self.condition:
+            entries = list(self.entries)
+            client_last_served = dict(self.client_last_served)
+            last_affinity_key = self.consumers[consumer]['last_affinity_key'] if consumer in self.consumers else None
+            bypass_counts = {id(e): e.bypass_count for e in entries}
+            dispatch_counter = self.dispatch_counter
+
+        upcoming = []
+        while len(entries) > 0 and len(upcoming) < count:
+            entry, bypassed = self.select_entry(entries, client_last_served, last_affinity_key, bypass_counts)
+            entries.remove(entry)
+            if bypassed is not None:
+                bypass_counts[id(bypassed)] += 1
+            dispatch_counter += 1
+            client_last_served[entry.client_id] = dispatch_counter
+            last_affinity_key = entry.affinity_key
+            upcoming.append(entry.task)
+        return upcoming
+
+    def find_entry(self, task):
+        for entry in self.entries:
+            if entry.task is task:
+                return entry
+        return None
+
+    def cancel(self, task):
+        with self.condition:
+            entry = self.find_entry(task)
+            if entry is None:
+                return False
+            self.entries.remove(entry)
+            self.cancelled_count += 1
+        self.notify_listeners()
+        return True
+
+    def set_priority(self, task, priority):
+        with self.condition:
+            entry = self.find_entry(task)
+            if entry is None:
+                return False
+            entry.priority = TaskPriority(priority)
+        self.notify_listeners()
+        return True
+
+    def move(self, task, position):
+        # moves the task to position among the queued tasks of the same client and priority, the order between
+        # clients is decided by the fair share when they are dispatched
+        with self.condition:
+            entry = self.find_entry(task)
+            if entry is None:
+                return False
+            slots = [i for i, e in enumerate(self.entries)
+                     if e.client_id == entry.client_id and e.priority == entry.priority]
+            group = [self.entries[i] for i in slots]
+            group.remove(entry)
+            group.insert(max(0, position), entry)
+            for i, e in zip(slots, group):
+                self.entries[i] = e
+        self.notify_listeners()
+        return True
+
+    def position(self, task):
+        upcoming = self.peek(count=len(self))
+        for index, t in enumerate(upcoming):
+            if t is task:
+                return index
+        return -1
+
+    def consumer_stats(self, consumer=None):
+        with self.condition:
+            return dict(self.get_consumer(consumer))
+
+    def stats(self):
+        with self.condition:
+            depth_by_priority = {p.name.lower(): 0 for p in TaskPriority}
+            for entry in self.entries:
+                depth_by_priority[entry.priority.name.lower()] += 1
+
+            now = time.perf_counter()
+            oldest_wait_time = max([now - entry.enqueue_time for entry in self.entries], default=0.0)
+
+            return dict(
+                depth=len(self.entries),
+                depth_by_priority=depth_by_priority,
+                dispatched=self.dispatch_counter,
+                cancelled=self.cancelled_count,
+                model_switches=self.model_switches,
+                model_switches_avoided=self.model_switches_avoided,
+                wait_time_avg=self.wait_time_total / self.dispatch_counter if self.dispatch_counter > 0 else 0.0,
+                wait_time_max=self.wait_time_max,
+                wait_time_last=self.wait_time_last,
+                oldest_wait_time=oldest_wait_time,
+                consumers={'local' if consumer is None else str(consumer): dict(
+                    dispatched=state['dispatched'],
+                    model_switches=state['model_switches'],
+                    model_switches_avoided=state['model_switches_avoided'],
+                    wait_time_last=state['wait_time_last']
+                ) for consumer, state in self.consumers.items()}
+            )
@@ -0,0 +1,192 @@
+import atexit
+import os
+import secrets
+import subprocess
+import sys
+import threading
+from multiprocessing.connection import Listener, Client
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# attributes of an AsyncTask that only make sense in the process that owns it
+local_task_attributes = ['yields', 'remote_worker']
+
+
+def get_task_state(task):
+    return {k: v for k, v in task.__dict__.items() if k not in local_task_attributes}
+
+
+def is_worker_process():
+    return 'FOOOCUS_WORKER_ADDRESS' in os.environ
+
+
+def get_worker_argv(argv, device):
+    result = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+            continue
+        if arg in ['--worker-devices', '--gpu-device-id']:
+            skip_value = True
+            continue
+        if arg.startswith('--worker-devices=') or arg.startswith('--gpu-device-id='):
+            continue
+        result.append(arg)
+    if device == 'cpu' and '--always-cpu' not in result:
+        result.append('--always-cpu')
+    return result
+
+
+class RemoteWorker:
+    """
+    Worker process bound to one device. It takes tasks from the shared queue of the main process, runs them in its
+    own async_worker and relays the progress events back into the task's channel.
+    """
+
+    def __init__(self, device, connection, process):
+        self.device = device
+        self.connection = connection
+        self.process = process
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.connection.send(message)
+
+    def interrupt(self, task):
+        self.send(('stop', task.last_stop))
+
+    def run(self, task):
+        task.processing = True
+        task.remote_worker = self
+        try:
+            self.send(('task', get_task_state(task)))
+            while True:
+                message = self.connection.recv()
+                if message[0] == 'finish':
+                    _, results, state = message
+                    task.__dict__.update(state)
+                    task.yields.append(['finish', results])
+                    return
+                task.yields.append(list(message))
+        except (EOFError, OSError) as e:
+            print(f'[Worker {self.device}] Lost connection to worker process: {e}')
+            task.yields.append(['finish', task.results])
+            raise
+        finally:
+            task.processing = False
+            task.remote_worker = None
+
+    def dispatch(self, task_queue):
+        while True:
+            task = task_queue.get(consumer=self.device)
+            wait_time = task_queue.consumer_stats(self.device)['wait_time_last']
+            print(f'[Worker {self.device}] Task started after waiting {wait_time:.2f} seconds, '
+                  f'{len(task_queue)} task(s) pending.')
+            try:
+                self.run(task)
+            except (EOFError, OSError):
+                return
+
+
+def start_pool(task_queue, devices):
+    authkey = secrets.token_bytes(32)
+    listener = Listener(('127.0.0.1', 0), authkey=authkey)
+    host, port = listener.address
+    processes = []
+
+    for index, device in enumerate(devices):
+        env = os.environ.copy()
+        env['FOOOCUS_WORKER_ADDRESS'] = f'{host}:{port}'
+        env['FOOOCUS_WORKER_AUTHKEY'] = authkey.hex()
+        env['FOOOCUS_WORKER_INDEX'] = str(index)
+        if device != 'cpu':
+            env['CUDA_VISIBLE_DEVICES'] = device
+        command = [sys.executable, '-m', 'modules.worker_pool'] + get_worker_argv(sys.argv[1:], device)
+        processes.append(subprocess.Popen(command, cwd=root, env=env))
+        print(f'[Worker {device}] Started worker process with PID {processes[-1].pid}')
+
+    def terminate():
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    atexit.register(terminate)
+
+    def accept():
+        for _ in devices:
+            connection = listener.accept()
+            _, index = connection.recv()
+            device = devices[index]
+            remote_worker = RemoteWorker(device, connection, processes[index])
+            threading.Thread(target=remote_worker.dispatch, args=(task_queue,), daemon=True).start()
+            print(f'[Worker {device}] Ready.')
+        listener.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+
+
+def prepare_worker_process():
+    # launch.py does this for the main process, without it wildcards, inline LoRAs and model filenames do not resolve
+    import modules.config as config
+    from modules.hash_cache import init_cache
+
+    config.update_files()
+    init_cache(config.model_filenames, config.paths_checkpoints, config.lora_filenames, config.paths_loras)
+
+
+def run_worker_process():
+    prepare_worker_process()
+
+    host, port = os.environ['FOOOCUS_WORKER_ADDRESS'].split(':')
+    index = int(os.environ['FOOOCUS_WORKER_INDEX'])
+    connection = Client((host, int(port)), authkey=bytes.fromhex(os.environ['FOOOCUS_WORKER_AUTHKEY']))
+
+    import modules.async_worker as worker
+    import ldm_patched.modules.model_management as model_management
+    from modules.progress_channel import ProgressChannel
+
+    send_lock = threading.Lock()
+    current_task = None
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    def relay(task):
+        while True:
+            flag, product = task.yields.get()
+            if flag == 'finish':
+                send(('finish', product, get_task_state(task)))
+                return
+            send((flag, product))
+
+    send(('ready', index))
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            return
+
+        if message[0] == 'task':
+            task = worker.AsyncTask(args=[])
+            task.__dict__.update(message[1])
+            task.yields = ProgressChannel()
+            task.processing = False
+            current_task = task
+            threading.Thread(target=relay, args=(task,), daemon=True).start()
+            worker.async_tasks.put(task)
+        elif message[0] == 'stop' and current_task is not None:
+            current_task.last_stop = message[1]
+            if current_task.processing:
+                model_management.interrupt_current_processing()
+
+
+if __name__ == '__main__':
+    sys.path.append(root)
+    os.chdir(root)
+    os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
+    os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
+    run_worker_process()
@@ -1,4 +1,23 @@
+import os
 import sys
 import pathlib
+import tempfile
 
 sys.path.append(pathlib.Path(f'{__file__}/../modules').parent.resolve())
+
+config_directory = tempfile.TemporaryDirectory()
+
+
+def import_config():
+    # modules.config parses the command line of the test runner and writes its config files when imported
+    os.environ['config_path'] = os.path.join(config_directory.name, 'config.txt')
+    os.environ['config_example_path'] = os.path.join(config_directory.name, 'config_modification_tutorial.txt')
+    argv = sys.argv
+    sys.argv = argv[:1]
+    try:
+        import modules.config
+    finally:
+        sys.argv = argv
+        os.environ.pop('config_path')
+        os.environ.pop('config_example_path')
+    return modules.config
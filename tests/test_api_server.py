@@ -0,0 +1,34 @@
+import unittest
+
+from tests import import_config
+
+import_config()
+
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from modules.api_schema import GenerationRequest
+from modules.api_server import create_app
+
+
+class TestApiServer(unittest.TestCase):
+    def test_invalid_choices_are_rejected(self):
+        invalid = [
+            dict(performance_selection='Fastest'),
+            dict(metadata_scheme='exif'),
+            dict(image_prompts=[dict(image='', type='Depth')])
+        ]
+        client = TestClient(create_app())
+        for request in invalid:
+            with self.assertRaises(ValidationError):
+                GenerationRequest.model_validate(request)
+            response = client.post('/v1/generation', json=request)
+            self.assertEqual(422, response.status_code)
+
+        with client.websocket_connect('/v1/generation') as websocket:
+            websocket.send_json(invalid[0])
+            self.assertEqual('error', websocket.receive_json()['type'])
+
+
+if __name__ == '__main__':
+    unittest.main()
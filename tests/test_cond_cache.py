@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from modules.cond_cache import ConditioningCache
+
+clip_identity = ['sd_xl_base_1.0.safetensors', 1700000000.0, [['lora.safetensors', 1700000001.0, 0.5]]]
+
+
+class TestConditioningCache(unittest.TestCase):
+    def test_lru_keyed_by_clip_identity_skip_and_text(self):
+        cache = ConditioningCache(max_entries=2)
+        cache.put([clip_identity, -2, 'a cat'], 'cond a')
+        self.assertIsNone(cache.get([clip_identity, -1, 'a cat']))
+        self.assertIsNone(cache.get([clip_identity[:2] + [[]], -2, 'a cat']))
+
+        cache.put([clip_identity, -2, 'b'], 'cond b')
+        self.assertEqual('cond a', cache.get([clip_identity, -2, 'a cat']))
+        cache.put([clip_identity, -2, 'c'], 'cond c')
+        self.assertEqual('cond a', cache.get([clip_identity, -2, 'a cat']))
+        self.assertIsNone(cache.get([clip_identity, -2, 'b']))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertAlmostEqual(0.4, stats['hit_rate'])
+
+    def test_disk_tier_does_not_unpickle(self):
+        import torch
+
+        class Code:
+            def __reduce__(self):
+                return print, ('unpickled',)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConditioningCache(path=directory)
+            cache.put([clip_identity, -2, 'a'], (torch.zeros(1), torch.zeros(1)))
+            file_path = os.path.join(directory, os.listdir(directory)[0])
+            torch.save((torch.zeros(1), Code()), file_path)
+
+            cache = ConditioningCache(path=directory)
+            self.assertIsNone(cache.get([clip_identity, -2, 'a']))
+            self.assertFalse(os.path.exists(file_path))
+
+    def test_disk_tier_survives_restart_and_is_bounded(self):
+        import torch
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConditioningCache(max_entries=1, path=directory, max_disk_entries=2)
+            for i, text in enumerate(['a', 'b', 'c']):
+                cache.put([clip_identity, -2, text], (torch.full((1, 77, 8), i), torch.full((1, 8), i)))
+            self.assertEqual(2, len(os.listdir(directory)))
+
+            cache = ConditioningCache(max_entries=1, path=directory, max_disk_entries=2)
+            self.assertEqual(0, len(cache))
+            self.assertIsNone(cache.get([clip_identity, -2, 'a']))
+            cond, pooled = cache.get([clip_identity, -2, 'b'])
+            self.assertTrue(torch.equal(torch.full((1, 77, 8), 1), cond))
+            self.assertTrue(torch.equal(torch.full((1, 8), 1), pooled))
+            self.assertIs(cond, cache.get([clip_identity, -2, 'b'])[0])
+            self.assertEqual(1, cache.stats()['disk_hits'])
+            self.assertEqual(1, cache.stats()['hits'])
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from ldm_patched.modules.embedding_index import EmbeddingIndex
+
+
+def write_file(path, content=b'embedding'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(content)
+
+
+class TestEmbeddingIndex(unittest.TestCase):
+    def test_names_as_probed_on_the_file_system(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_file(os.path.join(directory, 'style.pt'))
+            write_file(os.path.join(directory, 'style.safetensors'))
+            write_file(os.path.join(directory, 'negative', 'bad_hands.bin'))
+            write_file(os.path.join(directory, 'negative', 'notes.txt'))
+            write_file(os.path.join(directory, 'exact'))
+            write_file(os.path.join(directory, 'exact.pt'))
+            index = EmbeddingIndex([directory])
+
+            self.assertEqual(os.path.join(directory, 'style.safetensors'), index.find('style'))
+            self.assertEqual(os.path.join(directory, 'style.pt'), index.find('style.pt'))
+            self.assertEqual(os.path.join(directory, 'negative', 'bad_hands.bin'), index.find('bad_hands'))
+            self.assertEqual(os.path.join(directory, 'negative', 'bad_hands.bin'), index.find('negative/bad_hands'))
+            self.assertEqual(os.path.join(directory, 'exact'), index.find('exact'))
+            self.assertIsNone(index.find('notes'))
+            self.assertIsNone(index.find('missing'))
+            self.assertIsNone(index.find('../' + os.path.basename(directory) + '/style'))
+
+    def test_lookups_do_not_touch_the_disk_until_refreshed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_file(os.path.join(directory, 'a.pt'))
+            index = EmbeddingIndex([directory])
+            self.assertIsNotNone(index.find('a'))
+
+            write_file(os.path.join(directory, 'b.pt'))
+            self.assertIsNone(index.find('b'))
+            self.assertTrue(index.refresh())
+            self.assertIsNotNone(index.find('b'))
+            self.assertFalse(index.refresh())
+
+    def test_loaded_embeddings_cached_until_the_file_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'a.pt')
+            write_file(path, b'one')
+            loads = []
+
+            def loader(embed_path):
+                loads.append(embed_path)
+                with open(embed_path, 'rb') as fp:
+                    return fp.read()
+
+            index = EmbeddingIndex([directory], max_entries=2)
+            self.assertEqual(b'one', index.load('a', loader, key=768))
+            self.assertEqual(b'one', index.load('a.pt', loader, key=768))
+            self.assertEqual(1, len(loads))
+            index.load('a', loader, key=1280)
+            self.assertEqual(2, len(loads))
+            self.assertIsNone(index.load('missing', loader))
+
+            write_file(path, b'two')
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(b'one', index.load('a', loader, key=768))
+            index.refresh()
+            self.assertEqual(b'two', index.load('a', loader, key=768))
+            self.assertEqual(dict(names=2, entries=2, hits=2, misses=3), index.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
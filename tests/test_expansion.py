@@ -0,0 +1,54 @@
+import unittest
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, set_seed
+from transformers.generation.logits_process import LogitsProcessorList
+
+from extras.expansion import FooocusExpansion, neg_inf
+
+
+def create_expansion():
+    torch.manual_seed(0)
+    expansion = FooocusExpansion.__new__(FooocusExpansion)
+    expansion.model = GPT2LMHeadModel(GPT2Config(vocab_size=256, n_positions=64, n_embd=32, n_layer=2, n_head=2,
+                                                 bos_token_id=255, eos_token_id=255)).eval()
+    expansion.logits_bias = torch.zeros((1, 256))
+    expansion.logits_bias[0, ::3] = neg_inf
+    expansion.logits_bias[0, 255] = neg_inf
+    return expansion
+
+
+def generate_like_before(expansion, input_ids, seed, max_new_tokens):
+    # the expansion before batching, one prompt sampled by generate after seeding the global generators
+    def logits_processor(input_ids, scores):
+        bias = expansion.logits_bias.to(scores).clone()
+        bias[0, input_ids[0].to(bias.device).long()] = neg_inf
+        bias[0, 11] = 0
+        return scores + bias
+
+    set_seed(seed)
+    return expansion.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), top_k=100,
+                                    max_new_tokens=max_new_tokens, do_sample=True, pad_token_id=255,
+                                    logits_processor=LogitsProcessorList([logits_processor]))
+
+
+class TestExpansion(unittest.TestCase):
+    def test_seed_gives_the_expansion_of_earlier_versions(self):
+        expansion = create_expansion()
+        input_ids = torch.tensor([[20, 40, 11]])
+        with torch.inference_mode():
+            for seed in [0, 1, 12345]:
+                self.assertTrue(torch.equal(generate_like_before(expansion, input_ids, seed, 16),
+                                            expansion.generate_tokens(input_ids, [seed], 16, pad_token_id=255)))
+
+    def test_expansion_of_a_seed_does_not_depend_on_the_batch(self):
+        expansion = create_expansion()
+        input_ids = torch.tensor([[20, 40, 11]])
+        with torch.inference_mode():
+            batch = expansion.generate_tokens(torch.cat([input_ids, input_ids]), [7, 8], 16, pad_token_id=255)
+            self.assertTrue(torch.equal(expansion.generate_tokens(input_ids, [7], 16, pad_token_id=255), batch[0:1]))
+            self.assertTrue(torch.equal(expansion.generate_tokens(input_ids, [8], 16, pad_token_id=255), batch[1:2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import modules.job_journal as job_journal
+from modules.job_journal import JobJournal
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'jobs.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unfinished_jobs_survive_reopening(self):
+        journal = JobJournal(self.path)
+        state = dict(prompt='a cat', seed=42, uov_input_image=np.zeros((2, 2, 3), dtype=np.uint8))
+        queued = journal.add_job(state, image_number=4)
+        running = journal.add_job(dict(prompt='a dog'), image_number=1)
+        finished = journal.add_job(dict(prompt='a bird'), image_number=1)
+        journal.set_status(running, job_journal.RUNNING)
+        journal.set_status(finished, job_journal.FINISHED)
+        journal.add_image(queued, 2, 44, 'outputs/2.png')
+        journal.add_image(queued, 0, 42, 'outputs/0.png')
+        journal.close()
+
+        journal = JobJournal(self.path)
+        jobs = journal.get_unfinished_jobs()
+        self.assertEqual([queued, running], [job_id for job_id, _ in jobs])
+        self.assertEqual('a cat', jobs[0][1]['prompt'])
+        self.assertEqual((2, 2, 3), jobs[0][1]['uov_input_image'].shape)
+        self.assertEqual(np.uint8, jobs[0][1]['uov_input_image'].dtype)
+        self.assertEqual({0: 'outputs/0.png', 2: 'outputs/2.png'}, journal.get_images(queued))
+        journal.close()
+
+    def test_remove_finished_jobs_keeps_unfinished(self):
+        journal = JobJournal(self.path)
+        queued = journal.add_job({}, image_number=1)
+        finished = journal.add_job({}, image_number=1)
+        journal.set_status(finished, job_journal.FINISHED)
+        journal.add_image(finished, 0, 1, 'outputs/0.png')
+        time.sleep(0.01)
+
+        self.assertEqual(1, journal.remove_finished_jobs(max_age=0))
+        self.assertIsNone(journal.get_status(finished))
+        self.assertEqual({}, journal.get_images(finished))
+        self.assertEqual(job_journal.QUEUED, journal.get_status(queued))
+        journal.close()
+
+    def test_state_is_stored_as_json(self):
+        journal = JobJournal(self.path)
+        image = np.arange(24, dtype=np.uint8).reshape((2, 4, 3))
+        state = dict(args=['a cat', 3, 0.5, True, None, dict(image=image, mask=None), [image]], priority=1)
+        job_id = journal.add_job(state, image_number=1)
+        with self.assertRaises(TypeError):
+            journal.add_job(dict(args=[object()]), image_number=1)
+        stored = journal.execute('SELECT state FROM jobs WHERE id = ?', (job_id,))[0][0]
+        self.assertEqual('a cat', json.loads(stored)['args'][0])
+
+        restored = journal.get_unfinished_jobs()[0][1]
+        self.assertEqual(['a cat', 3, 0.5, True, None], restored['args'][:5])
+        np.testing.assert_array_equal(image, restored['args'][5]['image'])
+        np.testing.assert_array_equal(image, restored['args'][6][0])
+        journal.close()
+
+    def test_pickled_state_is_not_loaded(self):
+        journal = JobJournal(self.path)
+        journal.execute('INSERT INTO jobs (id, status, created, updated, image_number, state) '
+                        'VALUES (?, ?, 0, 0, 1, ?)', ('old', job_journal.QUEUED, pickle.dumps(dict(prompt='a cat'))))
+        self.assertEqual([], journal.get_unfinished_jobs())
+        self.assertEqual(job_journal.FAILED, journal.get_status('old'))
+        journal.close()
@@ -0,0 +1,77 @@
+import threading
+import unittest
+
+from modules.lazy_conditioning import LazyConditioning
+
+
+class TestLazyConditioning(unittest.TestCase):
+    def test_inline_encodes_up_to_the_required_task(self):
+        encoded = []
+        prepared = []
+        tasks = [dict(index=i) for i in range(5)]
+        conditioning = LazyConditioning(tasks, lambda i, t: encoded.append(i),
+                                        prepare=lambda batch: prepared.append([t['index'] for t in batch])).start()
+
+        conditioning.require(0)
+        self.assertEqual([0], encoded)
+        conditioning.require(3)
+        conditioning.require(1)
+        self.assertEqual([0, 1, 2, 3], encoded)
+        conditioning.require(4)
+        self.assertEqual([0, 1, 2, 3, 4], encoded)
+        self.assertEqual([[1, 2, 3]], prepared)
+
+    def test_first_task_samples_before_the_others_are_encoded(self):
+        # the default path with the text encoder on the sampling device, sampling batches of two after the first
+        events = []
+        conditioning = LazyConditioning([{} for _ in range(5)], lambda i, t: events.append(f'encode {i}'),
+                                        prepare=lambda batch: events.append(f'prepare {len(batch)}'))
+        conditioning.require(0)
+        conditioning.start()
+        for first, last in [(0, 0), (1, 2), (3, 4)]:
+            conditioning.require(last)
+            for i in range(first, last + 1):
+                conditioning.require(i)
+            events.append(f'sample {first}-{last}')
+
+        self.assertEqual(['encode 0', 'sample 0-0', 'prepare 2', 'encode 1', 'encode 2', 'sample 1-2',
+                          'prepare 2', 'encode 3', 'encode 4', 'sample 3-4'], events)
+
+    def test_background_encodes_ahead(self):
+        release = threading.Event()
+
+        def encode(i, t):
+            if i == 2:
+                release.wait(timeout=5)
+            t['c'] = i
+
+        tasks = [{} for _ in range(3)]
+        conditioning = LazyConditioning(tasks, encode, background=True)
+        conditioning.require(0)
+        conditioning.start()
+
+        self.assertEqual(1, conditioning.require(1)['c'])
+        self.assertFalse(conditioning.ready[2].is_set())
+        release.set()
+        self.assertEqual(2, conditioning.require(2)['c'])
+        conditioning.cancel()
+
+    def test_errors_are_raised_for_their_task(self):
+        def encode(i, t):
+            if i == 1:
+                raise ValueError('bad prompt')
+
+        conditioning = LazyConditioning([{}, {}, {}], encode)
+        conditioning.require(0)
+        with self.assertRaises(ValueError):
+            conditioning.require(1)
+        conditioning.require(2)
+
+    def test_cancel_stops_encoding(self):
+        encoded = []
+        conditioning = LazyConditioning([{} for _ in range(3)], lambda i, t: encoded.append(i))
+        conditioning.encode_next()
+        conditioning.cancel()
+
+        self.assertFalse(conditioning.encode_next())
+        self.assertEqual([0], encoded)
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+
+from modules.lora_merge import get_merged_weights
+from modules.model_cache import ModelCache
+
+
+class Patcher:
+    def __init__(self, patches):
+        self.patches = patches
+
+    def model_state_dict(self):
+        return {k: torch.zeros(100) for k in ['a', 'b', 'c']}
+
+
+def merge(weights, patcher):
+    # what patch_model fills in for the keys that were not reused
+    for k in patcher.patches:
+        if k not in weights:
+            weights[k] = (patcher.patches[k], torch.ones(100))
+
+
+class TestMergedWeights(unittest.TestCase):
+    def test_reused_weights_are_counted_after_their_entry_is_evicted(self):
+        lora_a = torch.ones(1)
+        lora_b = torch.ones(1)
+        cache = ModelCache(max_bytes=1000)
+
+        first = Patcher({'a': [(1.0, lora_a, 1.0)], 'b': [(1.0, lora_b, 1.0)]})
+        weights = get_merged_weights(cache, first, ('model', 'first'))
+        merge(weights, first)
+        self.assertEqual(800, cache.stats()['total_bytes'])
+
+        second = Patcher({'a': [(1.0, lora_a, 1.0)], 'b': [(0.5, lora_b, 1.0)]})
+        reused = get_merged_weights(cache, second, ('model', 'second'), ('model', 'first'))
+        self.assertIs(weights['a'], reused['a'])
+        self.assertNotIn('b', reused)
+        merge(reused, second)
+
+        self.assertNotIn(('model', 'first'), cache)
+        self.assertEqual(800, cache.stats()['total_bytes'])
+        self.assertEqual(800, sum(v[1].nelement() * v[1].element_size() for v in reused.values()))
+
+    def test_weights_over_budget_are_not_cached(self):
+        patcher = Patcher({k: [(1.0, torch.ones(1), 1.0)] for k in ['a', 'b', 'c']})
+        self.assertIsNone(get_merged_weights(ModelCache(max_bytes=1000), patcher, ('model', 'all')))
+        self.assertIsNone(get_merged_weights(ModelCache(), patcher, ('model', 'all')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,20 @@
+import time
+import unittest
+
+from modules.memory_monitor import PeakMemoryMonitor
+
+
+class TestPeakMemoryMonitor(unittest.TestCase):
+    def test_records_peak_between_entry_and_exit(self):
+        rss = [100]
+
+        with PeakMemoryMonitor(interval=0.001, read_rss=lambda: rss[0]) as monitor:
+            rss[0] = 500
+            time.sleep(0.05)
+            rss[0] = 200
+
+        self.assertEqual(100, monitor.start_rss)
+        self.assertEqual(500, monitor.peak_rss)
+        self.assertEqual(200, monitor.end_rss)
+        self.assertGreater(monitor.elapsed, 0.0)
+        self.assertIn('peak RSS', monitor.summary())
@@ -0,0 +1,48 @@
+import unittest
+
+from modules.model_cache import ModelCache
+
+
+class TestModelCache(unittest.TestCase):
+    def test_evicts_least_recently_used_over_budget(self):
+        cache = ModelCache(max_bytes=10)
+        cache.put('a', 'model a', 4)
+        cache.put('b', 'model b', 4)
+        self.assertEqual('model a', cache.get('a'))
+        cache.put('c', 'model c', 4)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('model a', cache.get('a'))
+        self.assertEqual('model c', cache.get('c'))
+        self.assertEqual(8, cache.stats()['total_bytes'])
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_does_not_cache_models_over_budget(self):
+        cache = ModelCache(max_bytes=10)
+        cache.put('a', 'model a', 4)
+        self.assertFalse(cache.put('b', 'model b', 11))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+        disabled = ModelCache()
+        self.assertFalse(disabled.put('a', 'model a', 1))
+        self.assertEqual(0, len(disabled))
+
+    def test_replacing_entry_updates_size(self):
+        cache = ModelCache(max_bytes=10)
+        cache.put('a', 'model a', 4)
+        cache.put('a', 'model a', 6)
+        self.assertEqual(6, cache.stats()['total_bytes'])
+        self.assertEqual(1, len(cache))
+
+    def test_peek_keeps_order_and_counters(self):
+        cache = ModelCache(max_bytes=8)
+        cache.put('a', 'model a', 4)
+        cache.put('b', 'model b', 4)
+        self.assertEqual('model a', cache.peek('a'))
+        self.assertIsNone(cache.peek('c'))
+        cache.put('c', 'model c', 4)
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(0, cache.stats()['hits'])
+        self.assertEqual(0, cache.stats()['misses'])
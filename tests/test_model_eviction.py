@@ -0,0 +1,46 @@
+import unittest
+
+from modules.model_eviction import CostAwareEvictionPolicy
+
+gb = 1024 ** 3
+
+
+class Patcher:
+    def __init__(self):
+        self.model = object()
+
+
+class Candidate:
+    def __init__(self, name, size, load_time=None, last_used=0):
+        self.name = name
+        self.size = size
+        self.load_time = load_time
+        self.last_used = last_used
+        self.model = Patcher()
+
+    def model_memory(self):
+        return self.size
+
+
+class TestCostAwareEvictionPolicy(unittest.TestCase):
+    def test_without_measurements_keeps_lru_order(self):
+        policy = CostAwareEvictionPolicy()
+        candidates = [Candidate('old', 2 * gb, last_used=1), Candidate('new', 1 * gb, last_used=3)]
+        self.assertEqual(['old', 'new'], [c.name for c in policy.order(candidates, clock=3)])
+
+    def test_unloads_models_cheap_to_reload_first(self):
+        policy = CostAwareEvictionPolicy()
+        unet = Candidate('unet', 5 * gb, load_time=10.0, last_used=2)
+        clip = Candidate('clip', 1 * gb, load_time=0.5, last_used=3)
+        self.assertEqual(['clip', 'unet'], [c.name for c in policy.order([unet, clip], clock=3)])
+
+    def test_keeps_models_needed_by_queued_tasks(self):
+        expansion = Candidate('expansion', 1 * gb, load_time=0.5, last_used=3)
+        controlnet = Candidate('controlnet', 1 * gb, load_time=1.0, last_used=3)
+        policy = CostAwareEvictionPolicy(needed_soon=lambda: [expansion.model.model])
+        self.assertEqual(['controlnet', 'expansion'],
+                         [c.name for c in policy.order([expansion, controlnet], clock=3)])
+
+        failing = CostAwareEvictionPolicy(needed_soon=lambda: 1 / 0)
+        self.assertEqual(['expansion', 'controlnet'],
+                         [c.name for c in failing.order([expansion, controlnet], clock=3)])
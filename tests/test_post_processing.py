@@ -0,0 +1,53 @@
+import threading
+import time
+import unittest
+
+from modules.post_processing import PostProcessingStage
+
+
+class TestPostProcessingStage(unittest.TestCase):
+    def test_done_runs_in_submission_order(self):
+        stage = PostProcessingStage(max_workers=4, max_pending=8)
+        done = []
+        for i, delay in enumerate([0.05, 0.0, 0.03, 0.0]):
+            stage.submit(lambda i=i, delay=delay: time.sleep(delay) or i, done.append)
+        stage.join()
+
+        self.assertEqual([0, 1, 2, 3], done)
+
+    def test_submit_blocks_when_full(self):
+        stage = PostProcessingStage(max_workers=1, max_pending=1)
+        release = threading.Event()
+        stage.submit(release.wait)
+
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (stage.submit(lambda: None), submitted.set()))
+        thread.start()
+        self.assertFalse(submitted.wait(timeout=0.05))
+
+        release.set()
+        self.assertTrue(submitted.wait(timeout=5))
+        thread.join()
+        stage.join()
+
+    def test_join_raises_first_error_after_all_jobs(self):
+        stage = PostProcessingStage(max_workers=2)
+        done = []
+
+        def fail():
+            raise ValueError('disk full')
+
+        stage.submit(fail, done.append)
+        stage.submit(lambda: 'ok', done.append)
+
+        with self.assertRaises(ValueError):
+            stage.join()
+        self.assertEqual(['ok'], done)
+
+    def test_inline_stage(self):
+        stage = PostProcessingStage(max_workers=0)
+        done = []
+        future = stage.submit(lambda: 1, done.append)
+
+        self.assertEqual([1], done)
+        self.assertEqual(1, future.result())
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from modules.prefetch import ModelPrefetcher
+
+
+class BlockingPrefetcher(ModelPrefetcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def read_file(self, path, generation):
+        self.started.set()
+        self.release.wait(5)
+        return super().read_file(path, generation)
+
+
+class TestModelPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = []
+        for name, size in [('a.safetensors', 300), ('b.safetensors', 500), ('c.safetensors', 200)]:
+            path = os.path.join(self.directory.name, name)
+            with open(path, 'wb') as fp:
+                fp.write(b'\0' * size)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reads_files_within_budget_once(self):
+        prefetcher = ModelPrefetcher(max_bytes=600, chunk_size=128, available_memory=lambda: 10 ** 9)
+        prefetcher.schedule(self.files + [os.path.join(self.directory.name, 'missing.safetensors')])
+        self.assertTrue(prefetcher.wait(timeout=5))
+
+        stats = prefetcher.stats()
+        self.assertEqual(2, stats['prefetched_files'])
+        self.assertEqual(500, stats['prefetched_bytes'])
+        self.assertEqual(1, stats['skipped_files'])
+
+        prefetcher.schedule(self.files[:1])
+        self.assertTrue(prefetcher.wait(timeout=5))
+        self.assertEqual(2, prefetcher.stats()['prefetched_files'])
+
+    def test_new_schedule_cancels_running_prefetch(self):
+        prefetcher = BlockingPrefetcher(max_bytes=1000, chunk_size=128, available_memory=lambda: 10 ** 9)
+        prefetcher.schedule(self.files[:1])
+        self.assertTrue(prefetcher.started.wait(5))
+        prefetcher.schedule(self.files[2:])
+        prefetcher.release.set()
+        self.assertTrue(prefetcher.wait(timeout=5))
+
+        stats = prefetcher.stats()
+        self.assertEqual(1, stats['cancelled'])
+        self.assertEqual(1, stats['prefetched_files'])
+        self.assertEqual(200, stats['prefetched_bytes'])
+
+    def test_disabled_without_budget(self):
+        prefetcher = ModelPrefetcher(max_bytes=0)
+        prefetcher.schedule(self.files)
+        self.assertIsNone(prefetcher.thread)
@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+import numpy as np
+
+from modules.progress_channel import ProgressChannel
+
+
+class TestProgressChannel(unittest.TestCase):
+    def test_keeps_only_latest_preview(self):
+        channel = ProgressChannel()
+        for i in range(10):
+            channel.append(['preview', (i, f'step {i}', np.zeros((2, 2, 3)))])
+
+        self.assertEqual(1, len(channel))
+        flag, product = channel.get()
+        self.assertEqual('preview', flag)
+        self.assertEqual(9, product[0])
+        self.assertEqual(9, channel.previews_dropped)
+
+    def test_never_drops_results_and_finish(self):
+        channel = ProgressChannel()
+        channel.append(['preview', (1, 'a', None)])
+        channel.append(['results', ['x']])
+        channel.append(['preview', (2, 'b', None)])
+        channel.append(['results', ['x', 'y']])
+        channel.append(['preview', (3, 'c', None)])
+        channel.append(['finish', ['x', 'y']])
+
+        events = [channel.get() for _ in range(len(channel))]
+        self.assertEqual(['results', 'results', 'preview', 'finish'], [flag for flag, _ in events])
+        self.assertEqual(3, events[2][1][0])
+
+    def test_get_blocks_until_put(self):
+        channel = ProgressChannel()
+        self.assertIsNone(channel.get(timeout=0.01))
+
+        result = []
+        consumer = threading.Thread(target=lambda: result.append(channel.get(timeout=5)))
+        consumer.start()
+        channel.append(['finish', []])
+        consumer.join()
+
+        self.assertEqual(['finish', []], result[0])
+
+    def test_deepcopy_gives_empty_channel(self):
+        import copy
+        channel = ProgressChannel()
+        channel.append(['results', ['x']])
+
+        copied = copy.deepcopy(channel)
+        self.assertEqual(0, len(copied))
+        self.assertEqual(1, len(channel))
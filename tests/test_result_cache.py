@@ -0,0 +1,93 @@
+import os
+import tempfile
+import time
+import unittest
+
+from modules.result_cache import ResultCache, get_cache_key
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.images = []
+        for i in range(3):
+            path = os.path.join(self.directory.name, f'{i}.png')
+            open(path, 'wb').close()
+            self.images.append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_key_ignores_order_of_settings(self):
+        self.assertEqual(get_cache_key(dict(seed=1, positive=['a cat'])),
+                         get_cache_key(dict(positive=['a cat'], seed=1)))
+        self.assertNotEqual(get_cache_key(dict(seed=1, positive=['a cat'])),
+                            get_cache_key(dict(seed=2, positive=['a cat'])))
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('a', [self.images[0]])
+        cache.put('b', [self.images[1]])
+        self.assertEqual([self.images[0]], cache.get('a'))
+        cache.put('c', [self.images[2]])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([self.images[0]], cache.get('a'))
+        self.assertEqual(2, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_drops_expired_and_missing_images(self):
+        cache = ResultCache(max_age=0.01)
+        cache.put('a', [self.images[0]])
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+        cache = ResultCache()
+        cache.put('b', [self.images[1]])
+        os.remove(self.images[1])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(0, len(cache))
+
+    def test_entries_are_persisted(self):
+        path = os.path.join(self.directory.name, 'result_cache.jsonl')
+        cache = ResultCache(path=path)
+        cache.put('a', [self.images[0], self.images[1]])
+        cache.put('b', [self.images[2]])
+        os.remove(self.images[2])
+
+        cache = ResultCache(path=path)
+        self.assertEqual([self.images[0], self.images[1]], cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        with open(path, 'rt', encoding='utf-8') as fp:
+            self.assertEqual(1, len(fp.readlines()))
+
+    def test_file_is_compacted_while_running(self):
+        path = os.path.join(self.directory.name, 'result_cache.jsonl')
+        main = ResultCache(path=path, max_entries=2)
+        worker = ResultCache(path=path, max_entries=2, compact=False)
+        for i in range(10):
+            main.put(f'main {i}', [self.images[0]])
+            worker.put(f'worker {i}', [self.images[1]])
+            with open(path, 'rb') as fp:
+                self.assertLessEqual(len(fp.readlines()), 2 * 2 + 2)
+
+        self.assertEqual([self.images[1]], main.get('worker 9'))
+        self.assertEqual([self.images[0]], worker.get('main 9'))
+        self.assertEqual([self.images[0]], ResultCache(path=path, max_entries=2).get('main 9'))
+
+    def test_processes_share_the_file(self):
+        path = os.path.join(self.directory.name, 'result_cache.jsonl')
+        main = ResultCache(path=path)
+        main.put('a', [self.images[0]])
+        with open(path, 'ab') as fp:
+            fp.write(b'{"key": "partial"')
+
+        worker = ResultCache(path=path, compact=False)
+        with open(path, 'rb') as fp:
+            self.assertTrue(fp.read().endswith(b'"partial"'))
+        self.assertEqual([self.images[0]], worker.get('a'))
+
+        with open(path, 'ab') as fp:
+            fp.write(b', "created": 0, "paths": []}\n')
+        main.put('b', [self.images[1]])
+        self.assertEqual([self.images[1]], worker.get('b'))
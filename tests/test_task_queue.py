@@ -0,0 +1,124 @@
+import threading
+import unittest
+
+from modules.task_queue import TaskQueue, TaskPriority
+
+
+class Task:
+    def __init__(self, name, priority=TaskPriority.NORMAL, client_id=None):
+        self.name = name
+        self.priority = priority
+        self.client_id = client_id
+
+
+class TestTaskQueue(unittest.TestCase):
+    def test_priority_before_arrival_order(self):
+        queue = TaskQueue()
+        queue.put(Task('low', TaskPriority.LOW))
+        queue.put(Task('normal'))
+        queue.put(Task('high', TaskPriority.HIGH))
+
+        self.assertEqual(['high', 'normal', 'low'], [queue.get().name for _ in range(3)])
+
+    def test_fair_share_between_clients(self):
+        queue = TaskQueue()
+        for i in range(3):
+            queue.put(Task(f'a{i}', client_id='a'))
+        queue.put(Task('b0', client_id='b'))
+        queue.put(Task('b1', client_id='b'))
+
+        self.assertEqual(['a0', 'b0', 'a1', 'b1', 'a2'], [t.name for t in queue.peek(count=5)])
+        self.assertEqual(['a0', 'b0', 'a1', 'b1', 'a2'], [queue.get().name for _ in range(5)])
+
+    def test_cancel_and_reorder(self):
+        queue = TaskQueue()
+        tasks = [Task(f't{i}') for i in range(3)]
+        for t in tasks:
+            queue.put(t)
+
+        self.assertTrue(queue.cancel(tasks[1]))
+        self.assertFalse(queue.cancel(tasks[1]))
+        self.assertTrue(queue.move(tasks[2], 0))
+        self.assertEqual(0, queue.position(tasks[2]))
+        self.assertEqual(['t2', 't0'], [queue.get().name for _ in range(2)])
+        self.assertEqual(1, queue.stats()['cancelled'])
+
+    def test_move_within_client_only(self):
+        queue = TaskQueue()
+        tasks = {name: Task(name, client_id=name[0]) for name in ['a0', 'b0', 'a1', 'b1', 'a2']}
+        for t in tasks.values():
+            queue.put(t)
+
+        self.assertTrue(queue.move(tasks['a2'], 0))
+        self.assertEqual(['a2', 'b0', 'a0', 'b1', 'a1'], [t.name for t in queue.peek(count=5)])
+        # the task of another client is not moved ahead of the fair share
+        self.assertTrue(queue.move(tasks['b1'], 0))
+        self.assertEqual(1, queue.position(tasks['b1']))
+        self.assertEqual(3, queue.position(tasks['b0']))
+        self.assertEqual(['a2', 'b1', 'a0', 'b0', 'a1'], [queue.get().name for _ in range(5)])
+
+    def test_get_blocks_until_put(self):
+        queue = TaskQueue()
+        self.assertIsNone(queue.get(timeout=0.01))
+
+        result = []
+        consumer = threading.Thread(target=lambda: result.append(queue.get(timeout=5)))
+        consumer.start()
+        queue.put(Task('t'))
+        consumer.join()
+
+        self.assertEqual('t', result[0].name)
+        stats = queue.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(1, stats['dispatched'])
+
+    def test_model_affinity_with_bounded_bypass(self):
+        queue = TaskQueue(affinity_key=lambda t: t.name[0], max_affinity_bypass=2)
+        for name in ['a0', 'b0', 'a1', 'a2', 'a3', 'b1']:
+            queue.put(Task(name))
+
+        expected = ['a0', 'a1', 'a2', 'b0', 'b1', 'a3']
+        self.assertEqual(expected, [t.name for t in queue.peek(count=6)])
+        self.assertEqual(expected, [queue.get().name for _ in range(6)])
+
+        stats = queue.stats()
+        self.assertEqual(3, stats['model_switches_avoided'])
+        self.assertEqual(2, stats['model_switches'])
+
+    def test_model_affinity_per_consumer(self):
+        queue = TaskQueue(affinity_key=lambda t: t.name[0], max_affinity_bypass=4)
+        queue.put(Task('a0'))
+        queue.put(Task('b0'))
+        self.assertEqual('a0', queue.get(consumer='gpu0').name)
+        self.assertEqual('b0', queue.get(consumer='gpu1').name)
+
+        # each worker keeps getting the tasks for the models it has loaded
+        for name in ['a1', 'b1', 'a2', 'b2']:
+            queue.put(Task(name))
+        self.assertEqual(['b1', 'b2'], [t.name for t in queue.peek(count=2, consumer='gpu1')])
+        self.assertEqual('b1', queue.get(consumer='gpu1').name)
+        self.assertEqual('a1', queue.get(consumer='gpu0').name)
+        self.assertEqual('b2', queue.get(consumer='gpu1').name)
+        self.assertEqual('a2', queue.get(consumer='gpu0').name)
+
+        stats = queue.stats()
+        self.assertEqual(0, stats['model_switches'])
+        self.assertEqual(2, stats['model_switches_avoided'])
+        self.assertEqual(dict(dispatched=3, model_switches=0, model_switches_avoided=2),
+                         {k: v for k, v in stats['consumers']['gpu1'].items() if k != 'wait_time_last'})
+        self.assertEqual(3, queue.consumer_stats('gpu0')['dispatched'])
+        self.assertNotIn('local', stats['consumers'])
+
+    def test_listeners_see_every_change(self):
+        queue = TaskQueue()
+        heads = []
+        queue.add_listener(lambda: heads.append([t.name for t in queue.peek()]))
+        tasks = [Task('t0'), Task('t1')]
+        for t in tasks:
+            queue.put(t)
+        queue.move(tasks[1], 0)
+        queue.cancel(tasks[0])
+        queue.cancel(tasks[0])
+        queue.get()
+
+        self.assertEqual([['t0'], ['t0'], ['t1'], ['t1'], []], heads)
@@ -0,0 +1,36 @@
+import threading
+import unittest
+
+import modules.task_context as task_context
+from modules.worker_pool import get_worker_argv, get_task_state
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_worker_argv(self):
+        argv = ['--listen', '--worker-devices', '0,cpu', '--gpu-device-id', '1', '--preset', 'anime']
+        self.assertEqual(['--listen', '--preset', 'anime'], get_worker_argv(argv, '0'))
+        self.assertEqual(['--listen', '--preset', 'anime', '--always-cpu'], get_worker_argv(argv, 'cpu'))
+        self.assertEqual(['--always-cpu'], get_worker_argv(['--worker-devices=cpu', '--always-cpu'], 'cpu'))
+
+    def test_task_state_skips_local_attributes(self):
+        class Task:
+            pass
+
+        task = Task()
+        task.yields = object()
+        task.remote_worker = object()
+        task.prompt = 'a cat'
+        self.assertEqual({'prompt': 'a cat'}, get_task_state(task))
+
+    def test_task_context_is_per_thread(self):
+        context = task_context.activate(task_context.TaskContext())
+        context.refiner = 'main'
+
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(task_context.current().refiner))
+        thread.start()
+        thread.join()
+
+        self.assertEqual([None], seen)
+        self.assertIs(context, task_context.current())
+        task_context.activate(None)
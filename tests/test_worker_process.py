@@ -0,0 +1,23 @@
+import random
+import unittest
+
+from tests import import_config
+
+config = import_config()
+
+from modules.util import apply_wildcards
+from modules.worker_pool import prepare_worker_process
+
+
+class TestWorkerProcess(unittest.TestCase):
+    def test_wildcards_resolve_in_worker_process(self):
+        config.wildcard_filenames = []
+        prepare_worker_process()
+
+        words = open('wildcards/color.txt', encoding='utf-8').read().splitlines()
+        result = apply_wildcards('a __color__ car', random.Random(1), 0, read_wildcards_in_order=True)
+        self.assertEqual(f'a {words[0]} car', result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,7 +44,7 @@ def get_task(*args):
 
     return worker.AsyncTask(args=args)
 
-def generate_clicked(task: worker.AsyncTask):
+def generate_clicked(task: worker.AsyncTask, request: gr.Request):
     import ldm_patched.modules.model_management as model_management
 
     with model_management.interrupt_processing_mutex:
@@ -62,45 +62,38 @@ def generate_clicked(task: worker.AsyncTask):
         gr.update(visible=False, value=None), \
         gr.update(visible=False)
 
-    worker.async_tasks.append(task)
+    if request is not None:
+        task.client_id = request.username if getattr(request, 'username', None) else request.session_hash
+    worker.enqueue_task(task)
 
     while not finished:
-        time.sleep(0.01)
-        if len(task.yields) > 0:
-            flag, product = task.yields.pop(0)
-            if flag == 'preview':
-
-                # help bad internet connection by skipping duplicated preview
-                if len(task.yields) > 0:  # if we have the next item
-                    if task.yields[0][0] == 'preview':   # if the next item is also a preview
-                        # print('Skipped one preview for better internet connection.')
-                        continue
-
-                percentage, title, image = product
-                yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
-                    gr.update(visible=True, value=image) if image is not None else gr.update(), \
-                    gr.update(), \
-                    gr.update(visible=False)
-            if flag == 'results':
-                yield gr.update(visible=True), \
-                    gr.update(visible=True), \
-                    gr.update(visible=True, value=product), \
-                    gr.update(visible=False)
-            if flag == 'finish':
-                if not args_manager.args.disable_enhance_output_sorting:
-                    product = sort_enhance_images(product, task)
-
-                yield gr.update(visible=False), \
-                    gr.update(visible=False), \
-                    gr.update(visible=False), \
-                    gr.update(visible=True, value=product)
-                finished = True
-
-                # delete Fooocus temp images, only keep gradio temp images
-                if args_manager.args.disable_image_log:
-                    for filepath in product:
-                        if isinstance(filepath, str) and os.path.exists(filepath):
-                            os.remove(filepath)
+        flag, product = task.yields.get()
+        if flag == 'preview':
+            percentage, title, image = product
+            yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
+                gr.update(visible=True, value=image) if image is not None else gr.update(), \
+                gr.update(), \
+                gr.update(visible=False)
+        if flag == 'results':
+            yield gr.update(visible=True), \
+                gr.update(visible=True), \
+                gr.update(visible=True, value=product), \
+                gr.update(visible=False)
+        if flag == 'finish':
+            if not args_manager.args.disable_enhance_output_sorting:
+                product = sort_enhance_images(product, task)
+
+            yield gr.update(visible=False), \
+                gr.update(visible=False), \
+                gr.update(visible=False), \
+                gr.update(visible=True, value=product)
+            finished = True
+
+            # delete Fooocus temp images, only keep gradio temp images
+            if args_manager.args.disable_image_log:
+                for filepath in product:
+                    if isinstance(filepath, str) and os.path.exists(filepath):
+                        os.remove(filepath)
 
     execution_time = time.perf_counter() - execution_start_time
     print(f'Total time: {execution_time:.2f} seconds')
@@ -198,17 +191,17 @@ with shared.gradio_root:
                     stop_button = gr.Button(label="Stop", value="Stop", elem_classes='type_row_half', elem_id='stop_button', visible=False)
 
                     def stop_clicked(currentTask):
-                        import ldm_patched.modules.model_management as model_management
                         currentTask.last_stop = 'stop'
                         if (currentTask.processing):
-                            model_management.interrupt_current_processing()
+                            worker.interrupt_task(currentTask)
+                        elif worker.cancel_task(currentTask):
+                            currentTask.yields.append(['finish', currentTask.results])
                         return currentTask
 
                     def skip_clicked(currentTask):
-                        import ldm_patched.modules.model_management as model_management
                         currentTask.last_stop = 'skip'
                         if (currentTask.processing):
-                            model_management.interrupt_current_processing()
+                            worker.interrupt_task(currentTask)
                         return currentTask
 
                     stop_button.click(stop_clicked, inputs=currentTask, outputs=currentTask, queue=False, show_progress=False, _js='cancelGenerateForever')
@@ -1131,6 +1124,10 @@ def dump_default_english_config():
 
 # dump_default_english_config()
 
+if args_manager.args.api_port is not None:
+    import modules.api_server
+    modules.api_server.start()
+
 shared.gradio_root.launch(
     inbrowser=args_manager.args.in_browser,
     server_name=args_manager.args.listen,